@@ -78,6 +78,20 @@ import getpass
 
 STATUS_FILE = 'last_status'
 
+# The configuration options whose changes can be applied to the running log copier and monitors without restarting
+# them.  These are the only options that can be set in the configuration directory.
+RELOADABLE_OPTIONS = ['logs', 'monitors', 'server_attributes', 'debug_level']
+
+# The configuration options that only affect the connection to the Scalyr servers.  Changing them requires a new
+# client, but the log copier and monitors can keep running.
+SERVER_CONNECTION_OPTIONS = ['api_key', 'scalyr_server', 'additional_scalyr_servers', 'load_balance_servers',
+                             'request_deadline', 'compression_type', 'compression_level',
+                             'limit_compressed_request_size', 'ca_cert_path', 'verify_server_certificate']
+
+# The maximum number of seconds to wait for the log copier to apply a new configuration before starting the new
+# monitors.
+CONFIG_UPDATE_TIMEOUT = 30
+
 
 class ScalyrAgent(object):
     """Encapsulates the entire Scalyr Agent 2 application.
@@ -106,8 +120,13 @@ class ScalyrAgent(object):
         # If the current contents of the configuration file has errors in it, then this will be set to the config
         # object produced by reading it.
         self.__current_bad_config = None
+        # The configuration produced by the most recent parse of the configuration files, whether or not it was bad or
+        # equivalent to the one in use.  The files are only parsed again if they differ from what it read.
+        self.__last_parsed_config = None
         # The last time the configuration file was checked to see if it had changed.
         self.__last_config_check_time = None
+        # The number of checks that found the configuration files unchanged, so they were not parsed again.
+        self.__unchanged_config_checks = 0
         self.__start_time = None
         # The path where the agent log file is being written.
         self.__log_file_path = None
@@ -117,6 +136,10 @@ class ScalyrAgent(object):
         self.__monitors_manager = None
         # The current ScalyrClientSession to use for sending requests.
         self.__scalyr_client = None
+        # The ScalyrClientSessions replaced by configuration updates that the copying manager may still be sending
+        # requests with.  Their stats are included in the overall stats until the copying manager has switched to the
+        # new client, at which point they are folded into the base stats.
+        self.__replaced_clients = []
 
         # Tracks whether or not the agent should still be running.  When a terminate signal is received,
         # the run state is set to false.  Threads are expected to notice this and finish as quickly as
@@ -531,11 +554,14 @@ class ScalyrAgent(object):
 
                 self.__copying_manager = worker_thread.copying_manager
                 self.__monitors_manager = worker_thread.monitors_manager
+                self.__last_parsed_config = self.__config
 
                 while not self.__run_state.sleep_but_awaken_if_stopped(30):
                     current_time = time.time()
                     self.__last_config_check_time = current_time
 
+                    base_overall_stats = self.__fold_replaced_client_stats(base_overall_stats)
+
                     # Log the overall stats once every 10 mins.
                     if current_time > last_overall_stats_report_time + 600:
                         self.__log_overall_stats(self.__calculate_overall_stats(base_overall_stats))
@@ -544,11 +570,23 @@ class ScalyrAgent(object):
                     # Log the bandwidth-related stats once every minute:
                     if current_time > last_bw_stats_report_time + 60:
                         self.__log_bandwidth_stats(self.__calculate_overall_stats(base_overall_stats))
+                        self.__log_request_phase_stats()
                         last_bw_stats_report_time = current_time
 
                     log.log(scalyr_logging.DEBUG_LEVEL_1, 'Checking for any changes to config file')
+                    # If none of the configuration files have changed since they were last parsed, parsing them
+                    # again would produce the same result, so we skip it.
+                    last_config = self.__last_parsed_config
+                    if last_config.compute_file_set_fingerprint() == last_config.file_set_fingerprint:
+                        log.log(scalyr_logging.DEBUG_LEVEL_1, 'Config files have not changed')
+                        self.__unchanged_config_checks += 1
+                        continue
+
                     new_config = Configuration(self.__config_file_path, self.__default_paths, self.__default_monitors,
                                                CopyingManager.build_log, MonitorsManager.build_monitor)
+                    # Even if the new configuration is bad or equivalent to the current one, its fingerprint reflects
+                    # the files as they are now, so they do not need to be parsed again until they change.
+                    self.__last_parsed_config = new_config
                     try:
                         new_config.parse()
                         self.__verify_can_write_to_logs_and_data(new_config)
@@ -566,11 +604,26 @@ class ScalyrAgent(object):
                     # See if the config has changed -- we ignore the debug_level setting since, if we are in the
                     # middle of debugging some weird behavior, we do not to restart the how copy manager, etc.  We
                     # just update the debugging logging level down below to whatever the new value is.
+                    changed_options = []
                     if not self.__config.equivalent(new_config, exclude_debug_level=True):
+                        changed_options = self.__config.get_changed_options(new_config)
+
+                    # Only restart the workers if an option they cannot update in place has changed.  Otherwise, we
+                    # just need a new client if the server connection options changed.
+                    restart_required = False
+                    reconnect_required = False
+                    for option in changed_options:
+                        if option in SERVER_CONNECTION_OPTIONS:
+                            reconnect_required = True
+                        elif option not in RELOADABLE_OPTIONS:
+                            restart_required = True
+
+                    if restart_required:
                         log.log(scalyr_logging.DEBUG_LEVEL_1, 'Config was different than previous.  Reloading.')
                         # We are about to reset the current workers and ScalyrClientSession, so we will lose their
-                        # contribution to the stats, so recalculate the base.
+                        # contribution to the stats, so recalculate the base.  This includes any replaced clients.
                         base_overall_stats = self.__calculate_overall_stats(base_overall_stats)
+                        self.__replaced_clients = []
                         log.info('New configuration file seen.')
                         log.info('Stopping copying and metrics threads.')
                         worker_thread.stop()
@@ -585,6 +638,20 @@ class ScalyrAgent(object):
                         self.__monitors_manager = worker_thread.monitors_manager
 
                         worker_thread.start()
+                    elif len(changed_options) > 0:
+                        log.log(scalyr_logging.DEBUG_LEVEL_1, 'Config was different than previous.  Updating.')
+                        log.info('New configuration file seen.  Updating copying and metrics threads in place.')
+                        self.__config = new_config
+                        new_client = None
+                        if reconnect_required:
+                            # The copying manager keeps sending with the current client until it applies the update,
+                            # so its stats are still tracked until then.
+                            self.__replaced_clients.append(self.__scalyr_client)
+                            log.info('Connecting to the Scalyr servers with the new settings.')
+                            self.__scalyr_client = self.__create_client()
+                            new_client = self.__scalyr_client
+                        worker_thread.update_config(self.__config, new_client)
+                        base_overall_stats = self.__fold_replaced_client_stats(base_overall_stats)
                     else:
                         log.log(scalyr_logging.DEBUG_LEVEL_1, 'Config was not different than previous')
 
@@ -635,7 +702,12 @@ class ScalyrAgent(object):
         else:
             ca_file = None
         return ScalyrClientSession(self.__config.scalyr_server, self.__config.api_key, SCALYR_VERSION, quiet=quiet,
-                                   request_deadline=self.__config.request_deadline, ca_file=ca_file)
+                                   request_deadline=self.__config.request_deadline, ca_file=ca_file,
+                                   compression_type=self.__config.compression_type,
+                                   compression_level=self.__config.compression_level,
+                                   limit_compressed_size=self.__config.limit_compressed_request_size,
+                                   additional_servers=list(self.__config.additional_scalyr_servers),
+                                   load_balance=self.__config.load_balance_servers)
 
     def __get_file_initial_position(self, path):
         """Returns the file size for the specified file.
@@ -731,6 +803,7 @@ class ScalyrAgent(object):
             config_result.last_error = self.__current_bad_config.last_error
             config_result.last_good_read = self.__config.read_time
             config_result.last_check_time = self.__last_config_check_time
+            config_result.last_parse_duration = self.__current_bad_config.parse_duration
         else:
             config_result.path = self.__config.file_path
             config_result.additional_paths = list(self.__config.additional_file_paths)
@@ -738,12 +811,16 @@ class ScalyrAgent(object):
             config_result.status = 'Good'
             config_result.last_error = None
             config_result.last_good_read = self.__config.read_time
+            config_result.last_parse_duration = self.__config.parse_duration
+        config_result.unchanged_checks = self.__unchanged_config_checks
 
         # Include the copying and monitors status.
         if self.__copying_manager is not None:
             result.copying_manager_status = self.__copying_manager.generate_status()
         if self.__monitors_manager is not None:
             result.monitor_manager_status = self.__monitors_manager.generate_status()
+        if self.__scalyr_client is not None:
+            result.request_phases = self.__scalyr_client.get_request_phase_status()
 
         return result
 
@@ -782,12 +859,31 @@ class ScalyrAgent(object):
         """
         stats = overall_stats
         log.info('agent_requests requests_sent=%ld requests_failed=%ld bytes_sent=%ld bytes_received=%ld '
-                 'request_latency_secs=%lf connections_created=%ld ' % (stats.total_requests_sent,
-                                                                        stats.total_requests_failed,
-                                                                        stats.total_request_bytes_sent,
-                                                                        stats.total_response_bytes_received,
-                                                                        stats.total_request_latency_secs,
-                                                                        stats.total_connections_created))
+                 'request_latency_secs=%lf connections_created=%ld compressed_bytes_sent=%ld '
+                 'uncompressed_bytes_sent=%ld ' % (stats.total_requests_sent,
+                                                   stats.total_requests_failed,
+                                                   stats.total_request_bytes_sent,
+                                                   stats.total_response_bytes_received,
+                                                   stats.total_request_latency_secs,
+                                                   stats.total_connections_created,
+                                                   stats.total_compressed_request_bytes_sent,
+                                                   stats.total_uncompressed_request_bytes_sent))
+
+    def __log_request_phase_stats(self):
+        """Logs the agent_request_phases message that we periodically write to the agent log along with the
+        agent_requests message to break down where the request latency is spent.
+
+        This includes the average, median, and 99th percentile of the time spent in each phase of the requests sent
+        by the current client, in milliseconds.  Phases that no request has completed are omitted.
+        """
+        fields = []
+        for phase_status in self.__scalyr_client.get_request_phase_status():
+            if phase_status.count > 0:
+                fields.append('%s_count=%ld %s_avg_ms=%.1f %s_p50_ms=%.1f %s_p99_ms=%.1f' % (
+                    phase_status.phase, phase_status.count, phase_status.phase, phase_status.average * 1000,
+                    phase_status.phase, phase_status.p50 * 1000, phase_status.phase, phase_status.p99 * 1000))
+        if len(fields) > 0:
+            log.info('agent_request_phases %s' % ' '.join(fields))
 
     def __calculate_overall_stats(self, base_overall_stats):
         """Return a newly calculated overall stats for the agent.
@@ -804,7 +900,9 @@ class ScalyrAgent(object):
         """
         current_status = self.__generate_status()
 
-        delta_stats = OverallStats()
+        delta_stats = self.__calculate_client_stats(self.__scalyr_client)
+        for scalyr_client in self.__replaced_clients:
+            delta_stats = delta_stats + self.__calculate_client_stats(scalyr_client)
 
         watched_paths = 0
         copying_paths = 0
@@ -822,6 +920,14 @@ class ScalyrAgent(object):
                     delta_stats.total_bytes_failed += processor_status.total_bytes_failed
                     delta_stats.total_redactions += processor_status.total_redactions
 
+            # The metric lines sent directly from the monitors, if the metric queue is used.
+            metric_queue_status = current_status.copying_manager_status.metric_queue_status
+            if metric_queue_status is not None:
+                delta_stats.total_bytes_copied += metric_queue_status.total_bytes_copied
+                delta_stats.total_bytes_subsampled += metric_queue_status.total_bytes_dropped_by_sampling
+                delta_stats.total_bytes_failed += metric_queue_status.total_bytes_failed
+                delta_stats.total_redactions += metric_queue_status.total_redactions
+
         running_monitors = 0
         dead_monitors = 0
 
@@ -832,13 +938,6 @@ class ScalyrAgent(object):
                 delta_stats.total_monitor_reported_lines += monitor_status.reported_lines
                 delta_stats.total_monitor_errors += monitor_status.errors
 
-        delta_stats.total_requests_sent = self.__scalyr_client.total_requests_sent
-        delta_stats.total_requests_failed = self.__scalyr_client.total_requests_failed
-        delta_stats.total_request_bytes_sent = self.__scalyr_client.total_request_bytes_sent
-        delta_stats.total_response_bytes_received = self.__scalyr_client.total_response_bytes_received
-        delta_stats.total_request_latency_secs = self.__scalyr_client.total_request_latency_secs
-        delta_stats.total_connections_created = self.__scalyr_client.total_connections_created
-
         # Add in the latest stats to the stats before the last restart.
         result = delta_stats + base_overall_stats
 
@@ -854,6 +953,44 @@ class ScalyrAgent(object):
 
         return result
 
+    def __fold_replaced_client_stats(self, base_overall_stats):
+        """Adds the stats of the replaced clients to the base stats once the copying manager no longer uses them.
+
+        @param base_overall_stats: The accumulated stats from before the last config change.
+        @type base_overall_stats: OverallStats
+
+        @return: The new base stats.
+        @rtype: OverallStats
+        """
+        if len(self.__replaced_clients) == 0 or not self.__copying_manager.wait_for_config_update(0):
+            return base_overall_stats
+
+        # The copying manager closes the old client when it switches, so its stats will not change anymore.
+        for scalyr_client in self.__replaced_clients:
+            base_overall_stats = self.__calculate_client_stats(scalyr_client) + base_overall_stats
+        self.__replaced_clients = []
+        return base_overall_stats
+
+    def __calculate_client_stats(self, scalyr_client):
+        """Returns the stats tracked by the specified client.
+
+        @param scalyr_client: The client.
+        @type scalyr_client: ScalyrClientSession
+
+        @return: The stats.  Only the fields related to requests are set.
+        @rtype: OverallStats
+        """
+        result = OverallStats()
+        result.total_requests_sent = scalyr_client.total_requests_sent
+        result.total_requests_failed = scalyr_client.total_requests_failed
+        result.total_request_bytes_sent = scalyr_client.total_request_bytes_sent
+        result.total_compressed_request_bytes_sent = scalyr_client.total_compressed_request_bytes_sent
+        result.total_uncompressed_request_bytes_sent = scalyr_client.total_uncompressed_request_bytes_sent
+        result.total_response_bytes_received = scalyr_client.total_response_bytes_received
+        result.total_request_latency_secs = scalyr_client.total_request_latency_secs
+        result.total_connections_created = scalyr_client.total_connections_created
+        return result
+
     def __report_status_to_file(self):
         """Handles the signal sent to request this process write its current detailed status out."""
         tmp_file = None
@@ -883,7 +1020,17 @@ class WorkerThread(object):
     """
     def __init__(self, configuration, scalyr_client, logs_initial_positions=None):
         self.__scalyr_client = scalyr_client
-        self.copying_manager = CopyingManager(scalyr_client, configuration, logs_initial_positions)
+        # If enabled, the monitors add their metric lines to this queue and the copying manager sends them from it,
+        # rather than having the metric lines written to disk and then read back.  This must be set before the
+        # monitors open their metric logs.
+        if configuration.metric_queue_size > 0:
+            metric_queue = scalyr_logging.MetricEventQueue(configuration.metric_queue_size)
+            scalyr_logging.set_metric_queue(metric_queue, write_metric_logs=configuration.write_metric_logs)
+        else:
+            metric_queue = None
+            scalyr_logging.set_metric_queue(None)
+        self.copying_manager = CopyingManager(scalyr_client, configuration, logs_initial_positions,
+                                              metric_queue=metric_queue)
         self.monitors_manager = MonitorsManager(configuration)
 
     def start(self):
@@ -895,6 +1042,26 @@ class WorkerThread(object):
         self.copying_manager.wait_for_copying_to_begin()
         self.monitors_manager.start()
 
+    def update_config(self, configuration, scalyr_client=None):
+        """Updates the log copier and monitors to use a new configuration without restarting them.
+
+        See CopyingManager.update_config and MonitorsManager.update_config for the options that can be updated.
+
+        @param configuration: The new configuration.
+        @param scalyr_client: If not None, the client to use for sending requests from now on.
+
+        @type configuration: Configuration
+        @type scalyr_client: ScalyrClientSession
+        """
+        self.copying_manager.update_config(configuration, scalyr_client)
+        if scalyr_client is not None:
+            self.__scalyr_client = scalyr_client
+        # Like start, we wait for the copying manager to pick up the log entries for any new monitors before
+        # starting them, so that their files are copied from byte index zero.
+        if not self.copying_manager.wait_for_config_update(CONFIG_UPDATE_TIMEOUT):
+            log.warn('Timed out waiting for the log copier to apply the new configuration.')
+        self.monitors_manager.update_config(configuration)
+
     def stop(self):
         log.debug('Shutting down monitors')
         self.monitors_manager.stop()
@@ -55,6 +55,9 @@ class AgentStatus(object):
         # The MonitorManagerStatus object recording the status of the monitor manager (or none if the MonitorManager
         # has not been started).  This contains information about the different ScalyrMonitors being run.
         self.monitor_manager_status = None
+        # The RequestPhaseStatus objects describing how long the requests sent to the Scalyr servers spent in each of
+        # their phases.
+        self.request_phases = []
 
 
 class OverallStats(object):
@@ -103,6 +106,10 @@ class OverallStats(object):
         self.total_requests_failed = 0
         # The total number of bytes sent over the network.
         self.total_request_bytes_sent = 0
+        # The total number of bytes sent over the network for request bodies that were compressed.
+        self.total_compressed_request_bytes_sent = 0
+        # The total size of all request bodies before compression was applied.
+        self.total_uncompressed_request_bytes_sent = 0
         # The total number of bytes received.
         self.total_response_bytes_received = 0
         # The total number of secs spent waiting for a responses (so average latency can be calculated by dividing
@@ -128,6 +135,10 @@ class OverallStats(object):
         result.total_requests_sent = self.total_requests_sent + other.total_requests_sent
         result.total_requests_failed = self.total_requests_failed + other.total_requests_failed
         result.total_request_bytes_sent = self.total_request_bytes_sent + other.total_request_bytes_sent
+        result.total_compressed_request_bytes_sent = (self.total_compressed_request_bytes_sent +
+                                                      other.total_compressed_request_bytes_sent)
+        result.total_uncompressed_request_bytes_sent = (self.total_uncompressed_request_bytes_sent +
+                                                        other.total_uncompressed_request_bytes_sent)
         result.total_response_bytes_received = self.total_response_bytes_received + other.total_response_bytes_received
         result.total_request_latency_secs = self.total_request_latency_secs + other.total_request_latency_secs
         result.total_connections_created = self.total_connections_created + other.total_connections_created
@@ -135,6 +146,21 @@ class OverallStats(object):
         return result
 
 
+class RequestPhaseStatus(object):
+    """The status object containing the distribution of the time spent in one phase of the requests sent to the
+    Scalyr servers, such as connecting or waiting for the response."""
+    def __init__(self):
+        # The name of the phase.
+        self.phase = None
+        # The number of requests that completed the phase.
+        self.count = 0
+        # The average, median, and estimated 99th percentile of the number of seconds spent in the phase.  None if
+        # no requests have completed it.
+        self.average = None
+        self.p50 = None
+        self.p99 = None
+
+
 class ConfigStatus(object):
     """The status pertaining to parsing of the configuration file."""
     def __init__(self):
@@ -152,6 +178,10 @@ class ConfigStatus(object):
         self.last_good_read = None
         # The last time the agent checked to see if the configuration file has changed.
         self.last_check_time = None
+        # The number of seconds it took to read and parse the configuration files the last time they changed.
+        self.last_parse_duration = None
+        # The number of checks that found the configuration files unchanged, so they were not parsed again.
+        self.unchanged_checks = 0
 
 
 class CopyingManagerStatus(object):
@@ -172,8 +202,26 @@ class CopyingManagerStatus(object):
         # The total number of failed copy requests.
         self.total_errors = None
 
+        # The total number of scans for new log files performed.
+        self.total_scans = 0
+        # The total number of seconds spent scanning for new log files.
+        self.total_scan_time = 0.0
+        # The number of seconds the last scan for new log files took.
+        self.last_scan_duration = None
+        # The number of log files whose processors have been closed because they were idle.
+        self.total_idle_log_files = 0
+        # The number of successful requests whose upload latency was measured.
+        self.total_latency_samples = 0
+        # The estimated median and 99th percentile of the number of seconds between when new log bytes were first
+        # observed and when they were successfully uploaded.  Only measured if max_upload_latency is set.
+        self.upload_latency_p50 = None
+        self.upload_latency_p99 = None
+
         # LogMatcherStatus objects for each of the log paths being watched for copying.
         self.log_matchers = []
+        # The MetricQueueStatus for the metric lines sent directly from the monitors, or None if they are only
+        # copied from the metric logs.
+        self.metric_queue_status = None
 
 
 class LogMatcherStatus(object):
@@ -216,6 +264,28 @@ class LogProcessorStatus(object):
         self.total_redactions = 0
 
 
+class MetricQueueStatus(object):
+    """The status object containing information about the metric lines sent directly from the monitors, rather than
+    being copied from their metric logs."""
+    def __init__(self):
+        # The total bytes copied to the Scalyr servers.
+        self.total_bytes_copied = 0
+        # The total number of metric lines copied to the Scalyr servers.
+        self.total_lines_copied = 0
+        # The number of metric lines and bytes waiting in the queue to be sent to the Scalyr servers.
+        self.total_lines_pending = 0
+        self.total_bytes_pending = 0
+        # The total number of metric lines dropped because the queue was full.
+        self.total_lines_dropped = 0
+        # The total bytes that failed due to errors at either the server or client.
+        self.total_bytes_failed = 0
+        # The total bytes and lines that were not sent to the server due to subsampling rules.
+        self.total_bytes_dropped_by_sampling = 0
+        self.total_lines_dropped_by_sampling = 0
+        # The total number of redactions applied to the metric lines copied to the server.
+        self.total_redactions = 0
+
+
 class MonitorManagerStatus(object):
     """The status object containing information about all of the running monitors."""
     def __init__(self):
@@ -276,6 +346,9 @@ def report_status(output, status, current_time):
         print >>output, 'Status:                Bad (could not parse, using last good version)'
     print >>output, 'Last checked:          %s' % scalyr_util.format_time(status.config_status.last_check_time)
     print >>output, 'Last changed observed: %s' % scalyr_util.format_time(status.config_status.last_read_time)
+    if status.config_status.last_parse_duration is not None:
+        print >>output, 'Last parse time:       %.1f ms (%d unchanged checks skipped parsing)' % (
+            status.config_status.last_parse_duration * 1000.0, status.config_status.unchanged_checks)
 
     if status.config_status.last_error is not None:
         print >>output, 'Parsing error:         %s' % str(status.config_status.last_error)
@@ -286,6 +359,15 @@ def report_status(output, status, current_time):
         __report_copying_manager(output, status.copying_manager_status, status.log_path,
                                  status.config_status.last_read_time)
 
+    has_request_phases = False
+    for phase_status in status.request_phases:
+        if phase_status.count > 0:
+            has_request_phases = True
+    if has_request_phases:
+        print >>output, ''
+        print >>output, ''
+        __report_request_phases(output, status.request_phases)
+
     if status.monitor_manager_status is not None:
         print >>output, ''
         print >>output, ''
@@ -315,6 +397,22 @@ def __report_copying_manager(output, manager_status, agent_log_file_path, read_t
     if manager_status.total_errors > 0:
         print >>output, 'Total responses with errors:               %d (see \'%s\' for details)' % (
             manager_status.total_errors, agent_log_file_path)
+    if manager_status.total_scans > 0:
+        print >>output, 'Last scan for new log files:               %.3f secs (%d scans, %.3f secs average)' % (
+            manager_status.last_scan_duration, manager_status.total_scans,
+            manager_status.total_scan_time / manager_status.total_scans)
+    if manager_status.total_idle_log_files > 0:
+        print >>output, 'Idle log files (closed until modified):    %d' % manager_status.total_idle_log_files
+    if manager_status.total_latency_samples > 0:
+        print >>output, 'Upload latency (p50 / p99):                %.3f secs / %.3f secs (%d requests)' % (
+            manager_status.upload_latency_p50, manager_status.upload_latency_p99,
+            manager_status.total_latency_samples)
+    if manager_status.metric_queue_status is not None:
+        queue_status = manager_status.metric_queue_status
+        print >>output, 'Metric lines sent directly from monitors:  %ld bytes (%ld lines), %ld lines pending' % (
+            queue_status.total_bytes_copied, queue_status.total_lines_copied, queue_status.total_lines_pending)
+        if queue_status.total_lines_dropped > 0:
+            print >>output, 'Metric lines dropped (queue was full):     %ld' % queue_status.total_lines_dropped
     print >>output, ''
 
     for matcher_status in manager_status.log_matchers:
@@ -374,6 +472,17 @@ def __report_copying_manager(output, manager_status, agent_log_file_path, read_t
                 output.flush()
 
 
+def __report_request_phases(output, request_phases):
+    print >>output, 'Request timing:'
+    print >>output, '==============='
+    print >>output, ''
+    for phase_status in request_phases:
+        if phase_status.count > 0:
+            print >>output, '%-11s %.1f ms average, %.1f ms p50, %.1f ms p99 (%d requests)' % (
+                phase_status.phase + ':', phase_status.average * 1000, phase_status.p50 * 1000,
+                phase_status.p99 * 1000, phase_status.count)
+
+
 def __report_monitor_manager(output, manager_status, read_time):
     print >>output, 'Monitors:'
     print >>output, '========='
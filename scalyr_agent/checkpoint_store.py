@@ -0,0 +1,320 @@
+# Copyright 2014 Scalyr Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+#
+# Persists the per-file checkpoints used by the CopyingManager to pick up copying where it left off when the agent
+# is restarted.
+#
+# author: Steven Czerwinski <czerwin@scalyr.com>
+
+__author__ = 'czerwin@scalyr.com'
+
+import os
+import time
+
+import scalyr_agent.scalyr_logging as scalyr_logging
+
+from scalyr_agent import json_lib
+
+# The checkpoint files are always written by the agent itself and are therefore strict JSON.  If the standard
+# json library is available (Python 2.6 or greater), we use its C-accelerated parser to read them since it is
+# significantly faster than json_lib for large checkpoint files.
+try:
+    import json as stdlib_json
+except ImportError:
+    stdlib_json = None
+
+log = scalyr_logging.getLogger(__name__)
+
+# The minimum size the journal must reach before we compact it back into the snapshot file.  The journal is also
+# only compacted once it grows larger than the last snapshot, so that the total amount of bytes written per
+# checkpoint update remains proportional to the number of entries that actually changed.
+MIN_COMPACTION_SIZE = 512 * 1024
+
+# The maximum number of seconds we allow to pass without writing anything to disk.  The time recorded with the
+# checkpoints is used to determine if they are too stale to be used when the agent restarts, so we must refresh it
+# periodically even if no checkpoint has changed.
+MAX_TIME_BETWEEN_WRITES = 60.0
+
+
+class CheckpointStore(object):
+    """Persists the checkpoints for all of the log files being copied.
+
+    Rather than rewriting the entire checkpoint state after every request, the state is kept in two files:  a
+    snapshot file ('checkpoints.json', the same format written by earlier versions of the agent) and an append-only
+    journal ('checkpoints.journal').  Each write appends a single line to the journal holding only the checkpoints
+    that have changed since the last write.  Once the journal grows larger than the snapshot, the two are compacted
+    into a new snapshot.
+
+    Each snapshot is tagged with a generation number which is recorded on every journal entry written against it.
+    When reading the state, only journal entries with a matching generation are replayed, which protects us against
+    applying an old journal to a newer snapshot if we are interrupted in the middle of a compaction.
+
+    This abstraction is not thread safe.  It is only meant to be used by the CopyingManager's thread.
+    """
+    def __init__(self, data_path, write_interval=0.0):
+        """Initializes the store.
+
+        @param data_path: The directory where the checkpoint files should be stored.
+        @param write_interval: The minimum number of seconds between writes of the checkpoint state to disk.  If
+            zero, the state is written every time write_if_necessary is invoked.
+
+        @type data_path: str
+        @type write_interval: float
+        """
+        # The path to the snapshot file.
+        self.__snapshot_path = os.path.join(data_path, 'checkpoints.json')
+        # The path to use for the temporary file when writing out a new snapshot.
+        self.__tmp_snapshot_path = os.path.join(data_path, 'checkpoints.json~')
+        # The path to the journal holding the changes written since the last snapshot.
+        self.__journal_path = os.path.join(data_path, 'checkpoints.journal')
+        self.__write_interval = write_interval
+
+        # A dict mapping file path to its most recent checkpoint.  This includes the changes that have not yet been
+        # written to disk.
+        self.__checkpoints = {}
+        # A dict mapping file path to the checkpoint changes that have not yet been written to disk.
+        self.__dirty = {}
+        # A dict whose keys are the file paths whose checkpoints have been removed but not yet written to disk.
+        self.__removed = {}
+
+        # The generation of the current snapshot file.
+        self.__generation = 0
+        # The size of the current snapshot and journal files in bytes.
+        self.__snapshot_size = 0
+        self.__journal_size = 0
+        # The last time the state was written to disk.
+        self.__last_write_time = None
+
+    def read(self):
+        """Reads the checkpoint state from disk, replaying any journal entries on top of the snapshot.
+
+        This also primes the store with the checkpoints that were read, so that future writes only need to record
+        changes to them.
+
+        @return:  The checkpoint state, or None if it could not be read.  The state is a dict containing a 'time'
+            entry with the time it was last written and a 'checkpoints' entry mapping file path to checkpoint.
+        @rtype: dict
+        """
+        if not os.path.isfile(self.__snapshot_path):
+            log.info('The log copying checkpoint file "%s" does not exist, skipping.' % self.__snapshot_path)
+            return None
+
+        # noinspection PyBroadException
+        try:
+            snapshot = self.__parse(self.__read_file(self.__snapshot_path))
+        except Exception:
+            log.exception('Could not read checkpoint file due to error.', error_code='failedCheckpointRead')
+            return None
+
+        self.__snapshot_size = os.path.getsize(self.__snapshot_path)
+        self.__generation = int(snapshot.get('generation', 0))
+        last_write_time = snapshot['time']
+
+        checkpoints = {}
+        for path, checkpoint in snapshot['checkpoints'].iteritems():
+            checkpoints[path] = checkpoint
+
+        if os.path.isfile(self.__journal_path):
+            # noinspection PyBroadException
+            try:
+                contents = self.__read_file(self.__journal_path)
+                self.__journal_size = len(contents)
+                for line in contents.splitlines():
+                    # noinspection PyBroadException
+                    try:
+                        entry = self.__parse(line)
+                    except Exception:
+                        # The last line may have been only partially written if the agent was killed in the middle
+                        # of a write.  Just ignore it and the remainder of the journal.
+                        log.warn('Ignoring truncated entry in checkpoint journal "%s"', self.__journal_path,
+                                 error_code='truncatedCheckpointJournal')
+                        break
+
+                    if int(entry.get('generation', 0)) != self.__generation:
+                        continue
+
+                    last_write_time = entry['time']
+                    for path, checkpoint in entry['checkpoints'].iteritems():
+                        checkpoints[path] = checkpoint
+                    for path in entry['removed']:
+                        if path in checkpoints:
+                            del checkpoints[path]
+            except Exception:
+                log.exception('Could not read checkpoint journal due to error.', error_code='failedCheckpointRead')
+
+        self.__checkpoints = checkpoints.copy()
+        self.__dirty = {}
+        self.__removed = {}
+
+        return {
+            'time': last_write_time,
+            'checkpoints': checkpoints,
+        }
+
+    def update(self, path, checkpoint):
+        """Records a new checkpoint for the specified file path.  It will be written on the next write.
+
+        @param path: The file path.
+        @param checkpoint: The checkpoint, as returned by LogFileProcessor.get_checkpoint.
+
+        @type path: str
+        @type checkpoint: dict
+        """
+        self.__checkpoints[path] = checkpoint
+        self.__dirty[path] = checkpoint
+        if path in self.__removed:
+            del self.__removed[path]
+
+    def remove(self, path):
+        """Removes the checkpoint for the specified file path.  The removal will be written on the next write.
+
+        @param path: The file path.
+        @type path: str
+        """
+        if path in self.__checkpoints:
+            del self.__checkpoints[path]
+            self.__removed[path] = True
+            if path in self.__dirty:
+                del self.__dirty[path]
+
+    def retain_only(self, paths):
+        """Removes the checkpoints for all file paths not contained in paths.
+
+        @param paths: The file paths whose checkpoints should be kept.
+        @type paths: dict
+        """
+        for path in self.__checkpoints.keys():
+            if path not in paths:
+                self.remove(path)
+
+    def write_if_necessary(self, current_time=None, force=False):
+        """Writes any changed checkpoints to disk if the write interval has passed since the last write.
+
+        @param current_time: If not None, the time to use as the current time.
+        @param force: If True, write the state even if the write interval has not passed.
+
+        @type current_time: float
+        @type force: bool
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        # Note, if the clock has moved backwards since the last write, we always write.
+        if self.__last_write_time is not None and current_time >= self.__last_write_time:
+            time_since_write = current_time - self.__last_write_time
+            if not force and time_since_write < self.__write_interval:
+                return
+            if len(self.__dirty) == 0 and len(self.__removed) == 0 and time_since_write < MAX_TIME_BETWEEN_WRITES:
+                return
+
+        if self.__last_write_time is None or self.__journal_size >= max(MIN_COMPACTION_SIZE, self.__snapshot_size):
+            self.__write_snapshot(current_time)
+        else:
+            self.__append_to_journal(current_time)
+
+    def __append_to_journal(self, current_time):
+        """Appends the changed checkpoints to the journal.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        entry = json_lib.serialize({
+            'time': current_time,
+            'generation': self.__generation,
+            'checkpoints': self.__dirty,
+            'removed': self.__removed.keys(),
+        }) + '\n'
+
+        fp = None
+        try:
+            fp = open(self.__journal_path, 'a')
+            fp.write(entry)
+            fp.close()
+            fp = None
+            self.__journal_size += len(entry)
+            self.__dirty = {}
+            self.__removed = {}
+            self.__last_write_time = current_time
+        except (IOError, OSError):
+            if fp is not None:
+                fp.close()
+            log.exception('Could not write checkpoint journal due to error', error_code='failedCheckpointWrite')
+
+    def __write_snapshot(self, current_time):
+        """Writes all of the checkpoints to a new snapshot and resets the journal.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        generation = self.__generation + 1
+        contents = json_lib.serialize({
+            'time': current_time,
+            'generation': generation,
+            'checkpoints': self.__checkpoints,
+        })
+
+        # We write to a temporary file and then rename it to the real file name to make the write more atomic.
+        # We have had problems in the past with corrupted checkpoint files due to failures during the write.
+        fp = None
+        try:
+            fp = open(self.__tmp_snapshot_path, 'w')
+            fp.write(contents)
+            fp.close()
+            fp = None
+            os.rename(self.__tmp_snapshot_path, self.__snapshot_path)
+
+            # Now that the snapshot has been written, any entries in the old journal are obsolete.  Even if we fail
+            # to truncate it, they will be ignored when read since they do not match the new generation.
+            self.__generation = generation
+            self.__snapshot_size = len(contents)
+            self.__dirty = {}
+            self.__removed = {}
+            self.__last_write_time = current_time
+
+            fp = open(self.__journal_path, 'w')
+            fp.close()
+            fp = None
+            self.__journal_size = 0
+        except (IOError, OSError):
+            if fp is not None:
+                fp.close()
+            log.exception('Could not write checkpoint file due to error', error_code='failedCheckpointWrite')
+
+    def __read_file(self, file_path):
+        """Returns the entire contents of the specified file.
+
+        @param file_path: The path of the file to read.
+        @type file_path: str
+
+        @rtype: str
+        """
+        fp = open(file_path, 'r')
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def __parse(self, contents):
+        """Parses the JSON contents of a checkpoint file.
+
+        @param contents: The JSON to parse.
+        @type contents: str
+
+        @return: The parsed object.
+        @rtype: dict
+        """
+        if stdlib_json is not None:
+            return stdlib_json.loads(contents)
+        return json_lib.parse(contents)
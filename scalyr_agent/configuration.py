@@ -57,8 +57,18 @@ class Configuration(object):
         # The JsonObject holding the contents of the configuration file, along with any default
         # values filled in.
         self.__config = None
+        # The ConfigurationValues holding the typed values for the options in the main configuration file.  It is
+        # built once the file has been verified.
+        self.__values = None
         # The number of seconds past epoch when the file was read.
         self.__read_time = None
+        # The number of seconds it took to read and parse the configuration files.
+        self.__parse_duration = None
+        # The full path of the configuration directory, once it is known from the main configuration file.
+        self.__config_directory_path = None
+        # The fingerprint of the configuration files read by parse, taken just before each was read.  See
+        # compute_file_set_fingerprint.
+        self.__file_set_fingerprint = None
         # The exception, if any, that was raised when the state was read.  This will be a BadConfiguration exception.
         self.__last_error = None
         # The list of log objects created by the log_factory passed into the parse method, one for each
@@ -91,10 +101,14 @@ class Configuration(object):
 
     def parse(self):
         self.__read_time = time.time()
+        # We fingerprint each file before reading it.  That way, if the file is changed after we take its
+        # fingerprint, the next check will see a different fingerprint and the files will be parsed again.
+        self.__file_set_fingerprint = {}
 
         try:
             try:
                 # First read the file.  This makes sure it exists and can be parsed.
+                self.__file_set_fingerprint[self.__file_path] = self.__fingerprint_file(self.__file_path)
                 self.__config = scalyr_util.read_file_as_json(self.__file_path)
 
                 # What implicit entries do we need to add?  metric monitor, agent.log, and then logs from all monitors.
@@ -106,11 +120,17 @@ class Configuration(object):
             self.__perform_substitutions()
 
             self.__verify_main_config_and_apply_defaults(self.__config, self.__file_path)
+            # None of the options held by the typed view can be changed by the configuration fragments, so we
+            # can build it now.
+            self.__config_directory_path = self.__resolve_absolute_path(
+                self.__config.get_string('config_directory'), self.__get_parent_directory(self.__file_path))
+            self.__values = ConfigurationValues(self.__config, self.__config_directory_path)
             self.__verify_logs_and_monitors_configs_and_apply_defaults(self.__config, self.__file_path)
 
             # Now, look for any additional configuration in the config fragment directory.
             for fp in self.__list_files(self.config_directory):
                 self.__additional_paths.append(fp)
+                self.__file_set_fingerprint[fp] = self.__fingerprint_file(fp)
                 content = scalyr_util.read_file_as_json(fp)
                 for k in content.keys():
                     if k not in ('logs', 'monitors', 'server_attributes'):
@@ -202,7 +222,9 @@ class Configuration(object):
                 all_paths[entry.log_path] = True
 
             # Now add in a logs entry for each monitor's log file if there is not already
-            # an entry for it.
+            # an entry for it.  When the metric queue is in use, the monitors' lines are sent directly from the queue
+            # and their metric logs are only written as an audit copy, so they must not be copied as well.
+            copy_monitor_logs = self.metric_queue_size == 0
             for entry in self.__monitors:
                 log_config = entry.log_config
                 if type(log_config) is dict:
@@ -218,7 +240,7 @@ class Configuration(object):
                 # Update the monitor to have the complete log config entry.  This also guarantees that the path
                 # is absolute.
                 entry.log_config = log_config
-                if not path in all_paths:
+                if copy_monitor_logs and not path in all_paths:
                     if 'parser' in log_config:
                         log_config['attributes']['parser'] = log_config['parser']
                     if self.__log_factory is not None:
@@ -227,8 +249,45 @@ class Configuration(object):
 
         except BadConfiguration, e:
             self.__last_error = e
+            self.__parse_duration = time.time() - self.__read_time
             raise e
 
+        self.__parse_duration = time.time() - self.__read_time
+
+    def compute_file_set_fingerprint(self):
+        """Returns a fingerprint of the current contents of the files that parse read, or would read now.
+
+        This covers the main configuration file and the files in the configuration directory, including any that
+        have been added or removed since the files were parsed.  If it is equal to file_set_fingerprint, none of the
+        files have changed, so parsing them again would produce the same configuration.  This is much cheaper than
+        parsing since each file only needs to be hashed.
+
+        @return: The fingerprint.  Its contents should be treated as opaque.
+        @rtype: dict
+        """
+        result = {self.__file_path: self.__fingerprint_file(self.__file_path)}
+        # If parsing failed before the configuration directory was known, only the main configuration file can
+        # affect the result of parsing again.
+        if self.__config_directory_path is not None:
+            for file_path in self.__list_files(self.__config_directory_path):
+                result[file_path] = self.__fingerprint_file(file_path)
+        return result
+
+    @property
+    def file_set_fingerprint(self):
+        """Returns the fingerprint of the configuration files taken when they were parsed.
+
+        This is available even if parsing failed.  See compute_file_set_fingerprint.
+
+        @rtype: dict
+        """
+        return self.__file_set_fingerprint
+
+    @property
+    def parse_duration(self):
+        """Returns the number of seconds it took to read and parse the configuration files."""
+        return self.__parse_duration
+
     @property
     def read_time(self):
         """Returns the time this configuration file was read."""
@@ -262,27 +321,37 @@ class Configuration(object):
     @property
     def agent_data_path(self):
         """Returns the configuration value for 'agent_data_path'."""
-        return self.__get_config().get_string('agent_data_path')
+        return self.__get_values().agent_data_path
 
     @property
     def agent_log_path(self):
         """Returns the configuration value for 'agent_log_path'."""
-        return self.__get_config().get_string('agent_log_path')
+        return self.__get_values().agent_log_path
 
     @property
     def additional_monitor_module_paths(self):
         """Returns the configuration value for 'additional_monitor_module_paths'."""
-        return self.__get_config().get_string('additional_monitor_module_paths')
+        return self.__get_values().additional_monitor_module_paths
 
     @property
     def api_key(self):
         """Returns the configuration value for 'api_key'."""
-        return self.__get_config().get_string('api_key')
+        return self.__get_values().api_key
 
     @property
     def scalyr_server(self):
         """Returns the configuration value for 'scalyr_server'."""
-        return self.__get_config().get_string('scalyr_server')
+        return self.__get_values().scalyr_server
+
+    @property
+    def additional_scalyr_servers(self):
+        """Returns the configuration value for 'additional_scalyr_servers'."""
+        return self.__get_config().get_json_array('additional_scalyr_servers')
+
+    @property
+    def load_balance_servers(self):
+        """Returns the configuration value for 'load_balance_servers'."""
+        return self.__get_values().load_balance_servers
 
     @property
     def server_attributes(self):
@@ -292,17 +361,17 @@ class Configuration(object):
     @property
     def implicit_agent_log_collection(self):
         """Returns the configuration value for 'implicit_agent_log_collection'."""
-        return self.__get_config().get_bool('implicit_agent_log_collection')
+        return self.__get_values().implicit_agent_log_collection
 
     @property
     def implicit_metric_monitor(self):
         """Returns the configuration value for 'implicit_metric_monitor'."""
-        return self.__get_config().get_bool('implicit_metric_monitor')
+        return self.__get_values().implicit_metric_monitor
 
     @property
     def implicit_agent_process_metrics_monitor(self):
         """Returns the configuration value for 'implicit_agent_process_metrics_monitor'."""
-        return self.__get_config().get_bool('implicit_agent_process_metrics_monitor')
+        return self.__get_values().implicit_agent_process_metrics_monitor
 
     @property
     def use_unsafe_debugging(self):
@@ -310,91 +379,127 @@ class Configuration(object):
 
         Note, this should be used with extreme care.  It allows arbitrary commands to be executed by any local
         user on the system as the user running the agent."""
-        return self.__get_config().get_bool('use_unsafe_debugging')
+        return self.__get_values().use_unsafe_debugging
 
     @property
     def config_directory(self):
         """Returns the configuration value for 'config_directory', resolved to full path if necessary."""
-        config_directory = self.__get_config().get_string('config_directory')
-
-        # The configuration directory's path is relative to the the directory this configuration
-        # file is stored in.
-        return self.__resolve_absolute_path(config_directory, self.__get_parent_directory(self.__file_path))
+        return self.__get_values().config_directory
 
     @property
     def max_allowed_request_size(self):
         """Returns the configuration value for 'max_allowed_request_size'."""
-        return self.__get_config().get_int('max_allowed_request_size')
+        return self.__get_values().max_allowed_request_size
 
     @property
     def min_allowed_request_size(self):
         """Returns the configuration value for 'min_allowed_request_size'."""
-        return self.__get_config().get_int('min_allowed_request_size')
+        return self.__get_values().min_allowed_request_size
 
     @property
     def min_request_spacing_interval(self):
         """Returns the configuration value for 'min_request_spacing_interval'."""
-        return self.__get_config().get_float('min_request_spacing_interval')
+        return self.__get_values().min_request_spacing_interval
 
     @property
     def max_request_spacing_interval(self):
         """Returns the configuration value for 'max_request_spacing_interval'."""
-        return self.__get_config().get_float('max_request_spacing_interval')
+        return self.__get_values().max_request_spacing_interval
 
     @property
     def max_error_request_spacing_interval(self):
         """Returns the configuration value for 'max_error_request_spacing_interval'."""
-        return self.__get_config().get_float('max_error_request_spacing_interval')
+        return self.__get_values().max_error_request_spacing_interval
 
     @property
     def low_water_bytes_sent(self):
         """Returns the configuration value for 'low_water_bytes_sent'."""
-        return self.__get_config().get_int('low_water_bytes_sent')
+        return self.__get_values().low_water_bytes_sent
 
     @property
     def low_water_request_spacing_adjustment(self):
         """Returns the configuration value for 'low_water_request_spacing_adjustment'."""
-        return self.__get_config().get_float('low_water_request_spacing_adjustment')
+        return self.__get_values().low_water_request_spacing_adjustment
 
     @property
     def high_water_bytes_sent(self):
         """Returns the configuration value for 'high_water_bytes_sent'."""
-        return self.__get_config().get_int('high_water_bytes_sent')
+        return self.__get_values().high_water_bytes_sent
 
     @property
     def high_water_request_spacing_adjustment(self):
         """Returns the configuration value for 'high_water_request_spacing_adjustment'."""
-        return self.__get_config().get_float('high_water_request_spacing_adjustment')
+        return self.__get_values().high_water_request_spacing_adjustment
 
     @property
     def failure_request_spacing_adjustment(self):
         """Returns the configuration value for 'failure_request_spacing_adjustment'."""
-        return self.__get_config().get_float('failure_request_spacing_adjustment')
+        return self.__get_values().failure_request_spacing_adjustment
 
     @property
     def request_too_large_adjustment(self):
         """Returns the configuration value for 'request_too_large_adjustment'."""
-        return self.__get_config().get_float('request_too_large_adjustment')
+        return self.__get_values().request_too_large_adjustment
 
     @property
     def request_deadline(self):
         """Returns the configuration value for 'request_deadline'."""
-        return self.__get_config().get_float('request_deadline')
+        return self.__get_values().request_deadline
+
+    @property
+    def checkpoint_write_interval(self):
+        """Returns the configuration value for 'checkpoint_write_interval'."""
+        return self.__get_values().checkpoint_write_interval
+
+    @property
+    def idle_log_eviction_time(self):
+        """Returns the configuration value for 'idle_log_eviction_time'."""
+        return self.__get_values().idle_log_eviction_time
+
+    @property
+    def max_upload_latency(self):
+        """Returns the configuration value for 'max_upload_latency'."""
+        return self.__get_values().max_upload_latency
+
+    @property
+    def metric_queue_size(self):
+        """Returns the configuration value for 'metric_queue_size'."""
+        return self.__get_values().metric_queue_size
+
+    @property
+    def write_metric_logs(self):
+        """Returns the configuration value for 'write_metric_logs'."""
+        return self.__get_values().write_metric_logs
+
+    @property
+    def compression_type(self):
+        """Returns the configuration value for 'compression_type'."""
+        return self.__get_values().compression_type
+
+    @property
+    def compression_level(self):
+        """Returns the configuration value for 'compression_level'."""
+        return self.__get_values().compression_level
+
+    @property
+    def limit_compressed_request_size(self):
+        """Returns the configuration value for 'limit_compressed_request_size'."""
+        return self.__get_values().limit_compressed_request_size
 
     @property
     def debug_level(self):
         """Returns the configuration value for 'debug_level'."""
-        return self.__get_config().get_int('debug_level')
+        return self.__get_values().debug_level
 
     @property
     def ca_cert_path(self):
         """Returns the configuration value for 'ca_cert_path'."""
-        return self.__get_config().get_string('ca_cert_path')
+        return self.__get_values().ca_cert_path
 
     @property
     def verify_server_certificate(self):
         """Returns the configuration value for 'verify_server_certificate'."""
-        return self.__get_config().get_bool('verify_server_certificate')
+        return self.__get_values().verify_server_certificate
 
     def equivalent(self, other, exclude_debug_level=False):
         """Returns true if other contains the same configuration information as this object.
@@ -424,6 +529,28 @@ class Configuration(object):
             if original_debug_level is not None:
                 other.__config.put('debug_level', original_debug_level)
 
+    def get_changed_options(self, other):
+        """Returns the names of the top level options whose values differ between this configuration and other.
+
+        Like equivalent, this compares the final results of the configuration, after defaults have been applied and
+        the configuration fragments have been merged in.  This can be used to determine which parts of the running
+        agent are affected by a new configuration.  Both configurations must have been successfully parsed.
+
+        @param other: The configuration to compare against.
+        @type other: Configuration
+
+        @return: The names of the options that were added, removed, or changed.
+        @rtype: list of str
+        """
+        result = []
+        for option in self.__config.keys():
+            if option not in other.__config or not self.__config[option] == other.__config[option]:
+                result.append(option)
+        for option in other.__config.keys():
+            if option not in self.__config:
+                result.append(option)
+        return result
+
     @staticmethod
     def default_ca_cert_path():
         """Returns the default configuration file path for the agent."""
@@ -467,6 +594,28 @@ class Configuration(object):
 
         return os.path.join(working_directory, file_path)
 
+    def __fingerprint_file(self, file_path):
+        """Returns the fingerprint for a single configuration file.
+
+        @param file_path: The path of the file.
+        @type file_path: str
+
+        @return: A tuple holding the file's size, modification time, and the SHA1 hash of its contents, or None if
+            the file cannot be read.
+        @rtype: tuple
+        """
+        fp = None
+        try:
+            try:
+                stat_info = os.stat(file_path)
+                fp = open(file_path, 'r')
+                return stat_info.st_size, stat_info.st_mtime, scalyr_util.sha1(fp.read()).hexdigest()
+            except (IOError, OSError):
+                return None
+        finally:
+            if fp is not None:
+                fp.close()
+
     def __list_files(self, directory_path):
         """Returns a list of the files ending in .json for the specified directory.
 
@@ -532,6 +681,8 @@ class Configuration(object):
                                              description)
         self.__verify_or_set_optional_string(config, 'additional_monitor_module_paths', '', description)
         self.__verify_or_set_optional_string(config, 'scalyr_server', 'https://agent.scalyr.com', description)
+        self.__verify_or_set_optional_string_array(config, 'additional_scalyr_servers', description)
+        self.__verify_or_set_optional_bool(config, 'load_balance_servers', False, description)
         self.__verify_or_set_optional_string(config, 'config_directory', 'agent.d', description)
         self.__verify_or_set_optional_bool(config, 'implicit_agent_log_collection', True, description)
         self.__verify_or_set_optional_bool(config, 'implicit_metric_monitor', True, description)
@@ -558,6 +709,24 @@ class Configuration(object):
         if debug_level < 0 or debug_level > 5:
             raise BadConfiguration('The debug level must be between 0 and 5 inclusive', 'debug_level', 'badDebugLevel')
         self.__verify_or_set_optional_float(config, 'request_deadline', 60.0, description)
+        self.__verify_or_set_optional_float(config, 'checkpoint_write_interval', 0.0, description)
+        self.__verify_or_set_optional_float(config, 'idle_log_eviction_time', 0.0, description)
+        self.__verify_or_set_optional_float(config, 'max_upload_latency', 0.0, description)
+        self.__verify_or_set_optional_int(config, 'metric_queue_size', 0, description)
+        if config.get_int('metric_queue_size') < 0:
+            raise BadConfiguration('The metric queue size must not be negative', 'metric_queue_size',
+                                   'badMetricQueueSize')
+        self.__verify_or_set_optional_bool(config, 'write_metric_logs', True, description)
+        self.__verify_or_set_optional_string(config, 'compression_type', 'none', description)
+        if config.get_string('compression_type') not in ('deflate', 'gzip', 'none'):
+            raise BadConfiguration('The compression type must be one of "deflate", "gzip", or "none"',
+                                   'compression_type', 'badCompressionType')
+        self.__verify_or_set_optional_int(config, 'compression_level', 6, description)
+        compression_level = config.get_int('compression_level')
+        if compression_level < 1 or compression_level > 9:
+            raise BadConfiguration('The compression level must be between 1 and 9 inclusive', 'compression_level',
+                                   'badCompressionLevel')
+        self.__verify_or_set_optional_bool(config, 'limit_compressed_request_size', False, description)
 
         self.__verify_or_set_optional_string(config, 'ca_cert_path', Configuration.default_ca_cert_path(),
                                              description)
@@ -850,6 +1019,35 @@ class Configuration(object):
             raise BadConfiguration('The value for the required field "%s" is not an array.  '
                                    'Error is in %s' % (field, config_description), field, 'notJsonArray')
 
+    def __verify_or_set_optional_string_array(self, config_object, field, config_description):
+        """Verifies that the specified field in config_object is an array of strings if present, otherwise sets
+        to empty array.
+
+        Raises an exception if the existing field is not a json array or if any of its elements are not strings.
+
+        @param config_object: The JsonObject containing the configuration information.
+        @param field: The name of the field to check in config_object.
+        @param config_description: A description of where the configuration object was sourced from to be used in the
+            error reporting to the user.
+        """
+        try:
+            json_array = config_object.get_json_array(field, none_if_missing=True)
+
+            if json_array is None:
+                config_object.put(field, JsonArray())
+                return
+
+            index = 0
+            for x in json_array:
+                if not isinstance(x, basestring):
+                    raise BadConfiguration('The element at index=%i is not a string as required in the array '
+                                           'field "%s".  Error is in %s' % (index, field, config_description),
+                                           field, 'notString')
+                index += 1
+        except JsonConversionException:
+            raise BadConfiguration('The value for the required field "%s" is not an array.  '
+                                   'Error is in %s' % (field, config_description), field, 'notJsonArray')
+
     def __verify_required_regexp(self, config_object, field, config_description):
         """Verifies that config_object has the specified field and it can be parsed as a regular expression, otherwise
         raises an exception.
@@ -905,6 +1103,11 @@ class Configuration(object):
             raise BadConfiguration(self.__last_error, 'fake', 'fake')
         return self.__config
 
+    def __get_values(self):
+        if self.__last_error is not None:
+            raise BadConfiguration(self.__last_error, 'fake', 'fake')
+        return self.__values
+
     def __import_shell_variables(self):
         """Imports the shell variables requested in 'import_vars' and adds them to self.__substitutions.
         """
@@ -986,6 +1189,66 @@ class Configuration(object):
         perform_object_substitution(self.__config)
 
 
+class ConfigurationValues(object):
+    """The values for the options in the main configuration file, already converted to their types.
+
+    Reading an option from the underlying JsonObject requires a lookup and type conversion on every access, and some
+    options are read on every iteration of the copying loop.  This view is built once the configuration has been
+    verified and its defaults applied, so that each value is just an attribute.  It only holds the options with str,
+    int, float, or bool values.  Everything else is still read from the JsonObject.
+    """
+    # The option name and type for each value held by this view.  The type is used to select the JsonObject method
+    # used to read the value.
+    OPTIONS = [
+        ('agent_data_path', 'string'),
+        ('agent_log_path', 'string'),
+        ('additional_monitor_module_paths', 'string'),
+        ('api_key', 'string'),
+        ('scalyr_server', 'string'),
+        ('load_balance_servers', 'bool'),
+        ('implicit_agent_log_collection', 'bool'),
+        ('implicit_metric_monitor', 'bool'),
+        ('implicit_agent_process_metrics_monitor', 'bool'),
+        ('use_unsafe_debugging', 'bool'),
+        ('max_allowed_request_size', 'int'),
+        ('min_allowed_request_size', 'int'),
+        ('min_request_spacing_interval', 'float'),
+        ('max_request_spacing_interval', 'float'),
+        ('max_error_request_spacing_interval', 'float'),
+        ('low_water_bytes_sent', 'int'),
+        ('low_water_request_spacing_adjustment', 'float'),
+        ('high_water_bytes_sent', 'int'),
+        ('high_water_request_spacing_adjustment', 'float'),
+        ('failure_request_spacing_adjustment', 'float'),
+        ('request_too_large_adjustment', 'float'),
+        ('request_deadline', 'float'),
+        ('checkpoint_write_interval', 'float'),
+        ('idle_log_eviction_time', 'float'),
+        ('max_upload_latency', 'float'),
+        ('metric_queue_size', 'int'),
+        ('write_metric_logs', 'bool'),
+        ('compression_type', 'string'),
+        ('compression_level', 'int'),
+        ('limit_compressed_request_size', 'bool'),
+        ('debug_level', 'int'),
+        ('ca_cert_path', 'string'),
+        ('verify_server_certificate', 'bool'),
+    ]
+
+    def __init__(self, config, config_directory):
+        """Initializes the values from a verified configuration.
+
+        @param config: The main configuration, with all defaults applied.
+        @param config_directory: The value to use for 'config_directory', resolved to a full path.
+
+        @type config: JsonObject
+        @type config_directory: str
+        """
+        for (option, option_type) in ConfigurationValues.OPTIONS:
+            setattr(self, option, getattr(config, 'get_' + option_type)(option))
+        self.config_directory = config_directory
+
+
 class BadConfiguration(Exception):
     """Raised when bad values are supplied in the configuration."""
     def __init__(self, message, field, error_code):
@@ -22,17 +22,36 @@ import os
 import threading
 import time
 import sys
+import Queue
 
 import scalyr_agent.scalyr_logging as scalyr_logging
 import scalyr_agent.util as scalyr_util
 
 from scalyr_agent import json_lib
-from scalyr_agent.util import StoppableThread
-from scalyr_agent.log_processing import LogMatcher, LogFileProcessor
+from scalyr_agent.util import StoppableThread, Histogram
+from scalyr_agent.log_processing import LogMatcher, LogFileProcessor, MetricQueueProcessor
+from scalyr_agent.checkpoint_store import CheckpointStore
 from scalyr_agent.agent_status import CopyingManagerStatus
 
 log = scalyr_logging.getLogger(__name__)
 
+# When a maximum upload latency is configured, the log files are checked for new bytes this many times per latency
+# period, but never more frequently than MIN_LATENCY_POLL_INTERVAL seconds.
+LATENCY_POLLS_PER_PERIOD = 4
+MIN_LATENCY_POLL_INTERVAL = 0.05
+# Checking for new bytes stats every open log file, so with many files the checks are spaced out further to stat at
+# most this many files per second.
+MAX_LATENCY_POLL_FILES_PER_SECOND = 1000
+
+# The maximum number of seconds to wait for an in flight request to complete before going back to look for new log
+# files and writing checkpoints.
+SEND_POLL_INTERVAL = 0.1
+
+# The fraction of each request that the metric lines from the monitors may use before the log files are copied.  Any
+# space left over by the log files is then also used for them.  This keeps a backlog of metric lines, such as after
+# a server outage, from stopping the copying of the log files.
+MAX_METRIC_QUEUE_REQUEST_SHARE = 0.5
+
 
 class CopyingParameters(object):
     """Tracks the copying parameters that should be used for sending requests to Scalyr and adjusts them over time
@@ -167,12 +186,119 @@ class AddEventsTask(object):
         self.completion_callback = completion_callback
 
 
+class NewLogScanner(StoppableThread):
+    """Periodically scans the file system for new files that match the configured logs.
+
+    Expanding the globs and checking the permissions of every matched file can take a significant amount of time
+    when there are many files, so it is done on its own thread rather than on the log copying thread.  The paths
+    of the newly matched files are handed to the CopyingManager through a queue.
+    """
+    def __init__(self, log_matchers, get_paths_being_processed, scan_interval):
+        """Initializes the scanner.
+
+        @param log_matchers: The LogMatchers whose log paths should be scanned for.
+        @param get_paths_being_processed: A function that returns the dict whose keys are the file paths already
+            being processed.  Those paths will not be returned as new matches.  The dict is only used for membership
+            tests, so it is safe for the copying thread to modify it while the scan is in progress.
+        @param scan_interval: The number of seconds to wait between scans.
+
+        @type log_matchers: list of LogMatcher
+        @type get_paths_being_processed: function
+        @type scan_interval: float
+        """
+        StoppableThread.__init__(self, name='new log scanner thread')
+        self.__log_matchers = log_matchers
+        self.__get_paths_being_processed = get_paths_being_processed
+        self.__scan_interval = scan_interval
+
+        # Holds (LogMatcher, file path) tuples for the newly matched files that have not been consumed yet.
+        self.__new_paths = Queue.Queue()
+
+        # A lock that protects the statistics below, which are read by other threads.
+        self.__lock = threading.Lock()
+        # The total number of scans performed.
+        self.__total_scans = 0
+        # The total number of seconds spent scanning.
+        self.__total_scan_time = 0.0
+        # The number of seconds the last scan took.
+        self.__last_scan_duration = None
+
+    def run(self):
+        """Scans for new log files until the thread is stopped."""
+        while self._run_state.is_running():
+            self._run_state.sleep_but_awaken_if_stopped(self.__scan_interval)
+            if not self._run_state.is_running():
+                break
+            # noinspection PyBroadException
+            try:
+                self.scan()
+            except Exception:
+                log.exception('Failed while scanning for new log files')
+
+    def scan(self):
+        """Performs a single scan for new log files, adding any matches to the queue returned by get_new_paths."""
+        start_time = time.time()
+        paths_being_processed = self.__get_paths_being_processed()
+        for matcher in self.__log_matchers:
+            for file_path in matcher.find_new_paths(paths_being_processed):
+                self.__new_paths.put((matcher, file_path))
+        scan_duration = time.time() - start_time
+
+        self.__lock.acquire()
+        try:
+            self.__total_scans += 1
+            self.__total_scan_time += scan_duration
+            self.__last_scan_duration = scan_duration
+        finally:
+            self.__lock.release()
+
+    def set_log_matchers(self, log_matchers):
+        """Replaces the LogMatchers whose log paths should be scanned for, starting with the next scan.
+
+        Matches found by a scan already in progress may still refer to the previous LogMatchers, so callers must
+        discard any matches returned by get_new_paths whose LogMatcher is no longer in use.
+
+        @param log_matchers: The LogMatchers whose log paths should be scanned for.
+        @type log_matchers: list of LogMatcher
+        """
+        self.__log_matchers = log_matchers
+
+    def get_new_paths(self):
+        """Returns the new matches found since the last invocation.
+
+        Note, the same path may be returned more than once if it was matched by multiple scans before it was
+        consumed, so callers should check it is not already being processed.
+
+        @return: A list of (LogMatcher, file path) tuples.
+        @rtype: list of (LogMatcher, str)
+        """
+        result = []
+        while True:
+            try:
+                result.append(self.__new_paths.get_nowait())
+            except Queue.Empty:
+                return result
+
+    def get_scan_stats(self):
+        """Returns the statistics about the scans performed.
+
+        @return: A tuple containing the total number of scans, the total number of seconds spent scanning, and
+            the number of seconds the last scan took (or None if no scans have been performed).
+        @rtype: (int, float, float)
+        """
+        self.__lock.acquire()
+        try:
+            return self.__total_scans, self.__total_scan_time, self.__last_scan_duration
+        finally:
+            self.__lock.release()
+
+
 class CopyingManager(StoppableThread):
     """Manages the process of copying all configured log files to the Scalyr server.
 
     This is run as its own thread.
     """
-    def __init__(self, scalyr_client, configuration, logs_initial_positions):
+    def __init__(self, scalyr_client, configuration, logs_initial_positions, metric_queue=None):
         """Initializes the manager.
 
         @param scalyr_client: The client to use to send requests to Scalyr.
@@ -180,10 +306,13 @@ class CopyingManager(StoppableThread):
         @param logs_initial_positions: A dict mapping file paths to the offset with the file to begin copying
             if none can be found from the checkpoint files.  This can be used to override the default behavior of
             just reading from the current end of the file if there is no checkpoint for the file
+        @param metric_queue: If not None, the queue holding the metric lines emitted by the monitors.  They are sent
+            along with the lines from the log files.
 
         @type scalyr_client: scalyr_client.ScalyrClientSession
         @type configuration: configuration.Configuration
         @type logs_initial_positions: dict
+        @type metric_queue: scalyr_logging.MetricEventQueue
         """
         StoppableThread.__init__(self, name='log copier thread')
         self.__config = configuration
@@ -192,22 +321,66 @@ class CopyingManager(StoppableThread):
 
         # The list of LogFileProcessors that are processing the lines from matched log files.
         self.__log_processors = []
-        # A dict from file path to the LogFileProcessor that is processing it.
+        # The processor for the metric lines emitted by the monitors, if they are sent directly rather than being
+        # copied from the metric logs.
+        if metric_queue is not None:
+            self.__metric_queue_processor = MetricQueueProcessor(metric_queue)
+        else:
+            self.__metric_queue_processor = None
+        # A dict from file path to the LogMatcher that matched it, for all files being processed.  This includes the
+        # files whose processors have been evicted for being idle.
         self.__log_paths_being_processed = {}
+        # A dict from file path to an (LogMatcher, checkpoint, file signature) tuple for each file whose processor
+        # was closed because it was idle.  The file signature is used to cheaply detect when the file has changed so
+        # that the processor can be recreated from the checkpoint.
+        self.__idle_log_files = {}
+        # The number of seconds a file must go without new bytes before its processor is evicted.  If zero,
+        # processors are never evicted.
+        self.__idle_log_eviction_time = configuration.idle_log_eviction_time
         # A lock that protects the status variables and the __log_matchers variable, the only variables that
         # are access in generate_status() which needs to be thread safe.
         self.__lock = threading.Lock()
 
         # The current pending AddEventsTask.  We will retry the contained AddEventsRequest serveral times.
         self.__pending_add_events_task = None
+        # The PendingRequest for the pending task's request, if it is currently being sent.
+        self.__pending_send = None
 
         # The next LogFileProcessor that should have log lines read from it for transmission.
         self.__current_processor = 0
 
+        # The maximum number of seconds new bytes should wait before being sent.  If zero, requests are instead
+        # spaced out according to the CopyingParameters.
+        self.__max_upload_latency = configuration.max_upload_latency
+        # The shortest number of seconds to wait between checks for new bytes when __max_upload_latency is set.  See
+        # __get_latency_poll_interval.
+        self.__latency_poll_interval = max(MIN_LATENCY_POLL_INTERVAL,
+                                           self.__max_upload_latency / LATENCY_POLLS_PER_PERIOD)
+        # The time of the last check for new bytes made to decide if an upload is due, or None if the bytes have been
+        # read since then, along with the number of bytes that were pending.  Only used when __max_upload_latency is
+        # set.
+        self.__last_upload_check_time = None
+        self.__last_upload_check_bytes = 0
+        # The time when the oldest bytes not yet included in a request were first observed, or None if there are
+        # none.  Only tracked when __max_upload_latency is set.
+        self.__pending_since = None
+        # The distribution of the number of seconds between when bytes were first observed and when the request
+        # containing them was successfully sent.  Only tracked when __max_upload_latency is set.
+        self.__upload_latency = Histogram(Histogram.exponential_bounds(0.01, 1.2, 60))
+
         # The client to use for sending the data.
         self.__scalyr_client = scalyr_client
+        # The configuration and client passed to the last update_config invocation that have not yet been applied.
+        # They are applied by the copying thread once there is no pending request.  Protected by __lock.
+        self.__pending_config = None
+        self.__pending_client = None
+        # Set whenever there is no configuration update waiting to be applied.
+        self.__config_update_applied = threading.Event()
+        self.__config_update_applied.set()
         # The last time we scanned for new files that match the __log_matchers.
         self.__last_new_file_scan_time = 0
+        # The last time we checked whether any of the idle log files have changed.
+        self.__last_idle_log_check_time = 0
 
         # Status variables that track statistics reported to the status page.
         self.__last_attempt_time = None
@@ -221,6 +394,14 @@ class CopyingManager(StoppableThread):
         # The positions to use for a given file if there is not already a checkpoint for that file.
         self.__logs_initial_positions = logs_initial_positions
 
+        # Persists the checkpoints for the files being copied, only writing the ones that have changed.
+        self.__checkpoint_store = CheckpointStore(configuration.agent_data_path,
+                                                  write_interval=configuration.checkpoint_write_interval)
+
+        # Scans for new log files after the initial scan has been performed.
+        self.__new_log_scanner = NewLogScanner(self.__log_matchers, lambda: self.__log_paths_being_processed,
+                                               configuration.max_new_log_detection_time)
+
         # A semaphore that we increment when this object has begun copying files (after first scan).
         self.__copying_semaphore = threading.Semaphore()
 
@@ -254,7 +435,7 @@ class CopyingManager(StoppableThread):
         try:
             # Try to read the checkpoint state from disk.
             current_time = time.time()
-            checkpoints_state = self.__read_checkpoint_state()
+            checkpoints_state = self.__checkpoint_store.read()
             if checkpoints_state is None:
                 log.info('The checkpoints could not be read.  All logs will be copied starting at their current end')
             elif (current_time - checkpoints_state['time']) > self.__config.max_allowed_checkpoint_age:
@@ -274,6 +455,10 @@ class CopyingManager(StoppableThread):
                                                   checkpoints=checkpoints,
                                                   logs_initial_positions=self.__logs_initial_positions)
 
+            # Drop any checkpoints for files we are no longer copying and write out the full state to start fresh.
+            self.__checkpoint_store.retain_only(self.__log_paths_being_processed)
+            self.__checkpoint_store.write_if_necessary(current_time=current_time, force=True)
+
             # The copying params that tell us how much we are allowed to send and how long we have to wait between
             # attempts.
             copying_params = CopyingParameters(self.__config)
@@ -281,17 +466,22 @@ class CopyingManager(StoppableThread):
             # Just initialize the last time we had a success to now.  Make the logic below easier.
             last_success = time.time()
 
+            # From now on, new log files are found by the scanner thread.
+            self.__new_log_scanner.start()
+
             # We are about to start copying.  We can tell waiting threads.
             self.__copying_semaphore.release()
 
             while self._run_state.is_running():
                 log.log(scalyr_logging.DEBUG_LEVEL_1, 'At top of copy log files loop.')
                 current_time = time.time()
+                sleep_time = None
                 # noinspection PyBroadException
                 try:
                     # If we have a pending request and it's been too taken too long to send it, just drop it
-                    # on the ground and advance.
-                    if current_time - last_success > self.__config.max_retry_time:
+                    # on the ground and advance.  If it is still being sent, we wait for that to finish first.
+                    if (current_time - last_success > self.__config.max_retry_time and
+                            self.__pending_send is None):
                         if self.__pending_add_events_task is not None:
                             self.__pending_add_events_task.completion_callback(LogFileProcessor.FAIL_AND_DROP)
                             self.__pending_add_events_task = None
@@ -300,17 +490,35 @@ class CopyingManager(StoppableThread):
                         for processor in self.__log_processors:
                             processor.skip_to_end('Too long since last successful request to server.',
                                                   'skipNoServerSuccess', current_time=current_time)
+                            self.__checkpoint_store.update(processor.log_path, processor.get_checkpoint())
+
+                    # Apply any new configuration.  Processors can only be removed when there is no request that may
+                    # still need to roll them back.
+                    if self.__pending_add_events_task is None:
+                        self.__apply_pending_config_update()
 
-                    # Check for new logs.  If we do detect some new log files, they must have been created since our
-                    # last scan.  In this case, we start copying them from byte zero instead of the end of the file.
-                    self.__scan_for_new_logs_if_necessary(current_time=current_time, copy_at_index_zero=True)
+                    # Pick up any new logs found by the scanner.
+                    self.__add_new_log_processors()
+
+                    # Recreate the processors for any idle files that have changed, and close any that have become
+                    # idle.  We can only close them when there is no request that may still need to roll them back.
+                    self.__revive_changed_idle_log_files(current_time)
+                    if self.__pending_add_events_task is None:
+                        self.__evict_idle_log_processors(current_time)
+
+                    # If we are sending based on latency, wait until there are enough bytes or they have waited long
+                    # enough before creating a new request.
+                    if self.__pending_add_events_task is None and not self.__is_upload_due(current_time):
+                        self.__checkpoint_store.write_if_necessary(current_time=current_time)
+                        self._run_state.sleep_but_awaken_if_stopped(self.__get_latency_poll_interval())
+                        continue
 
                     # Collect log lines to send if we don't have one already.
                     if self.__pending_add_events_task is None:
                         log.log(scalyr_logging.DEBUG_LEVEL_1, 'Getting next batch of events to send.')
                         self.__pending_add_events_task = self.__get_next_add_events_task(
                             copying_params.current_bytes_allowed_to_send)
-                    else:
+                    elif self.__pending_send is None:
                         log.log(scalyr_logging.DEBUG_LEVEL_1, 'Have pending batch of events, retrying to send.')
                         # Take a look at the file system and see if there are any new bytes pending.  This updates the
                         # statistics for each pending file.  This is important to do for status purposes if we have
@@ -318,9 +526,17 @@ class CopyingManager(StoppableThread):
                         # statistics).
                         self.__scan_for_new_bytes(current_time=current_time)
 
-                    # Try to send the request if we have one.
+                    # Try to send the request if we have one.  It is sent on another thread, so that we can keep
+                    # picking up new log files and writing checkpoints while the network is slow.
                     if self.__pending_add_events_task is not None:
-                        (result, bytes_sent, full_response) = self.__send_events(self.__pending_add_events_task)
+                        if self.__pending_send is None:
+                            self.__pending_send = self.__send_events(self.__pending_add_events_task)
+                        if not self.__pending_send.wait(SEND_POLL_INTERVAL):
+                            self.__checkpoint_store.write_if_necessary(current_time=current_time)
+                            continue
+
+                        (result, bytes_sent, full_response) = self.__pending_send.get_result()
+                        self.__pending_send = None
 
                         log.log(scalyr_logging.DEBUG_LEVEL_1, 'Sent %ld bytes and received response with status="%s".',
                                 bytes_sent, result)
@@ -333,10 +549,12 @@ class CopyingManager(StoppableThread):
                             else:
                                 self.__pending_add_events_task.completion_callback(LogFileProcessor.FAIL_AND_RETRY)
                             self.__pending_add_events_task = None
-                            self.__write_checkpoint_state()
 
                         if result == 'success':
                             last_success = current_time
+                            # Once caught up, we go back to waiting for new bytes rather than the request spacing.
+                            if self.__max_upload_latency > 0:
+                                sleep_time = self.__get_latency_poll_interval()
                     else:
                         result = 'failedReadingLogs'
                         bytes_sent = 0
@@ -356,6 +574,10 @@ class CopyingManager(StoppableThread):
                         self.__total_bytes_uploaded += bytes_sent
                     self.__lock.release()
 
+                    # Write out any checkpoints that have changed.  The store decides if enough time has passed
+                    # since the last write.
+                    self.__checkpoint_store.write_if_necessary(current_time=current_time)
+
                 except Exception:
                     # TODO: Do not catch Exception here.  That is too board.  Disabling warning for now.
                     log.exception('Failed while attempting to scan and transmit logs')
@@ -365,12 +587,79 @@ class CopyingManager(StoppableThread):
                     self.__total_errors += 1
                     self.__lock.release()
 
-                self._run_state.sleep_but_awaken_if_stopped(copying_params.current_sleep_interval)
+                if sleep_time is None:
+                    sleep_time = copying_params.current_sleep_interval
+                self._run_state.sleep_but_awaken_if_stopped(sleep_time)
+
+            # Do not leave a request in flight once we have stopped.
+            if self.__pending_send is not None:
+                self.__pending_send.cancel()
+
+            # If we never switched to a new client, the owner will close the new one, so we close the one in use.
+            self.__lock.acquire()
+            if self.__pending_client is not None:
+                self.__scalyr_client.close()
+            self.__lock.release()
+
+            # Make sure any changes that were held back due to the write interval make it to disk.
+            self.__checkpoint_store.write_if_necessary(force=True)
         except Exception:
             # If we got an exception here, it is caused by a bug in the program, so let's just terminate.
             log.exception('Log copying failed due to exception')
             sys.exit(1)
 
+    def stop(self, wait_on_join=True, join_timeout=5):
+        """Stops the thread from running, along with the thread scanning for new log files.
+
+        @param wait_on_join: If True, will block on a join of the threads.
+        @param join_timeout: The maximum number of seconds to block for each join.
+        """
+        self.__new_log_scanner.stop(wait_on_join=wait_on_join and self.__new_log_scanner.isAlive(),
+                                    join_timeout=join_timeout)
+        StoppableThread.stop(self, wait_on_join=wait_on_join, join_timeout=join_timeout)
+
+    def update_config(self, configuration, scalyr_client=None):
+        """Switches to a new configuration without restarting the copying.
+
+        The LogMatchers for log entries that are the same in both configurations are kept, along with the processors
+        for the files they have matched.  The processors for log entries that were removed or changed are closed, and
+        the files matched by the new or changed entries continue copying from where the old processors left off.
+        Other options, such as the request spacing, are not updated and require creating a new CopyingManager.
+
+        The update is applied asynchronously by the copying thread once there is no request pending.  This method is
+        thread safe.
+
+        @param configuration: The new configuration.
+        @param scalyr_client: If not None, the client to use for sending requests from now on.  The current client
+            will be closed once it is no longer needed.
+
+        @type configuration: configuration.Configuration
+        @type scalyr_client: scalyr_client.ScalyrClientSession
+        """
+        self.__lock.acquire()
+        try:
+            self.__pending_config = configuration
+            if scalyr_client is not None:
+                # If an earlier client was never switched to, it is no longer needed.
+                if self.__pending_client is not None:
+                    self.__pending_client.close()
+                self.__pending_client = scalyr_client
+            self.__config_update_applied.clear()
+        finally:
+            self.__lock.release()
+
+    def wait_for_config_update(self, timeout):
+        """Blocks the current thread until the configuration passed to update_config has been applied.
+
+        @param timeout: The maximum number of seconds to wait.
+        @type timeout: float
+
+        @return: True if the configuration has been applied.
+        @rtype: bool
+        """
+        self.__config_update_applied.wait(timeout)
+        return self.__config_update_applied.isSet()
+
     def wait_for_copying_to_begin(self):
         """Block the current thread until this instance has finished its first scan and has begun copying.
 
@@ -407,69 +696,24 @@ class CopyingManager(StoppableThread):
             result.last_response_status = self.__last_response_status
             result.total_errors = self.__total_errors
 
+            (result.total_scans, result.total_scan_time,
+             result.last_scan_duration) = self.__new_log_scanner.get_scan_stats()
+            result.total_idle_log_files = len(self.__idle_log_files)
+            result.total_latency_samples = self.__upload_latency.count()
+            result.upload_latency_p50 = self.__upload_latency.percentile(50)
+            result.upload_latency_p99 = self.__upload_latency.percentile(99)
+
             for entry in self.__log_matchers:
                 result.log_matchers.append(entry.generate_status())
 
+            if self.__metric_queue_processor is not None:
+                result.metric_queue_status = self.__metric_queue_processor.generate_status()
+
         finally:
             self.__lock.release()
 
         return result
 
-    def __read_checkpoint_state(self):
-        """Reads the checkpoint state from disk and returns it.
-
-        The checkpoint state maps each file path to the offset within that log file where we left off copying it.
-
-        @return:  The checkpoint state
-        @rtype: dict
-        """
-        file_path = os.path.join(self.__config.agent_data_path, 'checkpoints.json')
-
-        if not os.path.isfile(file_path):
-            log.info('The log copying checkpoint file "%s" does not exist, skipping.' % file_path)
-            return None
-
-        # noinspection PyBroadException
-        try:
-            return scalyr_util.read_file_as_json(file_path)
-        except Exception:
-            # TODO:  Fix read_file_as_json so that it will not return an exception.. or will return a specific one.
-            log.exception('Could not read checkpoint file due to error.', error_code='failedCheckpointRead')
-            return None
-
-    def __write_checkpoint_state(self):
-        """Writes the current checkpoint state to disk.
-
-        This must be done periodically to ensure that if the agent process stops and starts up again, we pick up
-        from where we left off copying each file.
-        """
-        # Create the format that is expected.  An overall JsonObject with the time when the file was written,
-        # and then an entry for each file path.
-        checkpoints = {}
-        state = {
-            'time': time.time(),
-            'checkpoints': checkpoints,
-        }
-
-        for processor in self.__log_processors:
-            checkpoints[processor.log_path] = processor.get_checkpoint()
-
-        # We write to a temporary file and then rename it to the real file name to make the write more atomic.
-        # We have had problems in the past with corrupted checkpoint files due to failures during the write.
-        file_path = os.path.join(self.__config.agent_data_path, 'checkpoints.json')
-        tmp_path = os.path.join(self.__config.agent_data_path, 'checkpoints.json~')
-        fp = None
-        try:
-            fp = open(tmp_path, 'w')
-            fp.write(json_lib.serialize(state))
-            fp.close()
-            fp = None
-            os.rename(tmp_path, file_path)
-        except (IOError, OSError):
-            if fp is not None:
-                fp.close()
-            log.exception('Could not write checkpoint file due to error', error_code='failedCheckpointWrite')
-
     def __get_next_add_events_task(self, bytes_allowed_to_send):
         """Returns a new AddEventsTask getting all of the pending bytes from the log files that need to be copied.
 
@@ -484,7 +728,9 @@ class CopyingManager(StoppableThread):
         logs_processed = 0
 
         # Initialize the looping variable to the processor we last left off at on a previous run through this method.
-        # This is an index into the __log_processors list.
+        # This is an index into the __log_processors list.  Processors may have been removed since then.
+        if self.__current_processor >= len(self.__log_processors):
+            self.__current_processor = 0
         current_processor = self.__current_processor
 
         # Track which processor we first look at in this method.
@@ -493,9 +739,25 @@ class CopyingManager(StoppableThread):
         # Whether or not the max bytes allowed to send has been reached.
         buffer_filled = False
 
+        # The time the oldest bytes in this request were observed, used to report the upload latency.
+        pending_since = self.__pending_since
+
         add_events_request = self.__scalyr_client.add_events_request(session_info=self.__config.server_attributes,
                                                                      max_size=bytes_allowed_to_send)
 
+        # The pending bytes are about to be read, so the next upload check must look at the files again.
+        self.__last_upload_check_time = None
+
+        # The metric lines from the monitors go first, but may only use part of the request so that the log files
+        # are still copied when there is a backlog of them.  If they could not be processed, they are retried next
+        # time.  The callbacks are kept with the most recently taken lines first.
+        metric_callbacks = []
+        if self.__metric_queue_processor is not None:
+            (metric_callback, buffer_filled) = self.__metric_queue_processor.perform_processing(
+                add_events_request, max_bytes=int(bytes_allowed_to_send * MAX_METRIC_QUEUE_REQUEST_SHARE))
+            if metric_callback is not None:
+                metric_callbacks.append(metric_callback)
+
         while not buffer_filled and logs_processed < len(self.__log_processors):
             # Iterate, getting bytes from each LogFileProcessor until we are full.
             (callback, buffer_filled) = self.__log_processors[current_processor].perform_processing(
@@ -506,6 +768,8 @@ class CopyingManager(StoppableThread):
                 # We have to make sure we rollback any LogFileProcessors we touched by invoking their callbacks.
                 for cb in all_callbacks.itervalues():
                     cb(LogFileProcessor.FAIL_AND_RETRY)
+                for cb in metric_callbacks:
+                    cb(LogFileProcessor.FAIL_AND_RETRY)
                 return None
 
             all_callbacks[current_processor] = callback
@@ -522,6 +786,16 @@ class CopyingManager(StoppableThread):
             else:
                 break
 
+        # Use any space the log files left over for the rest of the metric lines.
+        if self.__metric_queue_processor is not None and not buffer_filled:
+            (metric_callback, buffer_filled) = self.__metric_queue_processor.perform_processing(add_events_request)
+            if metric_callback is not None:
+                metric_callbacks.insert(0, metric_callback)
+
+        # If we read everything, the next bytes we observe will be the oldest pending ones.
+        if not buffer_filled:
+            self.__pending_since = None
+
         # Define the single callback we will return to wrap all of the callbacks we have collected.
         def handle_completed_callback(result):
             """Invokes the callback for all the LogFileProcessors that were touched, along with doing clean up work.
@@ -533,11 +807,22 @@ class CopyingManager(StoppableThread):
             # Copy the processor list because we may need to remove some processors if they are done.
             processor_list = self.__log_processors[:]
             self.__log_processors = []
-            # A dict that maps file paths to the processors assigned to them.  This is used to ensure multiple
-            # processors do not try to process the same file.
-            self.__log_paths_being_processed = {}
             add_events_request.close()
 
+            if pending_since is not None:
+                if result == LogFileProcessor.SUCCESS:
+                    self.__lock.acquire()
+                    self.__upload_latency.add(time.time() - pending_since)
+                    self.__lock.release()
+                elif result == LogFileProcessor.FAIL_AND_RETRY:
+                    # The bytes will be sent again, so they are still the oldest pending bytes.
+                    self.__pending_since = pending_since
+
+            # Lines that are retried are put back at the front of the queue, so the later lines must be put back
+            # first.
+            for cb in metric_callbacks:
+                cb(result)
+
             for i in range(0, len(processor_list)):
                 # Iterate over all the processors, seeing if we had a callback for that particular processor.
                 processor = processor_list[i]
@@ -549,21 +834,25 @@ class CopyingManager(StoppableThread):
                     keep_it = True
                 if keep_it:
                     self.__log_processors.append(processor)
-                    self.__log_paths_being_processed[processor.log_path] = True
+                    if i in all_callbacks:
+                        self.__checkpoint_store.update(processor.log_path, processor.get_checkpoint())
+                else:
+                    del self.__log_paths_being_processed[processor.log_path]
+                    self.__checkpoint_store.remove(processor.log_path)
 
         return AddEventsTask(add_events_request, handle_completed_callback)
 
     def __send_events(self, add_events_task):
-        """Sends the AddEventsRequest contained in the task.
+        """Starts sending the AddEventsRequest contained in the task on another thread.
 
         @param add_events_task: The task whose request should be sent.
         @type add_events_task: AddEventsTask
 
-        @return: The result of sending the request.  It is a tuple of the status message, the number of
-            bytes sent, and the actual response itself.
-        @rtype: (str, int, dict)
+        @return: The in flight request.  Its result is a tuple of the status message, the number of bytes sent,
+            and the actual response itself.
+        @rtype: scalyr_client.PendingRequest
         """
-        return self.__scalyr_client.send(add_events_task.add_events_request)
+        return self.__scalyr_client.send_async(add_events_task.add_events_request)
 
     def __scan_for_new_logs_if_necessary(self, current_time=None, checkpoints=None, logs_initial_positions=None,
                                          copy_at_index_zero=False):
@@ -603,8 +892,256 @@ class CopyingManager(StoppableThread):
         for matcher in self.__log_matchers:
             for new_processor in matcher.find_matches(self.__log_paths_being_processed, checkpoints,
                                                       copy_at_index_zero=copy_at_index_zero):
-                self.__log_processors.append(new_processor)
-                self.__log_paths_being_processed[new_processor.log_path] = True
+                self.__add_log_processor(new_processor, matcher)
+
+    def __add_new_log_processors(self):
+        """Creates processors for the new log files found by the NewLogScanner since the last invocation.
+
+        These files must have been created since the initial scan, so we copy them starting from byte zero instead of
+        the end of the file.
+        """
+        new_paths = self.__new_log_scanner.get_new_paths()
+        if len(new_paths) == 0:
+            return
+
+        # A scan that was in progress when the configuration was updated may have returned matches for LogMatchers
+        # that have since been removed.  Those files will be found by the current LogMatchers if they still match.
+        current_matchers = {}
+        for matcher in self.__log_matchers:
+            current_matchers[matcher] = True
+
+        for (matcher, file_path) in new_paths:
+            if matcher in current_matchers and file_path not in self.__log_paths_being_processed:
+                self.__add_log_processor(matcher.create_processor(file_path, {}, copy_at_index_zero=True), matcher)
+
+    def __add_log_processor(self, processor, matcher):
+        """Adds a newly created processor to the list of processors whose log lines should be copied.
+
+        @param processor: The processor.
+        @param matcher: The LogMatcher that created the processor.
+
+        @type processor: LogFileProcessor
+        @type matcher: LogMatcher
+        """
+        self.__log_processors.append(processor)
+        self.__log_paths_being_processed[processor.log_path] = matcher
+        self.__checkpoint_store.update(processor.log_path, processor.get_checkpoint())
+
+    def __apply_pending_config_update(self):
+        """Applies the configuration passed to update_config, if any.
+
+        This must only be invoked when there is no pending request, since processors may be closed.
+        """
+        self.__lock.acquire()
+        try:
+            new_config = self.__pending_config
+            new_client = self.__pending_client
+            self.__pending_config = None
+            self.__pending_client = None
+        finally:
+            self.__lock.release()
+
+        if new_config is None:
+            return
+
+        # Match up the new log entries with the existing LogMatchers with the same configuration.  There can be
+        # more than one LogMatcher for the same configuration if the entry is repeated.
+        current_matchers = {}
+        for matcher in self.__log_matchers:
+            current_matchers.setdefault(json_lib.serialize(matcher.log_entry_config), []).append(matcher)
+
+        log_matchers = []
+        added_matchers = []
+        for matcher in new_config.logs:
+            same_matchers = current_matchers.get(json_lib.serialize(matcher.log_entry_config))
+            if same_matchers:
+                log_matchers.append(same_matchers.pop(0))
+            else:
+                log_matchers.append(matcher)
+                added_matchers.append(matcher)
+
+        removed_matchers = {}
+        for same_matchers in current_matchers.itervalues():
+            for matcher in same_matchers:
+                removed_matchers[matcher] = True
+
+        # Close the processors for the removed LogMatchers, remembering where they left off in case the files are
+        # matched by one of the new LogMatchers.
+        checkpoints = {}
+        log_processors = []
+        for processor in self.__log_processors:
+            if self.__log_paths_being_processed[processor.log_path] in removed_matchers:
+                checkpoints[processor.log_path] = processor.get_checkpoint()
+                processor.close()
+                del self.__log_paths_being_processed[processor.log_path]
+            else:
+                log_processors.append(processor)
+
+        self.__lock.acquire()
+        try:
+            for file_path in self.__idle_log_files.keys():
+                (matcher, checkpoint, file_signature) = self.__idle_log_files[file_path]
+                if matcher in removed_matchers:
+                    checkpoints[file_path] = checkpoint
+                    del self.__idle_log_files[file_path]
+                    del self.__log_paths_being_processed[file_path]
+
+            self.__log_matchers = log_matchers
+            self.__log_processors = log_processors
+        finally:
+            self.__lock.release()
+
+        self.__new_log_scanner.set_log_matchers(log_matchers)
+        self.__config = new_config
+
+        for matcher in added_matchers:
+            for new_processor in matcher.find_matches(self.__log_paths_being_processed, checkpoints):
+                self.__add_log_processor(new_processor, matcher)
+
+        for file_path in checkpoints:
+            if file_path not in self.__log_paths_being_processed:
+                self.__checkpoint_store.remove(file_path)
+
+        if new_client is not None:
+            self.__scalyr_client.close()
+            self.__scalyr_client = new_client
+
+        log.info('Applied new configuration to log copying.  Added %d and removed %d log entries.',
+                 len(added_matchers), len(removed_matchers))
+        if new_client is not None:
+            log.info('Switched to a new client for sending requests.')
+
+        # Another update may have arrived while we were applying this one.
+        self.__lock.acquire()
+        if self.__pending_config is None:
+            self.__config_update_applied.set()
+        self.__lock.release()
+
+    def __evict_idle_log_processors(self, current_time):
+        """Closes the processors for any files that have not had new bytes for the idle eviction time.
+
+        Their checkpoints are retained so that their processors can be recreated if the files change.  This must
+        only be invoked when there is no pending request, since the processors may need to be rolled back.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        if self.__idle_log_eviction_time <= 0:
+            return
+
+        remaining_processors = []
+        for processor in self.__log_processors:
+            file_signature = None
+            if processor.is_idle(self.__idle_log_eviction_time, current_time=current_time):
+                file_signature = self.__get_file_signature(processor.log_path)
+
+            # If we cannot stat the file, it may have been deleted, so let the processor handle it as usual.
+            if file_signature is None:
+                remaining_processors.append(processor)
+                continue
+
+            log.log(scalyr_logging.DEBUG_LEVEL_1, 'Closing processor for idle log file \'%s\'', processor.log_path)
+            checkpoint = processor.get_checkpoint()
+            processor.close()
+            self.__checkpoint_store.update(processor.log_path, checkpoint)
+            self.__idle_log_files[processor.log_path] = (self.__log_paths_being_processed[processor.log_path],
+                                                         checkpoint, file_signature)
+
+        if len(remaining_processors) != len(self.__log_processors):
+            self.__lock.acquire()
+            self.__log_processors = remaining_processors
+            self.__lock.release()
+
+    def __revive_changed_idle_log_files(self, current_time):
+        """Recreates the processors for any idle files that have changed since their processors were closed.
+
+        Files that no longer exist are forgotten.  If they reappear, they will be found by the NewLogScanner.  Since
+        this stats every idle file, it is only done as often as the file system is scanned for new log files.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        if current_time - self.__last_idle_log_check_time < self.__config.max_new_log_detection_time:
+            return
+        self.__last_idle_log_check_time = current_time
+
+        for file_path in self.__idle_log_files.keys():
+            (matcher, checkpoint, file_signature) = self.__idle_log_files[file_path]
+            current_signature = self.__get_file_signature(file_path)
+            if current_signature == file_signature:
+                continue
+
+            self.__lock.acquire()
+            del self.__idle_log_files[file_path]
+            self.__lock.release()
+
+            if current_signature is None:
+                del self.__log_paths_being_processed[file_path]
+                self.__checkpoint_store.remove(file_path)
+            else:
+                log.log(scalyr_logging.DEBUG_LEVEL_1, 'Reopening idle log file \'%s\'', file_path)
+                self.__add_log_processor(matcher.create_processor(file_path, {file_path: checkpoint}), matcher)
+
+    def __get_file_signature(self, file_path):
+        """Returns a value that will change if the file is modified, replaced, or grows.
+
+        @param file_path: The file path.
+        @type file_path: str
+
+        @return: The signature, or None if the file could not be accessed.
+        @rtype: tuple
+        """
+        try:
+            stat_result = os.stat(file_path)
+            return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime
+        except OSError:
+            return None
+
+    def __is_upload_due(self, current_time):
+        """Returns True if a new request should be created and sent now.
+
+        If no maximum upload latency is configured, this always returns True since the requests are spaced out by
+        the CopyingParameters instead.  Otherwise, it checks the log files for new bytes and returns True if enough
+        bytes are pending to fill a request, if the oldest pending bytes would exceed the latency target by the next
+        check, or if no request has been sent for max_request_spacing_interval seconds.
+
+        @param current_time: The current time.
+        @type current_time: float
+
+        @rtype: bool
+        """
+        if self.__max_upload_latency <= 0:
+            return True
+
+        # The files are only checked once per poll interval, even if the copying thread wakes up more often.
+        poll_interval = self.__get_latency_poll_interval()
+        if (self.__last_upload_check_time is None or
+                current_time - self.__last_upload_check_time >= poll_interval):
+            self.__last_upload_check_bytes = self.__scan_for_new_bytes(current_time=current_time)
+            self.__last_upload_check_time = current_time
+        pending_bytes = self.__last_upload_check_bytes
+
+        if pending_bytes > 0 and self.__pending_since is None:
+            self.__pending_since = current_time
+
+        if pending_bytes >= self.__config.high_water_bytes_sent:
+            return True
+        if (self.__pending_since is not None and
+                current_time - self.__pending_since + poll_interval >= self.__max_upload_latency):
+            return True
+        return (self.__last_attempt_time is None or
+                current_time - self.__last_attempt_time >= self.__config.max_request_spacing_interval)
+
+    def __get_latency_poll_interval(self):
+        """Returns the number of seconds to wait between checks for new bytes when a maximum upload latency is set.
+
+        This is lengthened when there are too many log files to check them all within the interval derived from the
+        latency.
+
+        @rtype: float
+        """
+        return max(self.__latency_poll_interval,
+                   len(self.__log_processors) / float(MAX_LATENCY_POLL_FILES_PER_SECOND))
 
     def __scan_for_new_bytes(self, current_time=None):
         """For any existing LogProcessors, have them scan the file system to see if their underlying files have
@@ -614,8 +1151,15 @@ class CopyingManager(StoppableThread):
 
         This is mainly used to just update the statistics about the files for reporting purposes (i.e., the number
         of pending bytes, etc).
+
+        @return: The total number of bytes available to be read from all log files.
+        @rtype: int
         """
         if current_time is None:
             current_time = time.time()
+        total_bytes_available = 0
         for processor in self.__log_processors:
-            processor.scan_for_new_bytes(current_time)
\ No newline at end of file
+            total_bytes_available += processor.scan_for_new_bytes(current_time)
+        if self.__metric_queue_processor is not None:
+            total_bytes_available += self.__metric_queue_processor.scan_for_new_bytes()
+        return total_bytes_available
@@ -20,8 +20,39 @@
 
 __author__ = 'czerwin@scalyr.com'
 
+import re
+
 from scalyr_agent.json_lib import JsonArray, JsonObject, JsonParseException
 
+# The patterns used by JsonParser to consume entire tokens at once rather than a byte at a time.  The patterns in
+# this first group may match the empty string, so they always match.
+# Whitespace between tokens.
+WHITESPACE_PATTERN = re.compile(r'[ \t\r\n]*')
+# The characters of a string literal up to its closing quote.  A backslash may be followed by any character, which
+# is verified when the escapes are processed.  The pattern is written so that there is only one way to match any
+# input, which prevents exponential backtracking when a literal is not terminated.
+STRING_CONTENTS_PATTERN = re.compile(r'[^"\\\r\n]*(?:\\[\s\S][^"\\\r\n]*)*')
+# The characters that may make up a numeric literal.
+NUMBER_PATTERN = re.compile(r'[-+eE.0-9]*')
+# The characters that may make up an unquoted identifier.
+IDENTIFIER_PATTERN = re.compile(r'[_a-zA-Z0-9]*')
+# The remainder of a // comment.
+LINE_COMMENT_PATTERN = re.compile(r'[^\r\n]*')
+
+# The following patterns match the common cases of the lenient grammar in one step.  If they do not match, the
+# parser falls back to examining the input a byte at a time, which handles comments and reports errors.
+# A value that is a string literal not followed by a '+' (or a comment), a non-negative integer that fits in an int,
+# or one of the literals true, false, and null.  Each is captured by its own group.
+SIMPLE_VALUE_PATTERN = re.compile(r'[ \t\r\n]*(?:"([^"\\\r\n]*(?:\\[\s\S][^"\\\r\n]*)*)"(?![ \t\r\n]*[+/])|'
+                                  r'([0-9]{1,18})(?![-+eE.0-9])|(true|false|null))')
+# An object attribute name without backslash escapes, either quoted or not, followed by its colon.  The quoted and
+# unquoted names are captured by separate groups.
+OBJECT_KEY_PATTERN = re.compile(r'[ \t\r\n]*(?:"([^"\\\r\n]*)"|([_a-zA-Z][_a-zA-Z0-9]*))[ \t\r\n]*:')
+# The comma or closing brace following an object attribute value.  The brace is captured by the group.
+OBJECT_SEPARATOR_PATTERN = re.compile(r'[ \t\r\n]*(?:,|(\}))')
+# The comma or closing bracket following an array element.  The bracket is captured by the group.
+ARRAY_SEPARATOR_PATTERN = re.compile(r'[ \t\r\n]*(?:,|(\]))')
+
 
 class ByteScanner(object):
     """Allows for iterating over a byte input.
@@ -29,6 +60,9 @@ class ByteScanner(object):
     ByteScanner wraps an incoming byte array of input and provides
     methods to iterate over the bytes.  It also provides methods to
     perform typical conversions.
+
+    The scanner indexes directly into the input string rather than copying
+    it, so creating one is cheap even for very large inputs.
     """
 
     def __init__(self, string_input, start_pos=0, max_pos=None):
@@ -40,19 +74,17 @@ class ByteScanner(object):
             input is used.
 
         @return: The new instance."""
-        self.__buffer = []
+        # Every character of a byte string is already less than 256, so it can be used as is.  Anything else is
+        # converted to one, keeping only the low byte of each character.
+        if type(string_input) is not str:
+            string_input = ''.join([chr(ord(x) & 255) for x in string_input])
+        self.__buffer = string_input
         self.__pos = start_pos
         self.__start_pos = start_pos
         self.__max_pos = len(string_input)
         if not max_pos is None:
             self.__max_pos = max_pos
 
-        # Go through and make sure the bytes are all less than 255.  I
-        # am not sure if the b'' is really need to force a binary string,
-        # especially since python 2.X, all strings are binary by default.
-        for i in range(len(string_input)):
-            self.__buffer.append("" + chr(ord(string_input[i]) & 255))
-
     @property
     def at_end(self):
         """True if the scanner is at the end of the byte input."""
@@ -83,23 +115,15 @@ class ByteScanner(object):
 
         @raise IndexError: If the offset places the position outside of the valid range for the underlying byte
             range."""
-        line_num = 1
         target_pos = self.__pos + offset
-        x = self.__start_pos
 
         self.__check_index(target_pos)
- 
-        while x < target_pos:
-            b = self.__buffer[x]
-            x += 1
-            if b == '\n':
-                line_num += 1
-            elif b == '\r':
-                line_num += 1
-                # If this CR is the first half of a CRLF sequence, 
-                # skip the LF; otherwise we'd double-count CRLF line breaks.
-                if x < target_pos and self.__buffer[x] == '\n':
-                    x += 1
+
+        # Each LF and CR starts a new line, except that a CRLF sequence only counts once.
+        line_num = 1 + self.__buffer.count('\n', self.__start_pos, target_pos)
+        if self.__buffer.find('\r', self.__start_pos, target_pos) >= 0:
+            line_num += (self.__buffer.count('\r', self.__start_pos, target_pos) -
+                         self.__buffer.count('\r\n', self.__start_pos, target_pos))
         return line_num
 
     @property
@@ -121,9 +145,8 @@ class ByteScanner(object):
         @raise IndexError: If the end of the buffer would be reached before length bytes are read. In this case, the
             buffer is not advanced."""
         self.__check_read_size(length)
-        my_slice = self.__buffer[self.__pos:self.__pos + length]
         self.__pos += length
-        return "".join(my_slice)
+        return self.__buffer[self.__pos - length:self.__pos]
 
     def peek_next_ubyte(self, offset=0, none_if_bad_index=False):
         """Returns the next byte that will be returned when read_ubyte is 
@@ -143,6 +166,33 @@ class ByteScanner(object):
             return None
         return self.__buffer[index]
 
+    def match(self, pattern):
+        """Matches the regular expression at the current position and advances past the bytes it matched.
+
+        @param pattern: The compiled regular expression.
+        @type pattern: re.RegexObject
+
+        @return: The match, or None if the pattern did not match.  The scanner is only advanced if it matched.  The
+            positions in the match are relative to the underlying byte array.
+        @rtype: re.MatchObject"""
+        result = pattern.match(self.__buffer, self.__pos, self.__max_pos)
+        if result is not None:
+            self.__pos = result.end()
+        return result
+
+    def find(self, substring):
+        """Returns the offset from the current position of the next occurrence of substring.
+
+        @param substring: The bytes to search for.
+        @type substring: str
+
+        @return: The offset, or -1 if substring does not occur before the end of the buffer.
+        @rtype: int"""
+        index = self.__buffer.find(substring, self.__pos, self.__max_pos)
+        if index < 0:
+            return -1
+        return index - self.__pos
+
     def __check_read_size(self, read_length):
         index = self.__pos + read_length - 1
         if index < self.__start_pos or index >= self.__max_pos:
@@ -185,6 +235,22 @@ class JsonParser(object):
 
     def parse_value(self):
         """Parses a Json value from the input."""
+        # Try to consume the common case of a simple value in a single step.
+        match = self.__scanner.match(SIMPLE_VALUE_PATTERN)
+        if match is not None:
+            string_contents = match.group(1)
+            if string_contents is not None:
+                return self.__process_escapes(string_contents.decode("utf8"), match.start(1))
+            digits = match.group(2)
+            if digits is not None:
+                return int(digits)
+            literal = match.group(3)
+            if literal == 'true':
+                return True
+            elif literal == 'false':
+                return False
+            return None
+
         start_pos = self.__scanner.position
         try:
             c = self.__peek_next_non_whitespace()
@@ -230,6 +296,25 @@ class JsonParser(object):
         result_object = JsonObject()
 
         while True:
+            # Try to consume the common case of a simple attribute name through the comma following its value
+            # without examining each byte.
+            match = self.__scanner.match(OBJECT_KEY_PATTERN)
+            if match is not None:
+                key = match.group(1)
+                if key is not None:
+                    key = key.decode("utf8")
+                else:
+                    key = match.group(2)
+                result_object.put(key, self.parse_value())
+
+                match = self.__scanner.match(OBJECT_SEPARATOR_PATTERN)
+                if match is not None:
+                    if match.group(1) is not None:
+                        return result_object
+                    continue
+                self.__parse_object_separator(object_start)
+                continue
+
             c = self.__peek_next_non_whitespace()
       
             if c is None:
@@ -266,24 +351,29 @@ class JsonParser(object):
             # skip any whitespace after the colon
             self.__peek_next_non_whitespace()
             result_object.put(key, self.parse_value())
-      
-            c = self.__peek_next_non_whitespace()
-      
-            if c is None:
-                self.__error("Need '}' for end of object", object_start)
-            elif c == '}':
-                # do nothing we'll process the '}' back around at the top of 
-                # the loop.
-                continue
-            elif c == ',':
-                self.__scanner.read_ubyte()
+            self.__parse_object_separator(object_start)
+
+    def __parse_object_separator(self, object_start):
+        """Parse the comma following an object field, if there is one.
+
+        The closing '}' is not consumed."""
+        c = self.__peek_next_non_whitespace()
+
+        if c is None:
+            self.__error("Need '}' for end of object", object_start)
+        elif c == '}':
+            # do nothing we'll process the '}' back around at the top of
+            # the loop.
+            return
+        elif c == ',':
+            self.__scanner.read_ubyte()
+        else:
+            if self.__preceding_line_break() and self.allow_missing_commas:
+                # proceed, inferring a comma
+                return
             else:
-                if self.__preceding_line_break() and self.allow_missing_commas:
-                    # proceed, inferring a comma
-                    continue
-                else:
-                    self.__error("After object field, expected ',' or '}' but "
-                                 "found '%s'... are you missing a comma?" % c)
+                self.__error("After object field, expected ',' or '}' but "
+                             "found '%s'... are you missing a comma?" % c)
 
     def __parse_array(self):
         """Parse a JSON array. The scanner must be at the first '['."""
@@ -297,15 +387,20 @@ class JsonParser(object):
             if self.__peek_next_non_whitespace() == ']':
                 self.__scanner.read_ubyte()
                 return array
-      
-            self.__peek_next_non_whitespace()  # skip any whitespace
+
             # TODO:  If we ever want to put in annotated supported, uncomment the pos lines.
             # value_start_pos = self.__scanner.position
       
             array.add(self.parse_value())
             # value_end_pos = self.__scanner.position
             # value_comma_pos = -1
-      
+
+            match = self.__scanner.match(ARRAY_SEPARATOR_PATTERN)
+            if match is not None:
+                if match.group(1) is not None:
+                    return array
+                continue
+
             c = self.__peek_next_non_whitespace()
             if c is None:
                 self.__error("Array has no terminating '['", array_start)
@@ -352,16 +447,7 @@ class JsonParser(object):
   
     def __parse_identifier(self):
         """Parse an identifier."""
-        length = 0
-
-        while True:
-            c = self.__scanner.peek_next_ubyte(offset=length, none_if_bad_index=True)
-            if c == '_' or 'a' <= c <= 'z' or 'A' <= c <= 'Z' or '0' <= c <= '9':
-                length += 1
-            else:
-                break
-
-        return self.__scanner.read_ubytes(length)
+        return self.__scanner.match(IDENTIFIER_PATTERN).group()
 
     def __parse_string(self):
         """Parse a string literal. The next character should be '\"'."""
@@ -371,25 +457,17 @@ class JsonParser(object):
         if c != '"':
             return None
 
-        length = 0
-        while True:
-            if length >= self.__scanner.bytes_remaining:
-                self.__error("string literal not terminated")
-      
-            c = self.__scanner.peek_next_ubyte(offset=length)
-            if c == '"':
-                break
-            
-            length += 1
-            
-            if c == '\\':
-                if length >= self.__scanner.bytes_remaining:
-                    self.__error("incomplete backslash sequence")
-                length += 1
-            elif c == '\r' or c == '\n':
-                self.__error("string literal not terminated before end of line")
-
-        result = self.__scanner.read_ubytes(length)
+        result = self.__scanner.match(STRING_CONTENTS_PATTERN).group()
+
+        # The contents end at the closing quote, unless the literal is malformed.
+        c = self.__scanner.peek_next_ubyte(none_if_bad_index=True)
+        if c is None:
+            self.__error("string literal not terminated", start_pos)
+        elif c == '\\':
+            self.__error("incomplete backslash sequence", start_pos)
+        elif c == '\r' or c == '\n':
+            self.__error("string literal not terminated before end of line", start_pos)
+
         # Have to consume the quote mark
         self.__scanner.read_ubyte()
 
@@ -447,30 +525,15 @@ class JsonParser(object):
 
     def __parse_number(self):
         """Parse a numeric literal."""
-        literal_buffer = []
-        all_digits = True
-    
-        while not self.__scanner.at_end:
-            peek = self.__scanner.peek_next_ubyte()
-            if ((peek != '+') and (peek != '-') and (peek != 'e') and
-                    (peek != 'E') and (peek != '.') and
-                    (not '0' <= peek <= '9')):
-                break
-      
-            if len(literal_buffer) >= 100:
-                self.__error("numeric literal too long (limit 100 characters)")
-      
-            next_char = self.__scanner.read_ubyte()
-            all_digits = all_digits and '0' <= next_char <= '9'
-            literal_buffer.append(next_char)
-    
-        if all_digits and len(literal_buffer) <= 18:
-            value = 0
-            for digit in literal_buffer:
-                value = (value * 10) + ord(digit) - ord('0')
-            return value
+        start_pos = self.__scanner.position
+        number_string = self.__scanner.match(NUMBER_PATTERN).group()
+
+        if len(number_string) > 100:
+            self.__error("numeric literal too long (limit 100 characters)", start_pos + 99)
+
+        if len(number_string) <= 18 and number_string.isdigit():
+            return int(number_string)
 
-        number_string = ''.join(literal_buffer)
         if (number_string.find('.') < 0 and
                 number_string.find('e') < 0 and
                 number_string.find('E') < 0):
@@ -499,24 +562,19 @@ class JsonParser(object):
         c = self.__scanner.read_ubyte()
         if c == '/':
             # This is a "//" comment. Scan through EOL.
-            while not self.__scanner.at_end:
+            self.__scanner.match(LINE_COMMENT_PATTERN)
+            if not self.__scanner.at_end:
                 c = self.__scanner.read_ubyte()
-                if c == '\n' or c == '\r':
-                    break
-      
-            # If this is a CRLF, scan through the LF.
-            if c == '\r' and self.__scanner.peek_next_ubyte(none_if_bad_index=True) == '\n':
-                self.__scanner.read_ubyte()
+
+                # If this is a CRLF, scan through the LF.
+                if c == '\r' and self.__scanner.peek_next_ubyte(none_if_bad_index=True) == '\n':
+                    self.__scanner.read_ubyte()
         elif c == '*':
             # This is a "/*" comment. Scan through "*/".
-            while not self.__scanner.at_end:
-                c = self.__scanner.read_ubyte()
-                if (c == '*' and 
-                    self.__scanner.peek_next_ubyte(
-                        none_if_bad_index=True) == '/'):
-                    self.__scanner.read_ubyte()
-                    return
-            self.__error("Unterminated comment", comment_start_pos)
+            end_offset = self.__scanner.find('*/')
+            if end_offset < 0:
+                self.__error("Unterminated comment", comment_start_pos)
+            self.__scanner.read_ubytes(end_offset + 2)
         else:
             self.__error("Unexpected character '/%s'" % c)
   
@@ -575,13 +633,10 @@ class JsonParser(object):
         while True:
             # TODO: support any Unicode / UTF-8 whitespace sequence.
             raw_c = self.__scanner.peek_next_ubyte(none_if_bad_index=True)
-            if raw_c is None:
-                return raw_c
-            c = ord(raw_c)
-            if c == 32 or c == 9 or c == 13 or c == 10:
-                self.__scanner.read_ubyte()
-                continue
-            elif raw_c == '/':
+            if raw_c == ' ' or raw_c == '\t' or raw_c == '\r' or raw_c == '\n':
+                self.__scanner.match(WHITESPACE_PATTERN)
+                raw_c = self.__scanner.peek_next_ubyte(none_if_bad_index=True)
+            if raw_c == '/':
                 self.__parse_comment()
                 continue
             return raw_c
@@ -22,6 +22,14 @@ import re
 from cStringIO import StringIO
 from scalyr_agent.json_lib import JsonConversionException, JsonObject, JsonArray
 
+# The standard json library's C-accelerated encoder is used when available to speed up serializing events.  It is only
+# present in Python 2.7 or greater, and only if the _json extension was built.
+try:
+    from json.encoder import c_make_encoder, c_encode_basestring_ascii
+except ImportError:
+    c_make_encoder = None
+    c_encode_basestring_ascii = None
+
 # Used below to escape characters found in strings when
 # writing strings as a JSON string.
 ESCAPES = {
@@ -35,7 +43,7 @@ ESCAPES = {
 }
 
 
-def serialize(value, output=None, use_fast_encoding=False):
+def serialize(value, output=None, use_fast_encoding=False, sort_keys=True):
     """Serializes the specified value as JSON.
 
     @param value: The value to write. Can be a bool, int, long, float, dict, and list. If this value is a list or dict,
@@ -43,10 +51,27 @@ def serialize(value, output=None, use_fast_encoding=False):
     @param output: If specified, this should be a StringIO object to collect the output.
     @param use_fast_encoding: To be used only when JSON is going to be sent as part of a request to the Scalyr servers.
         We support a non-spec variant that allows us to skip a UTF-8 decoding step.
+    @param sort_keys: If True, the keys of each dict are written in sorted order.  If False, they are written in
+        iteration order, which allows values that use fast encoding and only contain plain dicts, lists, str, and
+        numbers to be serialized by the C-accelerated encoder in the standard json library, if it is available.  Note,
+        that encoder writes floats using their full precision rather than str(value).
 
     @return: The string containing the JSON if the output argument is None.  Otherwise, the results are
         written to output and the output object is returned.
     """
+    if not sort_keys and use_fast_encoding and __fast_encoder is not None:
+        try:
+            result = ''.join(__fast_encoder(value, 0))
+        except (TypeError, ValueError):
+            # The value holds something the C encoder cannot write the way we need it, such as a JsonObject, a unicode
+            # string, or a NaN.  Let the pure Python implementation handle it.
+            result = None
+        if result is not None:
+            if output is None:
+                return result
+            output.write(result)
+            return output
+
     if output is None:
         output = StringIO()
         # Remember that we have to return a string and not the output object.
@@ -54,6 +79,22 @@ def serialize(value, output=None, use_fast_encoding=False):
     else:
         return_as_string = False
 
+    __serialize_value(value, output, use_fast_encoding, sort_keys)
+
+    if return_as_string:
+        return output.getvalue()
+    else:
+        return output
+
+
+def __serialize_value(value, output, use_fast_encoding, sort_keys):
+    """Writes the specified value as JSON to output.
+
+    @param value: The value to write.  See serialize for the supported types.
+    @param output: The StringIO object to collect the output.
+    @param use_fast_encoding: True if the non-spec string escaping should be used.  See serialize.
+    @param sort_keys: True if the keys of each dict should be written in sorted order.
+    """
     value_type = type(value)
     if value is None:
         output.write('null')
@@ -64,13 +105,17 @@ def serialize(value, output=None, use_fast_encoding=False):
     elif value_type is dict or value_type is JsonObject:
         output.write('{')
         first = True
-        for key in sorted(value.iterkeys()):
+        if sort_keys:
+            keys = sorted(value.iterkeys())
+        else:
+            keys = value.iterkeys()
+        for key in keys:
             if not first:
                 output.write(',')
             output.write('"')
             output.write(__to_escaped_string(key, use_fast_encoding=use_fast_encoding))
             output.write('":')
-            serialize(value[key], output, use_fast_encoding=use_fast_encoding)
+            __serialize_value(value[key], output, use_fast_encoding, sort_keys)
             first = False
         output.write('}')
     elif value_type is list or value_type is JsonArray:
@@ -79,7 +124,7 @@ def serialize(value, output=None, use_fast_encoding=False):
         for element in value:
             if not first:
                 output.write(',')
-            serialize(element, output, use_fast_encoding=use_fast_encoding)
+            __serialize_value(element, output, use_fast_encoding, sort_keys)
             first = False
         output.write(']')
     elif value_type is int or value_type is long:
@@ -96,14 +141,8 @@ def serialize(value, output=None, use_fast_encoding=False):
         raise JsonConversionException('Unknown value type when attempting to serialize as json: %s' %
                                       str(value_type))
 
-    if return_as_string:
-        return output.getvalue()
-    else:
-        return output
-
-# Some regular expressions used for an optimized string escaping method
-# based on code in the json lib in 2.7.
-ESCAPE_OPT = re.compile(r'[\x00-\x1f\\"\b\f\n\r\t\x7f]')
+# The escaped forms of the characters that must be escaped in str values, used for an optimized string escaping
+# method based on code in the json lib in 2.7.
 ESCAPE_DCT_OPT = {
     '\\': '\\\\',
     '"': '\\"',
@@ -120,6 +159,32 @@ ESCAPE_DCT_OPT.setdefault(chr(127), '\\u007f')
 
 HAS_UTF8 = re.compile(r'[\x80-\xff]')
 
+# Matches the characters to escape in str values when using fast encoding.  Besides the characters in ESCAPE_DCT_OPT,
+# the bytes \x80 to \x9f are escaped as \u0080 to \u009f, just as the character by character loop in
+# __to_escaped_string does.
+ESCAPE_HIGH_ASCII = re.compile(r'[\x00-\x1f\\"\x7f-\x9f]')
+ESCAPE_DCT_HIGH_ASCII = ESCAPE_DCT_OPT.copy()
+for i in range(0x80, 0xa0):
+    ESCAPE_DCT_HIGH_ASCII[chr(i)] = '\\u%0.4x' % i
+
+# The equivalents for unicode values, which also have the characters \u2000 to \u20ff escaped.
+ESCAPE_UNICODE = re.compile(u'[\x00-\x1f\\\\"\x7f-\x9f\u2000-\u20ff]')
+ESCAPE_DCT_UNICODE = {}
+for i in range(0x20) + range(0x7f, 0xa0) + range(0x2000, 0x2100):
+    ESCAPE_DCT_UNICODE[unichr(i)] = u'\\u%0.4x' % i
+for i in ESCAPES:
+    ESCAPE_DCT_UNICODE[unichr(i)] = ESCAPES[i][1]
+
+
+def __replace_high_ascii(match):
+    """Returns the escaped form of a character matched by ESCAPE_HIGH_ASCII."""
+    return ESCAPE_DCT_HIGH_ASCII[match.group(0)]
+
+
+def __replace_unicode(match):
+    """Returns the escaped form of a character matched by ESCAPE_UNICODE."""
+    return ESCAPE_DCT_UNICODE[match.group(0)]
+
 
 def __to_escaped_string(string_value, use_fast_encoding=False, use_optimization=True):
     """Returns a string that is properly escaped by JSON standards.
@@ -127,24 +192,25 @@ def __to_escaped_string(string_value, use_fast_encoding=False, use_optimization=
     @param string_value: The value to return. Should be a str and not unicode but we might work either way.
     @param use_fast_encoding: If True, then uses a faster but non-spec escaping method that only the Scalyr servers
         will work with.
-    @param use_optimization: If True, use the optimized path for escaping. This only applies if string_value is 'str'
-        and use_fast_encoding is True and string_value does not have any high ascii. If any of these conditions are not
-        met, then this method falls back to the unoptimized approach.
+    @param use_optimization: If True, escape the string using regular expressions, which does the scanning in C.
+        Otherwise, the string is escaped by examining each character in Python.  Both produce the same result.
 
     @return: The escaped string.
     """
+    if use_optimization:
+        if type(string_value) is unicode:
+            return ESCAPE_UNICODE.sub(__replace_unicode, string_value)
+        elif not use_fast_encoding:
+            return ESCAPE_UNICODE.sub(__replace_unicode, string_value.decode('utf8'))
+        else:
+            return ESCAPE_HIGH_ASCII.sub(__replace_high_ascii, string_value)
+
     result = StringIO()
     if type(string_value) is unicode:
         type_index = 1
     elif not use_fast_encoding:
         string_value = string_value.decode('utf8')
         type_index = 1
-    elif not use_optimization:
-        type_index = 0
-    elif HAS_UTF8.search(string_value) is None:
-        def replace(match):
-            return ESCAPE_DCT_OPT[match.group(0)]
-        return ESCAPE_OPT.sub(replace, string_value)
     else:
         type_index = 0
     for x in string_value:
@@ -163,4 +229,43 @@ def __to_escaped_string(string_value, use_fast_encoding=False, use_optimization=
                 result.write(u'\\u%0.4x' % x_ord)
         else:
             result.write(x)
-    return result.getvalue()
\ No newline at end of file
+    return result.getvalue()
+
+
+def __raise_not_plain_json(value):
+    """Invoked by the C-accelerated encoder for any value it does not know how to write, such as a JsonObject.
+
+    Raising an error aborts the C encoder so that serialize falls back to the pure Python implementation.
+
+    @param value: The value that could not be written.
+    """
+    raise TypeError('Value must be serialized by json_lib: %s' % str(type(value)))
+
+
+def __encode_string_fast(string_value):
+    """Returns the quoted and escaped JSON for the specified string using the fast encoding semantics.
+
+    This is invoked by the C-accelerated encoder for every key and string value.  It produces exactly the same output
+    as __to_escaped_string does when use_fast_encoding is True.
+
+    @param string_value: The string to encode.
+    @return: The encoded string, including the surrounding quotes.
+    @rtype: str
+    """
+    if type(string_value) is not str:
+        # A unicode value may produce a unicode result, which cannot be mixed with the str chunks.
+        raise TypeError('Unicode strings must be serialized by json_lib')
+    if HAS_UTF8.search(string_value) is None:
+        # For pure ASCII, the standard library's escaping matches ESCAPE_DCT_OPT exactly.
+        return c_encode_basestring_ascii(string_value)
+    return '"' + __to_escaped_string(string_value, use_fast_encoding=True) + '"'
+
+
+# The encoder used by serialize when keys do not need to be sorted.  It is built on the C-accelerated encoder from the
+# standard json library and is None if that is not available (such as before Python 2.7).  Note, the C encoder ignores
+# its sort_keys argument in Python 2.7, which is why it can only be used when sorting was not requested.
+if c_make_encoder is not None and c_encode_basestring_ascii is not None:
+    __fast_encoder = c_make_encoder(None, __raise_not_plain_json, __encode_string_fast, None, ':', ',', False, False,
+                                    False)
+else:
+    __fast_encoder = None
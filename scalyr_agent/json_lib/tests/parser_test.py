@@ -112,6 +112,18 @@ class ByteScannerTests(unittest.TestCase):
 
         self.assertRaises(IndexError, x.line_number_for_offset, 25)
 
+    def test_line_number_with_mixed_line_endings(self):
+        x = ByteScanner("a\r\r\nb\nc\rd")
+
+        self.assertEquals(x.line_number_for_offset(3), 3)
+        self.assertEquals(x.line_number_for_offset(4), 3)
+        self.assertEquals(x.line_number_for_offset(8), 5)
+
+    def test_unicode_input(self):
+        x = ByteScanner(u"Hi\u0141")
+
+        self.assertEquals(x.read_ubytes(3), "Hi\x41")
+
     def test_line_number_for_offset_with_negative_offset(self):
         x = ByteScanner("Hi there\nAnother line\nOne more")
         #                 01234567 8901234567890 12345678
@@ -250,6 +262,34 @@ class JsonParserTests(unittest.TestCase):
         self.assertEquals(x.get("b"), 7)
 
 
+    def test_mixing_simple_and_lenient_syntax(self):
+        x = JsonParser.parse("""{
+                                   "a": "x\\ty", b: "one" // first
+                                     + "two",
+                                   "c\\u0041": [1, -2, 3.5, true, false, null, "z" /* last */, ],
+                                   d: { e : 12345678901234567890 },
+                                 }""")
+        self.assertEquals(len(x), 4)
+        self.assertEquals(x.get("a"), "x\ty")
+        self.assertEquals(x.get("b"), "onetwo")
+        self.assertEquals(x.get("cA")[1], -2)
+        self.assertEquals(x.get("cA")[2], 3.5)
+        self.assertEquals(x.get("cA")[3], True)
+        self.assertEquals(x.get("cA")[5], None)
+        self.assertEquals(x.get("cA")[6], "z")
+        self.assertEquals(len(x.get("cA")), 7)
+        self.assertEquals(x.get("d").get("e"), 12345678901234567890L)
+
+        self.assertRaises(JsonParseException, JsonParser.parse, "{ a: 5 b: 6 }")
+        self.assertRaises(JsonParseException, JsonParser.parse, "[ \"a\\q\" ]")
+        self.assertRaises(JsonParseException, JsonParser.parse, "{ a: 5,")
+
+        try:
+            JsonParser.parse("{\n  a: 5,\n  b: \"x\n}")
+            self.fail("Expected parse to fail")
+        except JsonParseException, e:
+            self.assertEquals(e.line_number, 3)
+
 def main():
     unittest.main()
 
@@ -17,9 +17,11 @@
 
 __author__ = 'czerwin@scalyr.com'
 
+import random
 import unittest
 
-from scalyr_agent.json_lib import serialize
+from scalyr_agent.json_lib import serialize, parse, JsonObject, JsonArray
+from scalyr_agent.json_lib import serializer
 
 
 class SerializeTests(unittest.TestCase):
@@ -50,6 +52,34 @@ class SerializeTests(unittest.TestCase):
         self.assertEquals(serialize('Escaped\xE2\x82\xAC', use_fast_encoding=True), '"Escaped\xe2\\u0082\xac"')
         self.assertEquals(serialize('Escaped\xE2\x82\xAC', use_fast_encoding=False), '"Escaped\\u20ac"')
 
+    def test_high_ascii_string(self):
+        self.assertEquals(serialize('caf\xc3\xa9 "\xe4\xb8\xad\xe6\x96\x87"\n', use_fast_encoding=True),
+                          '"caf\xc3\xa9 \\"\xe4\xb8\xad\xe6\\u0096\\u0087\\"\\n"')
+        self.assertEquals(serialize('\xe2\x80\x94\t\xe2\x82\xac', use_fast_encoding=False), '"\\u2014\\t\\u20ac"')
+        self.assertEquals(serialize(u'\u2014\x85"', use_fast_encoding=True), '"\\u2014\\u0085\\""')
+
+    def test_optimized_escaping_matches_loop(self):
+        # The optimized escaping must produce exactly what the character by character loop does.
+        to_escaped_string = getattr(serializer, '__to_escaped_string')
+        # The loop can only handle unicode values whose characters are either ascii or escaped.
+        escaped_characters = [unichr(x) for x in range(0, 0xa0) + range(0x2000, 0x2100)]
+        characters = escaped_characters + [unichr(x) for x in range(0xa0, 0x200) + [0x1fff, 0x2100, 0x4e2d, 0xfeff]]
+        rng = random.Random(0)
+        for i in range(500):
+            value = u''.join([rng.choice(characters) for j in range(rng.randint(0, 40))]).encode('utf8')
+            self.assertEquals(to_escaped_string(value, use_fast_encoding=True),
+                              to_escaped_string(value, use_fast_encoding=True, use_optimization=False))
+
+            value = u''.join([rng.choice(escaped_characters) for j in range(rng.randint(0, 40))])
+            for (string_value, use_fast_encoding) in [(value, True), (value, False), (value.encode('utf8'), False)]:
+                self.assertEquals(to_escaped_string(string_value, use_fast_encoding=use_fast_encoding),
+                                  to_escaped_string(string_value, use_fast_encoding=use_fast_encoding,
+                                                    use_optimization=False))
+
+            raw_bytes = ''.join([chr(rng.randint(0, 255)) for j in range(rng.randint(0, 40))])
+            self.assertEquals(to_escaped_string(raw_bytes, use_fast_encoding=True),
+                              to_escaped_string(raw_bytes, use_fast_encoding=True, use_optimization=False))
+
     def test_dict(self):
         self.assertEquals(self.write({'hi': 5}), '{"hi":5}')
         self.assertEquals(self.write({'bye': 5, 'hi': True}), '{"bye":5,"hi":true}')
@@ -60,6 +90,30 @@ class SerializeTests(unittest.TestCase):
         self.assertEquals(self.write([1, 2, 5]), '[1,2,5]')
         self.assertEquals(self.write([]), '[]')
 
+    def test_unsorted_keys(self):
+        self.assertEquals(serialize({'hi': 5}, use_fast_encoding=True, sort_keys=False), '{"hi":5}')
+        self.assertEquals(serialize({}, use_fast_encoding=True, sort_keys=False), '{}')
+
+        value = {'attrs': {'message': 'GET "/index.html"\n\5\177', 'parser': 'accessLog', 'sample_rate': 0.5,
+                           'size': 5123L, 'ok': True, 'missing': None, 'values': [1, 2, [3]]},
+                 'thread': 'log_1', 'sev': 3}
+        self.__assert_same_as_sorted(value)
+
+        # These contain values that the C encoder cannot write itself, so they are either handed back to the
+        # string escaping in this module or cause the entire value to be written by the pure Python implementation.
+        result = serialize({'message': 'Escaped\xE2\x82\xAC', 'other': 'plain'}, use_fast_encoding=True,
+                           sort_keys=False)
+        self.assertTrue('"message":"Escaped\xe2\\u0082\xac"' in result)
+        self.assertTrue('"other":"plain"' in result)
+        self.__assert_same_as_sorted({'message': u'Unicode', 'other': 'plain'})
+        self.__assert_same_as_sorted({'attrs': JsonObject({'foo': 'bar', 'baz': 5}), 'list': JsonArray(1, 2)})
+
+    def __assert_same_as_sorted(self, value):
+        result = serialize(value, use_fast_encoding=True, sort_keys=False)
+        self.assertEquals(type(result), str)
+        self.assertEquals(len(result), len(serialize(value, use_fast_encoding=True)))
+        self.assertEquals(parse(result), parse(serialize(value, use_fast_encoding=True)))
+
     def write(self, value):
         return serialize(value, use_fast_encoding=True)
 
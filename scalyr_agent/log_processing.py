@@ -24,7 +24,9 @@
 
 __author__ = 'czerwin@scalyr.com'
 
+import copy
 import errno
+import fnmatch
 import glob
 import os
 import random
@@ -38,6 +40,8 @@ import scalyr_agent.util as scalyr_util
 
 from scalyr_agent.agent_status import LogMatcherStatus
 from scalyr_agent.agent_status import LogProcessorStatus
+from scalyr_agent.agent_status import MetricQueueStatus
+from scalyr_agent.scalyr_client import EventSerializer
 
 from cStringIO import StringIO
 from os import listdir
@@ -73,6 +77,15 @@ LOG_DELETION_DELAY = 10 * 60
 # is exceeded, then we consider those bytes to be stale and just skip to reading from the end to get the freshest bytes.
 COPY_STALENESS_THRESHOLD = 15 * 60
 
+# The maximum number of seconds between full rescans of the directories matching a glob.  In between, only the
+# directories whose modification time has changed are listed again.
+GLOB_FULL_RESCAN_INTERVAL = 10 * 60
+
+# The granularity of directory modification times on the file systems we support.  If a directory was modified
+# within this many seconds of when we listed it, we cannot trust that a later change will update its modification
+# time, so we list it again on the next scan.
+DIRECTORY_MTIME_GRANULARITY = 2
+
 log = scalyr_logging.getLogger(__name__)
 
 
@@ -869,10 +882,7 @@ class LogFileIterator(object):
         return {'initial_position': initial_position}
 
     def get_open_files_count(self):
-        """Returns the number of pending file objects that need to be read to return log content.
-
-        This is only used for tests.
-        """
+        """Returns the number of pending file objects that need to be read to return log content."""
         return len(self.__pending_files)
 
     class BufferEntry(object):
@@ -955,6 +965,13 @@ class LogFileIterator(object):
             self.mark_offset = position
             self.mark_generation = mark_generation
 
+        def __eq__(self, other):
+            return (isinstance(other, LogFileIterator.Position) and self.mark_generation == other.mark_generation
+                    and self.mark_offset == other.mark_offset)
+
+        def __ne__(self, other):
+            return not self.__eq__(other)
+
 
 class LogFileProcessor(object):
     """Performs all processing on a single log file (identified by a path) including returning which lines are ready
@@ -988,7 +1005,8 @@ class LogFileProcessor(object):
         # Trackers whether or not close has been invoked on this processor.
         self.__is_closed = False
 
-        self.__log_attributes = log_attributes
+        # Used to serialize the events for the lines copied from this log.
+        self.__event_serializer = EventSerializer(log_attributes)
         # The redacter to perform on all log lines from this log file.
         self.__redacter = LogLineRedacter(file_path)
         # The sampler to apply to all log lines from this log file.
@@ -1016,6 +1034,14 @@ class LogFileProcessor(object):
         self.__max_log_offset_size = MAX_LOG_OFFSET_SIZE
 
         self.__last_success = None
+        # The last time new bytes were observed in the log file.  Used to determine if the processor is idle.
+        self.__last_activity_time = None
+        # If the last line read did not fit in its request, a tuple holding the iterator position the line was read
+        # from, the line, its serialized event, the number of bytes it counts as copied, and whether or not it was
+        # redacted.  It is used when the line is read again from that position for the next request, so that it does
+        # not have to be sampled, redacted, and serialized again.  It is cleared whenever the iterator is moved
+        # anywhere else.
+        self.__rejected_event = None
 
     def generate_status(self):
         """Generates and returns a status object for this particular processor.
@@ -1101,7 +1127,10 @@ class LogFileProcessor(object):
         self.__last_scan_time = current_time
         self.__lock.release()
 
-        self.__log_file_iterator.mark(current_time=current_time)
+        self.__mark_iterator(current_time)
+
+        if self.__last_activity_time is None or self.__log_file_iterator.available > 0:
+            self.__last_activity_time = current_time
 
         # Check to see if we haven't had a success in enough time.  If so, then we just skip ahead.
         if current_time - self.__last_success > self.__copy_staleness_threshold:
@@ -1144,25 +1173,37 @@ class LogFileProcessor(object):
                 bytes_read += len(line)
                 lines_read += 1L
 
-                sample_result = self.__sampler.process_line(line)
-                if sample_result is None:
-                    lines_dropped_by_sampling += 1L
-                    bytes_dropped_by_sampling += len(line)
-                    continue
-
-                (line, redacted) = self.__redacter.process_line(line)
+                rejected_event = self.__rejected_event
+                self.__rejected_event = None
+                if rejected_event is not None and rejected_event[0] == position and rejected_event[1] == line:
+                    # This line did not fit in the last request, so we already know what to send for it.
+                    (serialized_event, line_bytes_copied, redacted) = rejected_event[2:]
+                else:
+                    sample_result = self.__sampler.process_line(line)
+                    if sample_result is None:
+                        lines_dropped_by_sampling += 1L
+                        bytes_dropped_by_sampling += len(line)
+                        continue
+
+                    (redacted_line, redacted) = self.__redacter.process_line(line)
+                    line_bytes_copied = len(redacted_line)
+                    if len(redacted_line) > 0:
+                        serialized_event = self.__event_serializer.serialize(redacted_line, sample_result)
+                    else:
+                        serialized_event = None
 
-                if len(line) > 0:
+                if serialized_event is not None:
                     # Try to add the line to the request, but it will let us know if it exceeds the limit it can
-                    # send.
-                    if not add_events_request.add_event(self.__create_events_object(line, sample_result)):
+                    # send.  If it does not fit, we keep the serialized event for when we read the line again.
+                    if not add_events_request.add_serialized_event(serialized_event):
                         self.__log_file_iterator.seek(position)
+                        self.__rejected_event = (position, line, serialized_event, line_bytes_copied, redacted)
                         buffer_filled = True
                         break
 
                 if redacted:
                     total_redactions += 1L
-                bytes_copied += len(line)
+                bytes_copied += line_bytes_copied
                 lines_copied += 1
 
             final_position = self.__log_file_iterator.tell()
@@ -1206,7 +1247,7 @@ class LogFileProcessor(object):
 
                         # Do a mark to cleanup any state in the iterator.  We know we won't have to roll back
                         # to before this point now.
-                        self.__log_file_iterator.mark(current_time)
+                        self.__mark_iterator(current_time)
                         if self.__log_file_iterator.at_end:
                             self.__log_file_iterator.close()
                             self.__is_closed = True
@@ -1219,6 +1260,7 @@ class LogFileProcessor(object):
                         return False
                     elif result == LogFileProcessor.FAIL_AND_RETRY:
                         self.__log_file_iterator.seek(original_position)
+                        self.__rejected_event = None
                         self.__total_bytes_pending = self.__log_file_iterator.available
                         return False
                     else:
@@ -1237,10 +1279,28 @@ class LogFileProcessor(object):
 
             # Roll back the positions if something happened.
             self.__log_file_iterator.seek(original_position)
+            self.__rejected_event = None
             add_events_request.set_position(original_events_position)
 
             return None, False
 
+    def __mark_iterator(self, current_time):
+        """Marks the iterator, keeping the position of the rejected event in step with it.
+
+        Marking renumbers the iterator positions, so the rejected event is only kept if the iterator is still at the
+        position its line was read from.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        keep_rejected_event = (self.__rejected_event is not None and
+                               self.__rejected_event[0] == self.__log_file_iterator.tell())
+        self.__log_file_iterator.mark(current_time=current_time)
+        if keep_rejected_event:
+            self.__rejected_event = (self.__log_file_iterator.tell(),) + self.__rejected_event[1:]
+        else:
+            self.__rejected_event = None
+
     def skip_to_end(self, message, error_code, current_time=None):
         """Advances the iterator to the end of the log file due to some error.
 
@@ -1256,6 +1316,7 @@ class LogFileProcessor(object):
             current_time = time.time()
         skipped_bytes = self.__log_file_iterator.advance_to_end()
         self.__log_file_iterator.mark(current_time=current_time)
+        self.__rejected_event = None
 
         self.__lock.acquire()
         self.__total_bytes_skipped += skipped_bytes
@@ -1283,27 +1344,6 @@ class LogFileProcessor(object):
         """
         self.__redacter.add_redaction_rule(match_expression, replacement)
 
-    def __create_events_object(self, event_message, sampling_rate):
-        """Returns the events object that can be sent to the server for this log to insert the specified message.
-
-        @param event_message: The contents of the event, to be placed in attrs.message.
-        @param sampling_rate:  The sampling rate that had been used to decide if the event_message should be
-            sent to the server.
-
-        @return: A dict containing the correct fields that when serialized to JSON and added to an addEvents request
-            will insert the specified event along with any log attributes associated with this log.  In particular,
-            it will contain a 'attrs' field.  The ts (timestamp) field is not set because the AddEventRequest object
-            will set its value.  The attrs field will be another dict containing all of the log attributes for this
-            log as well as a 'message' field containing event_message.
-        """
-        attrs = self.__log_attributes.copy()
-        attrs['message'] = event_message
-        if sampling_rate != 1.0:
-            attrs['sample_rate'] = sampling_rate
-        return {
-            'attrs': attrs,
-        }
-
     def scan_for_new_bytes(self, current_time=None):
         """Checks the underlying file to see if any new bytes are available or if the file has been rotated.
 
@@ -1314,15 +1354,58 @@ class LogFileProcessor(object):
 
         @param current_time: If not None, the value to use as the current time.  Used for testing.
         @type current_time: float
+
+        @return: The number of bytes available to be read from the log file.
+        @rtype: int
         """
         if current_time is None:
             current_time = time.time()
         self.__log_file_iterator.scan_for_new_bytes(current_time)
+        available = self.__log_file_iterator.available
         self.__lock.acquire()
         self.__last_scan_time = current_time
-        self.__total_bytes_pending = self.__log_file_iterator.available
+        self.__total_bytes_pending = available
+        self.__lock.release()
+        if available > 0:
+            self.__last_activity_time = current_time
+        return available
+
+    def is_idle(self, max_idle_time, current_time=None):
+        """Returns True if no new bytes have been observed in the log file for max_idle_time seconds and there is
+        nothing left to read from it, including any rotated files.
+
+        An idle processor may be closed and later recreated using its checkpoint without losing any bytes.
+
+        @param max_idle_time: The number of seconds without new bytes before the processor is considered idle.
+        @param current_time: If not None, the value to use as the current time.  Used for testing.
+
+        @type max_idle_time: float
+        @type current_time: float
+
+        @rtype: bool
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        if self.__last_activity_time is None or current_time - self.__last_activity_time < max_idle_time:
+            return False
+
+        self.__lock.acquire()
+        bytes_being_processed = self.__total_bytes_being_processed
         self.__lock.release()
 
+        return (bytes_being_processed == 0 and self.__log_file_iterator.available == 0 and
+                self.__log_file_iterator.get_open_files_count() <= 1)
+
+    def close(self):
+        """Closes the processor, releasing any open file handles.  It may not be used after this."""
+        self.__lock.acquire()
+        try:
+            self.__log_file_iterator.close()
+            self.__is_closed = True
+        finally:
+            self.__lock.release()
+
     def get_checkpoint(self):
         return self.__log_file_iterator.get_checkpoint()
 
@@ -1335,6 +1418,240 @@ class LogFileProcessor(object):
         return LogFileIterator.create_checkpoint(initial_position)
 
 
+class MetricQueueProcessor(object):
+    """Performs all processing on the metric lines held by a MetricEventQueue, returning which lines are ready to be
+    sent to the server.
+
+    The lines are sent exactly as if they had been written to the monitors' metric logs and copied by a
+    LogFileProcessor.  The attributes, redaction rules and sampling rules for each line come from the log_config of
+    the monitor that emitted it.
+    """
+    def __init__(self, metric_queue):
+        """Initializes an instance.
+
+        @param metric_queue: The queue holding the lines to send.
+        @type metric_queue: scalyr_logging.MetricEventQueue
+        """
+        self.__metric_queue = metric_queue
+        # The serializer, sampler, and redacter for the lines of each open monitor, mapped to a tuple holding a copy
+        # of the monitor's log_config they were created from and the objects.  See __get_monitor_processors.
+        self.__monitor_processors = {}
+
+        # The lock that protects the statistics below.
+        self.__lock = threading.Lock()
+        # The statistics reported by generate_status.  See MetricQueueStatus for their meaning.
+        self.__total_bytes_copied = 0L
+        self.__total_lines_copied = 0L
+        self.__total_bytes_failed = 0L
+        self.__total_bytes_dropped_by_sampling = 0L
+        self.__total_lines_dropped_by_sampling = 0L
+        self.__total_redactions = 0L
+
+    def generate_status(self):
+        """
+        @return:  The status object describing the lines sent from the queue.
+        @rtype: MetricQueueStatus
+        """
+        result = MetricQueueStatus()
+        (result.total_lines_pending, result.total_bytes_pending,
+         result.total_lines_dropped) = self.__metric_queue.get_stats()
+
+        self.__lock.acquire()
+        try:
+            result.total_bytes_copied = self.__total_bytes_copied
+            result.total_lines_copied = self.__total_lines_copied
+            result.total_bytes_failed = self.__total_bytes_failed
+            result.total_bytes_dropped_by_sampling = self.__total_bytes_dropped_by_sampling
+            result.total_lines_dropped_by_sampling = self.__total_lines_dropped_by_sampling
+            result.total_redactions = self.__total_redactions
+        finally:
+            self.__lock.release()
+        return result
+
+    def scan_for_new_bytes(self):
+        """Returns the number of bytes in the lines waiting in the queue.
+
+        @rtype: int
+        """
+        return self.__metric_queue.get_stats()[1]
+
+    def perform_processing(self, add_events_request, max_bytes=None):
+        """Takes the lines from the queue, processes them using the redaction and sampling rules of the monitors that
+        emitted them, and appends the lines that emerge to add_events_request.
+
+        Any lines that do not fit in the request, or that would exceed max_bytes, are put back in the queue.
+
+        @param add_events_request:  The request to add the resulting lines/events to.
+        @param max_bytes:  If not None, the maximum number of serialized bytes to add to the request.  At least one
+            line is always added if there is room in the request, so that a large line cannot block the queue.
+
+        @type add_events_request: scalyr_client.AddEventsRequest
+        @type max_bytes: int or None
+
+        @return A tuple containing two elements:  a callback function to invoke when the result of sending the
+            events to the server is known, and a bool indicating if the buffer has been filled and could not
+            accept new events.  The callback has the same semantics as the one returned by
+            LogFileProcessor.perform_processing, except the lines are put back in the queue if FAIL_AND_RETRY is
+            passed in.  They keep the result of sampling them, so the same lines are sent when they are retried.
+            The processor is never closed, so it always returns False.
+        @rtype: (function(int) that returns a bool, bool)
+        """
+        open_monitors = self.__metric_queue.get_open_monitors()
+        events = self.__metric_queue.take_all()
+        original_events_position = add_events_request.position()
+
+        for monitor in self.__monitor_processors.keys():
+            if monitor not in open_monitors:
+                del self.__monitor_processors[monitor]
+
+        # noinspection PyBroadException
+        try:
+            bytes_read = 0L
+            bytes_copied = 0L
+            lines_copied = 0L
+            total_redactions = 0L
+            lines_dropped_by_sampling = 0L
+            bytes_dropped_by_sampling = 0L
+
+            buffer_filled = False
+            events_taken = len(events)
+            # The number of serialized bytes added to the request, used to enforce max_bytes.
+            bytes_added = 0
+
+            # The serializer, sampler, and redacter to use for each monitor's lines.
+            monitor_processors = {}
+            # The events with the result of sampling them added, which are put back if the request must be retried.
+            sampled_events = []
+
+            for i in range(0, len(events)):
+                monitor = events[i][3]
+                if monitor not in monitor_processors:
+                    monitor_processors[monitor] = self.__get_monitor_processors(monitor, open_monitors)
+                (event_serializer, sampler, redacter) = monitor_processors[monitor]
+
+                line = scalyr_logging.format_metric_event(events[i])
+
+                # Lines being retried keep the result of sampling them the first time.
+                if len(events[i]) > 4:
+                    sample_result = events[i][4]
+                else:
+                    sample_result = sampler.process_line(line)
+                sampled_events.append(events[i][0:4] + (sample_result,))
+
+                if sample_result is None:
+                    bytes_read += len(line)
+                    lines_dropped_by_sampling += 1L
+                    bytes_dropped_by_sampling += len(line)
+                    continue
+
+                (redacted_line, redacted) = redacter.process_line(line)
+                if len(redacted_line) > 0:
+                    serialized_event = event_serializer.serialize(redacted_line, sample_result)
+                    if max_bytes is not None and bytes_added > 0 and bytes_added + len(serialized_event) > max_bytes:
+                        events_taken = i
+                        break
+                    if not add_events_request.add_serialized_event(serialized_event):
+                        events_taken = i
+                        buffer_filled = True
+                        break
+                    bytes_added += len(serialized_event)
+
+                bytes_read += len(line)
+                if redacted:
+                    total_redactions += 1L
+                bytes_copied += len(redacted_line)
+                lines_copied += 1L
+
+            taken_events = sampled_events[0:events_taken]
+            if events_taken < len(events):
+                self.__metric_queue.put_back(sampled_events[events_taken:] + events[len(sampled_events):])
+
+            def completion_callback(result):
+                """Invoked by the caller to indicate if the events were successfully sent to server, and if not,
+                what to do.
+
+                @param result: Must be one of LogFileProcessor.SUCCESS, FAIL_AND_DROP, FAIL_AND_RETRY.
+                @type result: int
+                @return: Always False since the processor is never closed.
+                @rtype: bool
+                """
+                if result == LogFileProcessor.SUCCESS:
+                    self.__lock.acquire()
+                    self.__total_bytes_copied += bytes_copied
+                    self.__total_lines_copied += lines_copied
+                    self.__total_bytes_dropped_by_sampling += bytes_dropped_by_sampling
+                    self.__total_lines_dropped_by_sampling += lines_dropped_by_sampling
+                    self.__total_redactions += total_redactions
+                    self.__lock.release()
+                elif result == LogFileProcessor.FAIL_AND_DROP:
+                    self.__lock.acquire()
+                    self.__total_bytes_failed += bytes_read
+                    self.__lock.release()
+                elif result == LogFileProcessor.FAIL_AND_RETRY:
+                    self.__metric_queue.put_back(taken_events)
+                else:
+                    raise Exception('Invalid result %s' % str(result))
+                return False
+
+            return completion_callback, buffer_filled
+        except Exception:
+            log.exception('Failed to copy lines from the metric queue.  Will re-attempt lines.',
+                          error_code='logCopierFailed')
+            add_events_request.set_position(original_events_position)
+            self.__metric_queue.put_back(events)
+            return None, False
+
+    def __get_monitor_processors(self, monitor, open_monitors):
+        """Returns the objects used to process the lines emitted by a monitor.
+
+        The objects are kept for open monitors and created again if the monitor's log_config changes.
+
+        @param monitor: The monitor.
+        @param open_monitors: The monitors that were open when the lines were taken from the queue.
+
+        @type monitor: ScalyrMonitor
+        @type open_monitors: dict
+
+        @return: The serializer, sampler, and redacter for the lines.
+        @rtype: (EventSerializer, LogLineSampler, LogLineRedacter)
+        """
+        entry = self.__monitor_processors.get(monitor)
+        if entry is not None and entry[0] == monitor.log_config:
+            return entry[1]
+
+        processors = self.__create_monitor_processors(monitor.log_config)
+        # The lines of a closed monitor may still be waiting in the queue, but its objects are not kept since they
+        # would never be removed.
+        if monitor in open_monitors:
+            self.__monitor_processors[monitor] = (copy.deepcopy(monitor.log_config), processors)
+        return processors
+
+    def __create_monitor_processors(self, log_config):
+        """Returns the objects used to process the lines emitted by a monitor.
+
+        @param log_config: The log_config of the monitor.
+        @type log_config: dict
+
+        @return: The serializer, sampler, and redacter for the lines.
+        @rtype: (EventSerializer, LogLineSampler, LogLineRedacter)
+        """
+        # These are the same attributes the LogMatcher for the monitor's metric log would have used.
+        log_path = log_config['path']
+        log_attributes = dict(log_config['attributes'])
+        if 'parser' in log_config:
+            log_attributes['parser'] = log_config['parser']
+        if 'logfile' not in log_attributes and 'filename' not in log_attributes:
+            log_attributes['logfile'] = log_path
+
+        sampler = LogLineSampler(log_path)
+        for rule in log_config['sampling_rules']:
+            sampler.add_rule(rule['match_expression'], rule['sampling_rate'])
+        redacter = LogLineRedacter(log_path)
+        for rule in log_config['redaction_rules']:
+            redacter.add_redaction_rule(rule['match_expression'], rule['replacement'])
+        return EventSerializer(log_attributes), sampler, redacter
+
+
 class LogLineSampler(object):
     """Encapsulates all of the configured sampling rules to perform on lines from a single log file.
 
@@ -1541,8 +1858,25 @@ class LogMatcher(object):
         # The LogFileProcessor objects for all log files that have matched the log_path.  This will only have
         # one element if it is not a glob.
         self.__processors = []
-        # The lock that protects the __processor and __last_check vars.
+        # The lock that protects the __processor, __last_check, and __paths_to_recheck vars.
         self.__lock = threading.Lock()
+        # If the log path is a glob, used to expand it while only listing the directories that have changed.
+        if self.__is_glob:
+            self.__glob = IncrementalGlob(self.log_path)
+        else:
+            self.__glob = None
+        # A dict whose keys are the paths that matched the glob in a previous scan but were not picked up, either
+        # because they could not be read or because their processor has since closed.  These are checked on every
+        # scan since their directory may not have changed.
+        self.__paths_to_recheck = {}
+
+    @property
+    def log_entry_config(self):
+        """Returns the configuration entry this matcher was created for.
+
+        @rtype: dict
+        """
+        return self.__log_entry_config
 
     def generate_status(self):
         """
@@ -1585,49 +1919,111 @@ class LogMatcher(object):
         @return: A list of the processors to handle the newly matched files.
         @rtype: list of LogFileProcessor
         """
+        result = []
+        for matched_file in self.find_new_paths(existing_processors):
+            result.append(self.create_processor(matched_file, previous_state, copy_at_index_zero=copy_at_index_zero))
+        return result
+
+    def find_new_paths(self, existing_processors):
+        """Returns the file paths that match the log file for this matcher that are readable and not already handled
+        by other processors.
+
+        This only accesses the file system and does not create any processors, so it is safe to invoke from a thread
+        other than the one processing the log files.
+
+        @param existing_processors: A dict from file path to the processor currently handling it.  Paths that are keys
+            in this dict are not returned.
+        @type existing_processors: dict of str to LogFileProcessor
+
+        @return: The list of matching file paths.
+        @rtype: list of str
+        """
         if not self.__is_glob and self.log_path in existing_processors:
             return []
 
         self.__lock.acquire()
         self.__last_check = time.time()
         self.__removed_closed_processors()
+        paths_to_recheck = self.__paths_to_recheck
+        self.__paths_to_recheck = {}
         self.__lock.release()
 
+        if self.__glob is not None:
+            # Only returns the matches in directories that have changed since the last scan.
+            candidates = self.__glob.find_matches(changed_directories_only=True)
+            for file_path in paths_to_recheck:
+                if os.path.lexists(file_path):
+                    candidates.append(file_path)
+        else:
+            candidates = glob.glob(self.log_path)
+
         result = []
-        # See if the file path matches.. even if it is not a glob, this will return the single file represented by it.
-        for matched_file in glob.glob(self.__log_entry_config['path']):
-            # Only process it if we have permission to read it and it is not already being processed.
-            if not matched_file in existing_processors and self.__can_read_file(matched_file):
-                checkpoint_state = None
-                # Get the last checkpoint state if it exists.
-                if matched_file in previous_state:
-                    checkpoint_state = previous_state[matched_file]
-                    del previous_state[matched_file]
-                elif copy_at_index_zero:
-                    # If we don't have a checkpoint and we are suppose to start copying the file at index zero,
-                    # then create a checkpoint to represent that.
-                    checkpoint_state = LogFileProcessor.create_checkpoint(0)
-
-                # Be sure to add in an entry for the logfile name to include in the log attributes.  We only do this
-                # if the field or legacy field is not present.  Maybe we should override this regardless because the
-                # user could get it wrong.. but for now, we just let them screw it up if they want to.
-                log_attributes = dict(self.__log_entry_config['attributes'])
-                if 'logfile' not in log_attributes and 'filename' not in log_attributes:
-                    log_attributes['logfile'] = matched_file
-
-                # Create the processor to handle this log.
-                new_processor = LogFileProcessor(matched_file, log_attributes, checkpoint=checkpoint_state)
-                for rule in self.__log_entry_config['redaction_rules']:
-                    new_processor.add_redacter(rule['match_expression'], rule['replacement'])
-                for rule in self.__log_entry_config['sampling_rules']:
-                    new_processor.add_sampler(rule['match_expression'], rule['sampling_rate'])
-                result.append(new_processor)
-                self.__lock.acquire()
-                self.__processors.append(new_processor)
-                self.__lock.release()
+        # The paths already in result, so duplicate candidates are skipped without searching the list.
+        added_paths = {}
+        unreadable_paths = {}
+        for matched_file in candidates:
+            # Only return it if we have permission to read it and it is not already being processed.
+            if matched_file in existing_processors or matched_file in added_paths:
+                continue
+            if self.__can_read_file(matched_file):
+                result.append(matched_file)
+                added_paths[matched_file] = True
+            else:
+                unreadable_paths[matched_file] = True
+
+        self.__lock.acquire()
+        self.__paths_to_recheck.update(unreadable_paths)
+        self.__lock.release()
 
         return result
 
+    def create_processor(self, matched_file, previous_state, copy_at_index_zero=False):
+        """Creates a processor to handle a file path returned by find_new_paths.
+
+        @param matched_file: The file path.
+        @param previous_state: A dict from file path to the serialized checkpoint state last recorded for that
+            file path.  Note, if this method does use a state entry, then it will remove it from this dict.
+        @param copy_at_index_zero: If no previous checkpoint state is found for the file path, then if
+            copy_at_index_zero is True, the file will be processed from the first byte in the file.  Otherwise,
+            the processing will skip over all bytes currently in the file and only process bytes added after this
+            point.
+
+        @type matched_file: str
+        @type previous_state: dict of str to json_lib.JsonObject
+        @type copy_at_index_zero: bool
+
+        @return: The processor to handle the file.
+        @rtype: LogFileProcessor
+        """
+        checkpoint_state = None
+        # Get the last checkpoint state if it exists.
+        if matched_file in previous_state:
+            checkpoint_state = previous_state[matched_file]
+            del previous_state[matched_file]
+        elif copy_at_index_zero:
+            # If we don't have a checkpoint and we are suppose to start copying the file at index zero,
+            # then create a checkpoint to represent that.
+            checkpoint_state = LogFileProcessor.create_checkpoint(0)
+
+        # Be sure to add in an entry for the logfile name to include in the log attributes.  We only do this
+        # if the field or legacy field is not present.  Maybe we should override this regardless because the
+        # user could get it wrong.. but for now, we just let them screw it up if they want to.
+        log_attributes = dict(self.__log_entry_config['attributes'])
+        if 'logfile' not in log_attributes and 'filename' not in log_attributes:
+            log_attributes['logfile'] = matched_file
+
+        # Create the processor to handle this log.
+        new_processor = LogFileProcessor(matched_file, log_attributes, checkpoint=checkpoint_state)
+        for rule in self.__log_entry_config['redaction_rules']:
+            new_processor.add_redacter(rule['match_expression'], rule['replacement'])
+        for rule in self.__log_entry_config['sampling_rules']:
+            new_processor.add_sampler(rule['match_expression'], rule['sampling_rate'])
+        self.__lock.acquire()
+        self.__processors.append(new_processor)
+        self.__lock.release()
+
+        return new_processor
+
     def __can_read_file(self, file_path):
         """Determines if this process can read the file at the path.
 
@@ -1654,9 +2050,167 @@ class LogMatcher(object):
         for processor in self.__processors:
             if not processor.is_closed():
                 new_list.append(processor)
+            elif self.__glob is not None:
+                # The file may reappear without its directory changing, so make sure we look for it next scan.
+                self.__paths_to_recheck[processor.log_path] = True
         self.__processors = new_list
 
 
+class IncrementalGlob(object):
+    """Expands a glob pattern, caching the contents of the directories it covers.
+
+    A directory is only listed again if its modification time has changed since it was last listed, which is the
+    case whenever a file is created, removed, or renamed within it.  This allows new files to be found by only
+    performing a stat on each directory covered by the pattern, rather than listing all of them.
+
+    This follows the same rules as glob.glob, such as not matching hidden files unless the pattern explicitly
+    begins with a period.
+    """
+    def __init__(self, pattern, full_rescan_interval=GLOB_FULL_RESCAN_INTERVAL):
+        """Initializes the instance.
+
+        @param pattern: The glob pattern.
+        @param full_rescan_interval: The maximum number of seconds between returning all matches, even for the
+            directories that have not changed.
+
+        @type pattern: str
+        @type full_rescan_interval: float
+        """
+        self.__pattern = pattern
+        self.__full_rescan_interval = full_rescan_interval
+        # A dict mapping directory path to a tuple of its modification time and the list of entries it contained
+        # when it was last listed.  The modification time is None if it cannot be trusted.
+        self.__directory_cache = {}
+        # The last time all matches were returned.
+        self.__last_full_scan_time = None
+
+    def find_matches(self, changed_directories_only=False, current_time=None):
+        """Returns the paths matching the glob pattern.
+
+        @param changed_directories_only: If True, only return the matches in directories that have changed since
+            the last invocation.  Even so, all matches are returned on the first invocation and at least once every
+            full_rescan_interval seconds.
+        @param current_time: If not None, the time to use as the current time.
+
+        @type changed_directories_only: bool
+        @type current_time: float
+
+        @return: The matching paths.
+        @rtype: list of str
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        if (self.__last_full_scan_time is None or
+                current_time - self.__last_full_scan_time >= self.__full_rescan_interval):
+            changed_directories_only = False
+            self.__last_full_scan_time = current_time
+
+        new_cache = {}
+        result = self.__expand(self.__pattern, changed_directories_only, new_cache, current_time)
+        # Only keep the directories we looked at this time, so that the cache does not grow without bound.
+        self.__directory_cache = new_cache
+        return result
+
+    def __expand(self, pattern, changed_directories_only, new_cache, current_time):
+        """Returns the paths matching the pattern.
+
+        @param pattern: The glob pattern to expand.
+        @param changed_directories_only: If True, only return the matches in directories that have changed since
+            the last scan.  This only applies to the last component of the pattern.
+        @param new_cache: The dict to add the directory listings used by this scan to.
+        @param current_time: The current time.
+
+        @type pattern: str
+        @type changed_directories_only: bool
+        @type new_cache: dict
+        @type current_time: float
+
+        @rtype: list of str
+        """
+        if not glob.has_magic(pattern):
+            if os.path.lexists(pattern) and not changed_directories_only:
+                return [pattern]
+            return []
+
+        dirname, basename = os.path.split(pattern)
+        if dirname and dirname != pattern and glob.has_magic(dirname):
+            # We always need all of the matching parent directories, even if they have not changed, since the
+            # directories within them may have.
+            directories = self.__expand(dirname, False, new_cache, current_time)
+        else:
+            directories = [dirname]
+
+        result = []
+        for directory in directories:
+            if basename == '':
+                # The pattern ended with a path separator, so it only matches directories.
+                if not changed_directories_only and os.path.isdir(directory):
+                    result.append(os.path.join(directory, basename))
+                continue
+
+            (names, changed) = self.__list_directory(directory, new_cache, current_time)
+            if changed_directories_only and not changed:
+                continue
+            if not glob.has_magic(basename):
+                if basename in names:
+                    result.append(os.path.join(directory, basename))
+                continue
+            if basename[0] != '.':
+                names = [x for x in names if x[0] != '.']
+            for name in fnmatch.filter(names, basename):
+                if directory:
+                    result.append(os.path.join(directory, name))
+                else:
+                    result.append(name)
+        return result
+
+    def __list_directory(self, directory, new_cache, current_time):
+        """Returns the entries in the specified directory, using the cached listing if it has not changed.
+
+        @param directory: The directory path.  If empty, the current working directory is used.
+        @param new_cache: The dict to add the listing to.
+        @param current_time: The current time.
+
+        @type directory: str
+        @type new_cache: dict
+        @type current_time: float
+
+        @return: A tuple containing the list of entry names and whether or not the directory has changed since it
+            was last listed.
+        @rtype: (list of str, bool)
+        """
+        if directory in new_cache:
+            return new_cache[directory][1], False
+
+        path = directory
+        if not path:
+            path = os.curdir
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], False
+
+        if directory in self.__directory_cache:
+            (cached_mtime, cached_names) = self.__directory_cache[directory]
+            if cached_mtime is not None and cached_mtime == mtime:
+                new_cache[directory] = (cached_mtime, cached_names)
+                return cached_names, False
+
+        try:
+            names = listdir(path)
+        except OSError:
+            return [], False
+
+        # If the directory was modified very recently, another change within the granularity of the modification
+        # time may not be reflected in it.  In that case, do not trust it so it is listed again on the next scan.
+        if current_time - mtime < DIRECTORY_MTIME_GRANULARITY:
+            mtime = None
+        new_cache[directory] = (mtime, names)
+        return names, True
+
+
 class FileSystem(object):
     """A facade through which file system calls can be made.
 
@@ -77,10 +77,68 @@ class MonitorsManager(object):
         Each monitor will run in its own thread.  This method will return after all of the monitor threads
         have been started.
         """
+        self.__start_monitors(self.__monitors)
+
+    def stop(self):
+        """Stops all of the monitors.
+
+        This will only return after all the threads for the monitors have been stopped and joined on.
+        """
+        self.__stop_monitors(self.__running_monitors)
+
+    def update_config(self, configuration):
+        """Switches to the monitors for a new configuration without restarting the monitors that have not changed.
+
+        Running monitors whose configuration is the same in the new configuration are kept.  All other running
+        monitors are stopped and the monitors created for the new configuration are started in their place.  This
+        will only return after the monitors have been stopped and started.
+
+        @param configuration: The new configuration.
+        @type configuration: scalyr_agent.Configuration
+        """
+        unmatched_monitors = list(self.__running_monitors)
+        monitors = []
+        kept_monitors = []
+        new_monitors = []
+        for monitor in configuration.monitors:
+            same_monitor = None
+            for running_monitor in unmatched_monitors:
+                if self.__is_same_monitor(running_monitor, monitor):
+                    same_monitor = running_monitor
+                    break
+
+            if same_monitor is not None:
+                unmatched_monitors.remove(same_monitor)
+                monitors.append(same_monitor)
+                kept_monitors.append(same_monitor)
+            else:
+                monitors.append(monitor)
+                new_monitors.append(monitor)
+
+        self.__stop_monitors(unmatched_monitors)
+
+        self.__lock.acquire()
+        try:
+            self.__config = configuration
+            self.__monitors = monitors
+            self.__running_monitors = kept_monitors
+        finally:
+            self.__lock.release()
+
+        self.__start_monitors(new_monitors)
+        log.info('Applied new configuration to monitors.  Started %d and stopped %d monitors.', len(new_monitors),
+                 len(unmatched_monitors))
+
+    def __start_monitors(self, monitors):
+        """Starts the specified monitors running, adding them to the running monitors.
+
+        @param monitors: The monitors to start.
+        @type monitors: list of scalyr_monitor.ScalyrMonitor
+        """
         # TODO:  Move this try statement out of here.  Let higher layers catch it.
         # noinspection PyBroadException
         try:
-            for monitor in self.__monitors:
+            for monitor in monitors:
                 # Check to see if we can open the metric log.  Maybe we should not silently fail here but instead
                 # fail.
                 if monitor.open_metric_log():
@@ -92,24 +150,38 @@ class MonitorsManager(object):
         except:
             log.exception('Failed to start the monitors due to an exception')
 
-    def stop(self):
-        """Stops all of the monitors.
+    def __stop_monitors(self, monitors):
+        """Stops the specified monitors.
 
-        This will only return after all the threads for the monitors have been stopped and joined on.
+        @param monitors: The monitors to stop.
+        @type monitors: list of scalyr_monitor.ScalyrMonitor
         """
         # TODO:  Move this try statement out of here.  Let higher layers catch it.
         # noinspection PyBroadException
         try:
-            for monitor in self.__running_monitors:
+            for monitor in monitors:
                 log.info('Stopping monitor %s', monitor.monitor_name)
                 monitor.stop(wait_on_join=False)
 
-            for monitor in self.__running_monitors:
+            for monitor in monitors:
                 monitor.stop(join_timeout=1)
                 monitor.close_metric_log()
         except:
             log.exception('Failed to stop the monitors due to an exception')
 
+    @staticmethod
+    def __is_same_monitor(running_monitor, monitor):
+        """Returns True if monitor was created for the same configuration as running_monitor.
+
+        @type running_monitor: scalyr_monitor.ScalyrMonitor
+        @type monitor: scalyr_monitor.ScalyrMonitor
+
+        @rtype: bool
+        """
+        # noinspection PyProtectedMember
+        return (type(running_monitor) is type(monitor) and running_monitor.monitor_name == monitor.monitor_name and
+                running_monitor._config == monitor._config and running_monitor.log_config == monitor.log_config)
+
     @staticmethod
     def load_monitor(monitor_module, additional_python_paths):
         """Loads the module for the specified monitor.
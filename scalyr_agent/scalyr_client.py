@@ -21,9 +21,13 @@ import httplib
 import os
 import platform
 import re
+import select
 import socket
+import struct
 import sys
+import threading
 import time
+import zlib
 
 # noinspection PyBroadException
 try:
@@ -37,6 +41,7 @@ import scalyr_agent.json_lib as json_lib
 import scalyr_agent.scalyr_logging as scalyr_logging
 import scalyr_agent.util as scalyr_util
 
+from scalyr_agent.agent_status import RequestPhaseStatus
 from cStringIO import StringIO
 
 log = scalyr_logging.getLogger(__name__)
@@ -49,7 +54,9 @@ class ScalyrClientSession(object):
     The session aspect is important because we must ensure that the timestamps we include in the AddEventRequests
     are monotonically increasing within a session.
     """
-    def __init__(self, server, api_key, agent_version, quiet=False, request_deadline=60.0, ca_file=None):
+    def __init__(self, server, api_key, agent_version, quiet=False, request_deadline=60.0, ca_file=None,
+                 compression_type='none', compression_level=6, limit_compressed_size=False, additional_servers=None,
+                 load_balance=False):
         """Initializes the connection.
 
         This does not actually try to connect to the server.
@@ -61,6 +68,16 @@ class ScalyrClientSession(object):
         @param request_deadline: The maximum time to wait for all requests in seconds.
         @param ca_file: The path to the file containing the certificates for the trusted certificate authority roots.
             This is used for the SSL connections to verify the connection is to Scalyr.
+        @param compression_type: The encoding to use to compress the request bodies.  Must be one of 'deflate',
+            'gzip', or 'none'.
+        @param compression_level: The zlib compression level to use, from 1 (fastest) to 9 (smallest).
+        @param limit_compressed_size: If True, the maximum size of each request applies to its compressed body
+            rather than its uncompressed JSON.
+        @param additional_servers: The URLs for other servers that may be sent requests, such as regional proxies.
+            If a server cannot be reached, requests are sent to the next available one.
+        @param load_balance: If True, each request is sent to the available server with the fewest requests in
+            flight and the lowest recent latency.  Otherwise, requests are sent to the first available server,
+            in the order the servers were given.
 
         @type server: str
         @type api_key: str
@@ -68,40 +85,31 @@ class ScalyrClientSession(object):
         @type quiet: bool
         @type request_deadline: float
         @type ca_file: str
+        @type compression_type: str
+        @type compression_level: int
+        @type limit_compressed_size: bool
+        @type additional_servers: list of str
+        @type load_balance: bool
         """
+        servers = [server]
+        if additional_servers is not None:
+            servers.extend(additional_servers)
         if not quiet:
-            log.info('Using "%s" as address for scalyr servers' % server)
-        # Verify the server address looks right.
-        parsed_server = re.match('^(http://|https://|)([^:]*)(:\d+|)$', server.lower())
-
-        if parsed_server is None:
-            raise Exception('Could not parse server address "%s"' % server)
-
-        # The full URL address
-        self.__full_address = server
-        # The host for the server.
-        self.__host = parsed_server.group(2)
-        # Whether or not the connection uses SSL.  For production use, this should always be true.  We only
-        # use non-SSL when testing against development versions of the Scalyr server.
-        self.__use_ssl = parsed_server.group(1) == 'https://'
+            log.info('Using "%s" as address for scalyr servers' % ', '.join(servers))
 
-        # Determine the port, defaulting to the right one based on protocol if not given.
-        if parsed_server.group(3) != '':
-            self.__port = int(parsed_server.group(3)[1:])
-        elif self.__use_ssl:
-            self.__port = 443
-        else:
-            self.__port = 80
+        # The servers we may send requests to, in the order they were given.  This also verifies the server addresses
+        # look right.
+        self.__endpoints = []
+        for address in servers:
+            self.__endpoints.append(ServerEndpoint(address))
+        # Whether or not to send each request to the fastest available server rather than the first available one.
+        self.__load_balance = load_balance
 
-        # The HTTPConnection object that has been opened to the servers, if one has been opened.
-        self.__connection = None
         self.__api_key = api_key
         self.__session_id = scalyr_util.create_unique_id()
         # The time of the last success.
         self.__last_success = None
 
-        # The last time the connection was closed, if any.
-        self.__last_connection_close = None
 
         # We create a few headers ahead of time so that we don't have to recreate them each time we need them.
         self.__standard_headers = {
@@ -110,16 +118,38 @@ class ScalyrClientSession(object):
             'User-Agent': ScalyrClientSession.__get_user_agent(agent_version)
         }
 
+        # How to compress the request bodies.
+        self.__compression_type = compression_type
+        self.__compression_level = compression_level
+        self.__limit_compressed_size = limit_compressed_size
+        if compression_type != 'none':
+            self.__standard_headers['Content-Encoding'] = compression_type
+
         # The number of seconds to wait for a blocking operation on the connection before considering it to have
         # timed out.
         self.__request_deadline = request_deadline
 
+        # The buffers used to serialize the AddEventsRequests created by this session, reused across requests.
+        self.__buffer_pool = BufferPool()
+        # The serialized session info and the request prefix created from it for the last request, so that we
+        # do not have to recreate the prefix for every request.
+        self.__last_session_info = None
+        self.__last_request_prefix = None
+
+        # Protects the state shared by requests that are sent at the same time, including the statistics below and
+        # the state of the endpoints.
+        self.__lock = threading.Lock()
+
         # The total number of RPC requests sent.
         self.total_requests_sent = 0
         # The total number of RPC requests that failed.
         self.total_requests_failed = 0
         # The total number of bytes sent over the network.
         self.total_request_bytes_sent = 0
+        # The total number of bytes sent over the network for request bodies that were compressed.
+        self.total_compressed_request_bytes_sent = 0
+        # The total size of all request bodies before compression was applied.
+        self.total_uncompressed_request_bytes_sent = 0
         # The total number of bytes received.
         self.total_response_bytes_received = 0
         # The total number of secs spent waiting for a responses (so average latency can be calculated by dividing
@@ -127,10 +157,25 @@ class ScalyrClientSession(object):
         self.total_request_latency_secs = 0
         # The total number of HTTP connections successfully created.
         self.total_connections_created = 0
+        # A dict mapping each of the phases in REQUEST_PHASES to a Histogram of the number of seconds requests spent
+        # in it.  A phase is only recorded for the requests that completed it, so for example, requests sent on a
+        # reused connection do not record a connect time.
+        self.__phase_latencies = {}
+        for phase in REQUEST_PHASES:
+            self.__phase_latencies[phase] = scalyr_util.Histogram(scalyr_util.Histogram.exponential_bounds(
+                0.0001, 1.25, 65))
         # The path the file containing the certs for the root certificate authority to use for verifying the SSL
         # connection to Scalyr.  If this is None, then server certificate verification is disabled, and we are
         # susceptible to man-in-the-middle attacks.
         self.__ca_file = ca_file
+        # The SSL context shared by all connections, if the ssl library supports them.  This avoids reloading the
+        # certificates for every new connection.
+        self.__ssl_context = None
+        if __has_ssl__:
+            for endpoint in self.__endpoints:
+                if endpoint.use_ssl:
+                    self.__ssl_context = create_ssl_context(ca_file)
+                    break
 
     def ping(self):
         """Ping the Scalyr server by sending a test message to add zero events.
@@ -153,106 +198,186 @@ class ScalyrClientSession(object):
         @type add_events_request: AddEventsRequest
 
         @return: A tuple containing the status message in the response (such as 'success'), the number of bytes
-            sent, and the full response.
+            in the request counted against its maximum size, and the full response.
+        @rtype: (str, int, str)
+        """
+        return self.__send(add_events_request, None)
+
+    def send_async(self, add_events_request, deadline=None):
+        """Sends an AddEventsRequest to Scalyr on a new thread, returning immediately.
+
+        Any number of requests may be in flight at once, although the same request must not be sent again until
+        its previous send has completed.  If a request has not completed by its deadline, its connection is shut
+        down and it completes with the status 'requestTimedOut'.
+
+        @param add_events_request: The request containing any log lines/events to copy to the server.
+        @param deadline: The time by which the request must complete.  If None, it is request_deadline seconds from
+            now.
+
+        @type add_events_request: AddEventsRequest
+        @type deadline: float
+
+        @return: The in flight request, whose result is the same tuple returned by send.
+        @rtype: PendingRequest
+        """
+        if deadline is None:
+            deadline = time.time() + self.__request_deadline
+
+        pending_request = PendingRequest(deadline)
+        thread = threading.Thread(target=self.__send_in_background, args=(add_events_request, pending_request),
+                                  name='scalyr-send')
+        thread.setDaemon(True)
+        thread.start()
+        return pending_request
+
+    def __send_in_background(self, add_events_request, pending_request):
+        """Sends the request and records its result in pending_request.  Run by the threads created by send_async.
+
+        @param add_events_request: The request to send.
+        @param pending_request: The object to record the result in.
+
+        @type add_events_request: AddEventsRequest
+        @type pending_request: PendingRequest
+        """
+        result = ('requestFailed', 0, '')
+        # noinspection PyBroadException
+        try:
+            result = self.__send(add_events_request, pending_request)
+        except Exception:
+            log.exception('Failed to send request due to exception', error_code='requestFailed')
+        pending_request.set_result(result)
+
+    def __send(self, add_events_request, pending_request):
+        """Sends an AddEventsRequest to Scalyr, as described by the send method.
+
+        This may be invoked by multiple threads at once, so all of the state shared between requests must be
+        accessed while holding the lock.
+
+        @param add_events_request: The request containing any log lines/events to copy to the server.
+        @param pending_request: If not None, the object tracking the request if it is being sent asynchronously.
+            It is given the connection used for the request so that it can be shut down at the deadline.
+
+        @type add_events_request: AddEventsRequest
+        @type pending_request: PendingRequest
+
+        @return: A tuple containing the status message in the response (such as 'success'), the number of bytes
+            in the request counted against its maximum size, and the full response.
         @rtype: (str, int, str)
         """
         current_time = time.time()
 
-        # Refuse to try to send the message if the connection has been recently closed and we have not waited
-        # long enough to try to re-open it.  We do this to avoid excessive connection opens and SYN floods.
-        if self.__last_connection_close is not None and current_time - self.__last_connection_close < 30:
-            return 'client/connectionClosed', 0, ''
+        # Refuse to try to send the message if all of the servers recently failed and we have not waited long enough
+        # to try them again.  The wait doubles with each consecutive failure, so that a transient error only delays
+        # us briefly while we still avoid excessive connection opens and SYN floods when the servers are unavailable.
+        self.__lock.acquire()
+        try:
+            endpoints = self.__get_available_endpoints(current_time)
+            if len(endpoints) == 0:
+                return 'client/connectionClosed', 0, ''
+
+            self.total_requests_sent += 1
+        finally:
+            self.__lock.release()
 
-        self.total_requests_sent += 1
         was_success = False
         bytes_received = 0
-
-        if self.__use_ssl:
-            if not __has_ssl__:
-                log.warn('No ssl library available so cannot verify server certificate when communicating with Scalyr. '
-                         'This means traffic is encrypted but can be intercepted through a man-in-the-middle attack. '
-                         'To solve this, install the Python ssl library. '
-                         'For more details, see https://www.scalyr.com/help/scalyr-agent#ssl',
-                         limit_once_per_x_secs=86400, limit_key='nosslwarning', error_code='client/nossl')
-            elif self.__ca_file is None:
-                log.warn('Server certificate validation has been disabled while communicating with Scalyr. '
-                         'This means traffic is encrypted but can be intercepted through a man-in-the-middle attach. '
-                         'Please update your configuration file to re-enable server certificate validation.',
-                         limit_once_per_x_secs=86400, limit_key='nocertwarning', error_code='client/sslverifyoff')
+        # The number of seconds this request spent in each of the phases it completed, keyed by phase name.
+        phase_latencies = {}
 
         # TODO:  Break this part out into a generic invokeApi method once we need to support
         # multiple Scalyr service API calls.
         response = ''
+        endpoint = None
+        connection = None
         try:
-            try:
-                if self.__connection is None:
-                    if self.__use_ssl:
-                        # If we do not have the SSL library, then we cannot do server certificate validation anyway.
-                        if __has_ssl__:
-                            ca_file = self.__ca_file
-                        else:
-                            ca_file = None
-                        self.__connection = HTTPSConnectionWithTimeoutAndVerification(self.__host, self.__port,
-                                                                                      self.__request_deadline,
-                                                                                      ca_file, __has_ssl__)
-
-                    else:
-                        self.__connection = HTTPConnectionWithTimeout(self.__host, self.__port, self.__request_deadline)
-                    self.__connection.connect()
-                    self.total_connections_created += 1
-            except (socket.error, socket.herror, socket.gaierror), error:
-                if hasattr(error, 'errno'):
-                    errno = error.errno
-                else:
-                    errno = None
-                if __has_ssl__ and isinstance(error, ssl.SSLError):
-                    log.error('Failed to connect to "%s" due to some SSL error.  Possibly the configured certificate '
-                              'for the root Certificate Authority could not be parsed, or we attempted to connect to '
-                              'a server whose certificate could not be trusted (if so, maybe Scalyr\'s SSL cert has '
-                              'changed and you should update your agent to get the new certificate).  The returned '
-                              'errno was %d and the full exception was \'%s\'.  Closing connection, will re-attempt',
-                              self.__full_address, errno, str(error), error_code='client/connectionFailed')
-                elif errno == 61:  # Connection refused
-                    log.error('Failed to connect to "%s" because connection was refused.  Server may be unavailable.',
-                              self.__full_address, error_code='client/connectionFailed')
-                elif errno == 8:  # Unknown name
-                    log.error('Failed to connect to "%s" because could not resolve address.  Server host may be bad.',
-                              self.__full_address, error_code='client/connectionFailed')
-                elif errno is not None:
-                    log.error('Failed to connect to "%s" due to errno=%d.  Exception was %s.  Closing connection, '
-                              'will re-attempt', self.__full_address, errno, str(error),
-                              error_code='client/connectionFailed')
-                else:
-                    log.error('Failed to connect to "%s" due to exception.  Exception was %s.  Closing connection, '
-                              'will re-attempt', self.__full_address, str(error),
-                              error_code='client/connectionFailed')
+            # Prefer reusing an idle keep-alive connection from a previous request.  If we cannot connect to a
+            # server, we fail over to the next available one.
+            is_reused_connection = False
+            for candidate in endpoints:
+                connection = candidate.connection_pool.get(current_time)
+                is_reused_connection = connection is not None
+                if connection is None:
+                    connection = self.__connect(candidate, phase_latencies)
+                if connection is not None:
+                    endpoint = candidate
+                    break
+                self.__lock.acquire()
+                try:
+                    candidate.record_failure(time.time())
+                finally:
+                    self.__lock.release()
+
+            if endpoint is None:
                 return 'client/connectionFailed', 0, ''
+            if pending_request is not None:
+                pending_request.set_connection(connection)
+
+            self.__lock.acquire()
+            try:
+                endpoint.in_flight += 1
+            finally:
+                self.__lock.release()
 
             # Update the time that request it is being sent, according the client's clock.
+            serialize_start_time = time.time()
             add_events_request.set_client_time(current_time)
 
-            body_str = add_events_request.get_payload()
-
-            self.total_request_bytes_sent += len(body_str)
+            # The request compresses its body as events are added, if compression is enabled.  Only the last
+            # segment depends on the client time, so resending a request does not copy its events again.
+            body_segments = add_events_request.get_payload_segments()
+            body_length = 0
+            for segment in body_segments:
+                body_length += len(segment)
+            # We report the size that counts against the request's maximum size to the caller.
+            body_size = add_events_request.get_size()
+            phase_latencies['serialize'] = time.time() - serialize_start_time
+
+            self.__lock.acquire()
+            try:
+                self.total_uncompressed_request_bytes_sent += add_events_request.get_uncompressed_size()
+                if self.__compression_type != 'none':
+                    self.total_compressed_request_bytes_sent += body_length
+                self.total_request_bytes_sent += body_length
+            finally:
+                self.__lock.release()
 
             # noinspection PyBroadException
             try:
-                log.log(scalyr_logging.DEBUG_LEVEL_5, 'Sending POST /addEvents with body \"%s\"', body_str)
-                self.__connection.request('POST', '/addEvents', body=body_str,
-                                          headers=self.__standard_headers)
-
-                response = self.__connection.getresponse().read()
+                if self.__compression_type == 'none':
+                    log.log(scalyr_logging.DEBUG_LEVEL_5, 'Sending POST /addEvents with body \"%s\"',
+                            add_events_request)
+                try:
+                    response = self.__send_segments(connection, '/addEvents', body_segments, body_length,
+                                                    phase_latencies)
+                except Exception, error:
+                    if not is_reused_connection or (pending_request is not None and pending_request.is_timed_out()):
+                        raise
+                    # The server may have closed the idle connection after our health check passed.  That is
+                    # expected with keep-alive connections, so we just retry once on a new connection.
+                    log.log(scalyr_logging.DEBUG_LEVEL_1, 'Reused connection to "%s" failed due to %s, retrying '
+                            'on a new connection', endpoint.full_address, str(error))
+                    connection.close()
+                    connection = self.__connect(endpoint, phase_latencies)
+                    if connection is None:
+                        return 'client/connectionFailed', body_size, ''
+                    if pending_request is not None:
+                        pending_request.set_connection(connection)
+                    response = self.__send_segments(connection, '/addEvents', body_segments, body_length,
+                                                    phase_latencies)
                 bytes_received = len(response)
             except Exception, error:
                 # TODO: Do not just catch Exception.  Do narrower scope.
-                if hasattr(error, 'errno'):
+                if pending_request is not None and pending_request.is_timed_out():
+                    log.warn('Request to "%s" did not complete before its deadline.  Closing connection, will '
+                             're-attempt', endpoint.full_address, error_code='client/requestTimedOut')
+                elif getattr(error, 'errno', None) is not None:
                     log.error('Failed to connect to "%s" due to errno=%d.  Exception was %s.  Closing connection, '
-                              'will re-attempt', self.__full_address, error.errno, str(error),
+                              'will re-attempt', endpoint.full_address, error.errno, str(error),
                               error_code='client/requestFailed')
                 else:
                     log.exception('Failed to send request due to exception.  Closing connection, will re-attempt',
                                   error_code='requestFailed')
-                return 'requestFailed', len(body_str), response
+                return 'requestFailed', body_size, response
 
             log.log(scalyr_logging.DEBUG_LEVEL_5, 'Response was received with body \"%s\"', response)
 
@@ -260,18 +385,22 @@ class ScalyrClientSession(object):
             if len(response) == 0:
                 log.error('Received empty response, server may have reset connection.  Will re-attempt',
                           error_code='emptyResponse')
-                return 'emptyResponse', len(body_str), response
+                return 'emptyResponse', body_size, response
 
-            # Try to parse the response
+            # Try to parse the response.  The status is the only field we need, so the common case of a successful
+            # response is recognized without running the full parser.
             # noinspection PyBroadException
             try:
-                response_as_json = json_lib.parse(response)
+                if SUCCESS_RESPONSE_PATTERN.match(response) is not None:
+                    response_as_json = {'status': 'success'}
+                else:
+                    response_as_json = json_lib.parse(response)
             except Exception:
                 # TODO: Do not just catch Exception.  Do narrower scope.  Also, log error here.
                 log.exception('Failed to parse response of \'%s\' due to exception.  Closing connection, will '
                               're-attempt', scalyr_util.remove_newlines_and_truncate(response, 1000),
                               error_code='parseResponseFailed')
-                return 'parseResponseFailed', len(body_str), response
+                return 'parseResponseFailed', body_size, response
 
             self.__last_success = current_time
 
@@ -281,36 +410,216 @@ class ScalyrClientSession(object):
                     was_success = True
                 elif status == 'error/client/badParam':
                     log.error('Request to \'%s\' failed due to a bad parameter value.  This may be caused by an '
-                              'invalid write logs api key in the configuration', self.__full_address,
+                              'invalid write logs api key in the configuration', endpoint.full_address,
                               error_code='error/client/badParam')
                 else:
                     log.error('Request to \'%s\' failed due to an error.  Returned error code was \'%s\'',
-                              self.__full_address, status, error_code='error/client/badParam')
-                return status, len(body_str), response
+                              endpoint.full_address, status, error_code='error/client/badParam')
+                return status, body_size, response
             else:
                 log.error('No status message provided in response.  Unknown error.  Response was \'%s\'',
                           scalyr_util.remove_newlines_and_truncate(response, 1000), error_code='unknownError')
-                return 'unknownError', len(body_str), response
+                return 'unknownError', body_size, response
+
+        finally:
+            end_time = time.time()
+            if not was_success and connection is not None:
+                connection.close()
+
+            self.__lock.acquire()
+            try:
+                self.total_request_latency_secs += (end_time - current_time)
+                if not was_success:
+                    self.total_requests_failed += 1
+                if endpoint is not None:
+                    endpoint.in_flight -= 1
+                    if was_success:
+                        # Keep the connection open so that it can be used by the next request.
+                        endpoint.connection_pool.put(connection, end_time)
+                        endpoint.record_success(end_time, end_time - current_time)
+                    else:
+                        endpoint.record_failure(end_time)
+                self.total_response_bytes_received += bytes_received
+                for phase, latency in phase_latencies.iteritems():
+                    self.__phase_latencies[phase].add(latency)
+            finally:
+                self.__lock.release()
+
+    def get_request_phase_status(self):
+        """Returns the distribution of the time requests have spent in each of their phases.
 
+        @return: A status object for each of the phases in REQUEST_PHASES, in order.
+        @rtype: list of RequestPhaseStatus
+        """
+        self.__lock.acquire()
+        try:
+            result = []
+            for phase in REQUEST_PHASES:
+                latencies = self.__phase_latencies[phase]
+                phase_status = RequestPhaseStatus()
+                phase_status.phase = phase
+                phase_status.count = latencies.count()
+                phase_status.average = latencies.average()
+                phase_status.p50 = latencies.percentile(50)
+                phase_status.p99 = latencies.percentile(99)
+                result.append(phase_status)
+            return result
         finally:
-            self.total_request_latency_secs += (time.time() - current_time)
-            if not was_success:
-                self.total_requests_failed += 1
-                self.close(current_time=current_time)
-            self.total_response_bytes_received += bytes_received
+            self.__lock.release()
+
+    def __get_available_endpoints(self, current_time):
+        """Returns the servers that may be sent a request, in the order they should be tried.
 
-    def close(self, current_time=None):
-        """Closes the underlying connection to the Scalyr server.
+        The lock must be held when invoking this method.
 
-        @param current_time: If not None, the time to use for the current time.  Used for testing purposes.
-        @type current_time: float or None
+        @param current_time: The current time.
+        @type current_time: float
+
+        @rtype: list of ServerEndpoint
         """
-        if self.__connection is not None:
-            if current_time is None:
-                current_time = time.time()
-            self.__connection.close()
-            self.__connection = None
-            self.__last_connection_close = current_time
+        result = []
+        for endpoint in self.__endpoints:
+            if endpoint.is_available(current_time):
+                result.append(endpoint)
+
+        if self.__load_balance:
+            # The sort is stable, so servers that are equally good are still tried in the order they were given.
+            result.sort(key=lambda x: (x.in_flight, x.get_expected_latency(current_time)))
+        return result
+
+    def __connect(self, endpoint, phase_latencies):
+        """Opens a new connection to the specified server.
+
+        @param endpoint: The server.
+        @param phase_latencies: The dict to record the time spent in the 'connect' and 'tls' phases in, if the
+            connection is opened.
+
+        @type endpoint: ServerEndpoint
+        @type phase_latencies: dict
+
+        @return: The connection, or None if it could not be opened.  The error is logged.
+        @rtype: httplib.HTTPConnection
+        """
+        if endpoint.use_ssl:
+            if not __has_ssl__:
+                log.warn('No ssl library available so cannot verify server certificate when communicating with Scalyr. '
+                         'This means traffic is encrypted but can be intercepted through a man-in-the-middle attack. '
+                         'To solve this, install the Python ssl library. '
+                         'For more details, see https://www.scalyr.com/help/scalyr-agent#ssl',
+                         limit_once_per_x_secs=86400, limit_key='nosslwarning', error_code='client/nossl')
+            elif self.__ca_file is None:
+                log.warn('Server certificate validation has been disabled while communicating with Scalyr. '
+                         'This means traffic is encrypted but can be intercepted through a man-in-the-middle attach. '
+                         'Please update your configuration file to re-enable server certificate validation.',
+                         limit_once_per_x_secs=86400, limit_key='nocertwarning', error_code='client/sslverifyoff')
+
+        try:
+            if endpoint.use_ssl:
+                # If we do not have the SSL library, then we cannot do server certificate validation anyway.
+                if __has_ssl__:
+                    ca_file = self.__ca_file
+                else:
+                    ca_file = None
+                connection = HTTPSConnectionWithTimeoutAndVerification(endpoint.host, endpoint.port,
+                                                                       self.__request_deadline,
+                                                                       ca_file, __has_ssl__,
+                                                                       ssl_context=self.__ssl_context)
+
+            else:
+                connection = HTTPConnectionWithTimeout(endpoint.host, endpoint.port, self.__request_deadline)
+            connect_start_time = time.time()
+            connection.connect()
+            connect_time = time.time() - connect_start_time
+
+            # The handshake is only timed separately if we wrapped the socket ourselves.
+            tls_handshake_secs = getattr(connection, 'tls_handshake_secs', None)
+            if tls_handshake_secs is not None:
+                phase_latencies['tls'] = tls_handshake_secs
+                connect_time -= tls_handshake_secs
+            phase_latencies['connect'] = connect_time
+
+            self.__lock.acquire()
+            try:
+                self.total_connections_created += 1
+            finally:
+                self.__lock.release()
+            return connection
+        except (socket.error, socket.herror, socket.gaierror), error:
+            if hasattr(error, 'errno'):
+                errno = error.errno
+            else:
+                errno = None
+            if __has_ssl__ and isinstance(error, ssl.SSLError):
+                log.error('Failed to connect to "%s" due to some SSL error.  Possibly the configured certificate '
+                          'for the root Certificate Authority could not be parsed, or we attempted to connect to '
+                          'a server whose certificate could not be trusted (if so, maybe Scalyr\'s SSL cert has '
+                          'changed and you should update your agent to get the new certificate).  The returned '
+                          'errno was %d and the full exception was \'%s\'.  Closing connection, will re-attempt',
+                          endpoint.full_address, errno, str(error), error_code='client/connectionFailed')
+            elif errno == 61:  # Connection refused
+                log.error('Failed to connect to "%s" because connection was refused.  Server may be unavailable.',
+                          endpoint.full_address, error_code='client/connectionFailed')
+            elif errno == 8:  # Unknown name
+                log.error('Failed to connect to "%s" because could not resolve address.  Server host may be bad.',
+                          endpoint.full_address, error_code='client/connectionFailed')
+            elif errno is not None:
+                log.error('Failed to connect to "%s" due to errno=%d.  Exception was %s.  Closing connection, '
+                          'will re-attempt', endpoint.full_address, errno, str(error),
+                          error_code='client/connectionFailed')
+            else:
+                log.error('Failed to connect to "%s" due to exception.  Exception was %s.  Closing connection, '
+                          'will re-attempt', endpoint.full_address, str(error),
+                          error_code='client/connectionFailed')
+            return None
+
+    def __send_segments(self, connection, path, body_segments, body_length, phase_latencies):
+        """Sends a POST request whose body is made up of the specified segments and returns the response.
+
+        Large bodies are written one segment at a time rather than being copied into a single string.  Small
+        bodies are joined and sent along with the headers, since writing a short segment after the headers can
+        be delayed by the interaction between Nagle's algorithm and delayed acks.
+
+        @param connection: The connection to send the request on.
+        @param path: The path to post to.
+        @param body_segments: The strings making up the body, in order.
+        @param body_length: The total number of bytes in body_segments.
+        @param phase_latencies: The dict to record the time spent in the 'write', 'first_byte', and 'read' phases in.
+
+        @type connection: httplib.HTTPConnection
+        @type path: str
+        @type body_segments: list of str
+        @type body_length: int
+        @type phase_latencies: dict
+
+        @return: The body of the response.
+        @rtype: str
+        """
+        write_start_time = time.time()
+        if body_length < MIN_SEGMENTED_BODY_SIZE:
+            connection.request('POST', path, body=''.join(body_segments), headers=self.__standard_headers)
+        else:
+            connection.putrequest('POST', path)
+            for header_name, header_value in self.__standard_headers.iteritems():
+                connection.putheader(header_name, header_value)
+            connection.putheader('Content-Length', str(body_length))
+            connection.endheaders()
+            for segment in body_segments:
+                connection.send(segment)
+
+        # The time until the response's status line and headers are received is the time to the first byte.
+        response_start_time = time.time()
+        phase_latencies['write'] = response_start_time - write_start_time
+        http_response = connection.getresponse()
+        read_start_time = time.time()
+        phase_latencies['first_byte'] = read_start_time - response_start_time
+        result = http_response.read()
+        phase_latencies['read'] = time.time() - read_start_time
+        return result
+
+    def close(self):
+        """Closes the underlying connections to the Scalyr servers."""
+        for endpoint in self.__endpoints:
+            endpoint.connection_pool.close()
 
     def add_events_request(self, session_info=None, max_size=1*1024*1024*1024):
         """Creates and returns a new AddEventRequest that can be later sent by this session.
@@ -337,7 +646,16 @@ class ScalyrClientSession(object):
         if session_info is not None:
             body['sessionInfo'] = session_info
 
-        return AddEventsRequest(body, max_size=max_size)
+        # The api key and session id never change, so the prefix only has to be recreated if the session info does.
+        serialized_session_info = json_lib.serialize(session_info, use_fast_encoding=True)
+        if serialized_session_info != self.__last_session_info:
+            self.__last_request_prefix = AddEventsRequest.create_prefix(body)
+            self.__last_session_info = serialized_session_info
+
+        return AddEventsRequest(body, max_size=max_size, compression_type=self.__compression_type,
+                                compression_level=self.__compression_level,
+                                limit_compressed_size=self.__limit_compressed_size,
+                                prefix=self.__last_request_prefix, buffer_pool=self.__buffer_pool)
 
     @staticmethod
     def __get_user_agent(agent_version):
@@ -407,8 +725,15 @@ class AddEventsRequest(object):
     It will also prevent you from exceeding the maximum request size.  Third, you may undo the effect of adding events
     to the request before it is sent.  This is useful to rollback the request state to a previous state if some
     problem occurs.
+
+    If a compression type is given, the events are fed into a compressor as they are added, so that the body is
+    compressed incrementally and the full uncompressed body is never held in memory.  The compressed body is
+    assembled by hand from a raw deflate stream so that the trailing portion holding the client time can be
+    compressed separately, allowing it to be updated without compressing the events again.  In this mode, only the
+    most recently returned position may be passed to set_position.
     """
-    def __init__(self, base_body, max_size=1*1024*1024):
+    def __init__(self, base_body, max_size=1*1024*1024, compression_type='none', compression_level=6,
+                 limit_compressed_size=False, prefix=None, buffer_pool=None):
         """Initializes the instance.
 
         @param base_body: A JsonObject or dict containing the information to send as the body of the add_events
@@ -416,50 +741,28 @@ class AddEventsRequest(object):
             included because they will be added later. Note, base_body must have some fields set, such as 'ts' which is
             required by the server.
         @param max_size: The maximum number of bytes this request can consume when it is serialized to JSON.
+        @param compression_type: The encoding to use to compress the body.  Must be one of 'deflate', 'gzip', or
+            'none'.
+        @param compression_level: The zlib compression level to use, from 1 (fastest) to 9 (smallest).
+        @param limit_compressed_size: If True, max_size limits the size of the compressed body rather than the size
+            of the serialized JSON.  The compressor is flushed each time it is fed so that its output size is known,
+            but the events that have not been fed to it yet are counted at their full size.
+        @param prefix: If not None, the value returned by create_prefix for base_body.  This avoids serializing
+            base_body again when many requests are created with the same body.
+        @param buffer_pool: If not None, the pool to take the buffer used to serialize the request from.  The
+            buffer is returned to the pool when close is invoked.
         """
-        assert len(base_body) > 0, "The base_body object must have some fields defined."
-        assert not 'events' in base_body, "The base_body object cannot already have 'events' set."
-        assert not 'client_time' in base_body, "The base_body object cannot already have 'client_time' set."
-
-        # As an optimization, we use a StringIO object to serialize the request.  We also
-        # do a little bit of the JSON object assembly by hand.  Specifically, we serialize the request
-        # to JSON without the 'events' field, but then delete the last '}' so that we can manually
-        # add in the 'events: [ ... ]' ourselves.  This way we can watch the size of the buffer as
-        # we build up events.
-        string_buffer = StringIO()
-        json_lib.serialize(base_body, output=string_buffer, use_fast_encoding=True)
-
-        # Now go back and find the last '}' and delete it so that we can open up the JSON again.
-        location = string_buffer.tell()
-        while location > 0:
-            location -= 1
-            string_buffer.seek(location)
-            if string_buffer.read(1) == '}':
-                break
-
-        # Now look for the first non-white character.  We need to add in a comma after it.
-        last_char = None
-        while location > 0:
-            location -= 1
-            string_buffer.seek(location)
-            last_char = string_buffer.read(1)
-            if not last_char.isspace():
-                break
-
-        # If the character happened to a comma, back up over that since we want to write our own comma.
-        if location > 0 and last_char == ',':
-            location -= 1
-
-        if location < 0:
-            raise Exception('Could not locate trailing "}" and non-whitespace in base JSON for add events request')
-
-        # Now chop off everything after the character at the location.
-        location += 1
-        string_buffer.seek(location)
-        string_buffer.truncate()
-
-        # Append the start of our events field.
-        string_buffer.write(', events: [')
+        if prefix is None:
+            prefix = AddEventsRequest.create_prefix(base_body)
+
+        # As an optimization, we use a StringIO object to serialize the request.  The events are serialized
+        # directly into it after the prefix, so that we can watch the size of the buffer as we build up events.
+        self.__buffer_pool = buffer_pool
+        if buffer_pool is not None:
+            string_buffer = buffer_pool.get()
+        else:
+            string_buffer = StringIO()
+        string_buffer.write(prefix)
 
         # The string that must be append after all of the events to terminate the JSON.  We will
         # later replace TIMESTAMP with the real timestamp.
@@ -470,15 +773,56 @@ class AddEventsRequest(object):
         # is being reused to send the events again.
         self.__client_time = time.time()
 
+        # Holds the serialized JSON that has not yet been fed to the compressor.  If there is no compression, this
+        # holds the entire body.
         self.__buffer = string_buffer
         self.__max_size = max_size
+        # The number of bytes of serialized JSON in the request, including the post fix.
         self.__current_size = self.__buffer.tell() + len(self.__get_post_fix(self.__client_time))
 
         self.__events_added = 0
 
-        # If we have finished serializing the body, it is stored here until the close() method is invoked.
+        # Once we have finished serializing the body, this holds everything up to and including the events, which
+        # does not change when the request is resent.  It is kept until the close() method is invoked.
+        self.__events = None
+        # The end of the body following the events, which depends on the client time.  This is None if it has not
+        # been created for the current client time.
+        self.__tail = None
+        # The complete body, if get_payload has been invoked for the current client time.
         self.__body = None
 
+        self.__compression_type = compression_type
+        self.__compression_level = compression_level
+        self.__limit_compressed_size = limit_compressed_size
+        # The raw deflate compressor the body is fed to, or None if the body is not compressed.
+        self.__compressor = None
+        if compression_type != 'none':
+            self.__compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            if compression_type == 'gzip':
+                self.__compressed_chunks = [GZIP_HEADER]
+                self.__checksum = zlib.crc32('')
+            else:
+                # The zlib header depends only on the compression level, so we just take it from zlib itself.
+                self.__compressed_chunks = [zlib.compress('', compression_level)[:2]]
+                self.__checksum = zlib.adler32('')
+            # The number of bytes in __compressed_chunks.
+            self.__compressed_size = len(self.__compressed_chunks[0])
+            # The number of bytes fed to the compressor.
+            self.__compressed_input_size = 0
+            # The maximum number of bytes of serialized JSON to buffer before feeding it to the compressor.  When
+            # limiting the compressed size, the buffered bytes are counted at full size, so we keep fewer of them.
+            self.__max_buffer_size = MAX_UNCOMPRESSED_BUFFER_SIZE
+            if limit_compressed_size:
+                self.__max_buffer_size = max(MIN_UNCOMPRESSED_BUFFER_SIZE,
+                                             min(MAX_UNCOMPRESSED_BUFFER_SIZE, max_size / 8))
+
+        # The number of times position has been invoked.  Used to verify set_position is only invoked with the
+        # latest position when compressing.
+        self.__position_count = 0
+        # The state of the compressor at the last position, if events have been fed to it since then.  It is
+        # restored if we are rolled back to that position.
+        self.__rollback_state = None
+
     def add_event(self, event, timestamp=None):
         """Adds the serialized JSON for event if it does not cause the maximum request size to be exceeded.
 
@@ -493,25 +837,78 @@ class AddEventsRequest(object):
         @return: True if the event's serialized JSON was added to the request, or False if that would have resulted
             in the maximum request size being exceeded so it did not.
         """
-        start_pos = self.__buffer.tell()
+        if 'ts' in event:
+            del event['ts']
+        return self.add_serialized_event(self.serialize_event(event), timestamp=timestamp)
+
+    def serialize_event(self, event):
+        """Serializes an event so that it can be passed to add_serialized_event.
+
+        Callers that may have to retry adding an event to a later request should serialize it once using this
+        method and hold on to the result, rather than paying for the serialization again.
+
+        @param event: The event object, usually a dict or a JsonObject.  It must not have a 'ts' field since that is
+            added when the event is added to a request.
+        @type event: dict or JsonObject
+
+        @return: The serialized JSON for the event.
+        @rtype: str
+        """
+        # The server does not care about the order of the fields, so we skip sorting them.  This lets json_lib use
+        # the much faster C encoder when it is available.
+        return json_lib.serialize(event, use_fast_encoding=True, sort_keys=False)
+
+    def add_serialized_event(self, serialized_event, timestamp=None):
+        """Adds an event serialized by serialize_event if it does not cause the maximum request size to be exceeded.
+
+        A 'ts' field holding a new timestamp is added to the event, as described by add_event.  The size of the
+        event is computed before anything is written, so an event that does not fit leaves the request untouched and
+        may be added to another request without serializing it again.
+
+        It is illegal to invoke this method if 'get_payload' has already been invoked.
+
+        @param serialized_event: The serialized event.
+        @param timestamp: The timestamp to use for the event. This should only be used for testing.
+
+        @type serialized_event: str
+        @type timestamp: long
+
+        @return: True if the event was added to the request, or False if that would have resulted in the maximum
+            request size being exceeded so it did not.
+        @rtype: bool
+        """
         # If we already added an event before us, then make sure we add in a comma to separate us from the last event.
         if self.__events_added > 0:
-            self.__buffer.write(',')
+            separator = ','
+        else:
+            separator = ''
+
+        # The timestamp is added as the last field of the event, replacing its closing brace.
+        if serialized_event == '{}':
+            timestamp_prefix = '"ts":"'
+        else:
+            timestamp_prefix = ',"ts":"'
 
         if timestamp is None:
             timestamp = self.__get_timestamp()
+        timestamp_str = str(timestamp)
 
-        event['ts'] = str(timestamp)
-        json_lib.serialize(event, output=self.__buffer, use_fast_encoding=True)
-        size = self.__buffer.tell() - start_pos
-
-        # Check if we exceeded the size, if so chop off what we just added.
-        if self.__current_size + size > self.__max_size:
-            self.__buffer.truncate(start_pos)
+        size = len(separator) + len(serialized_event) + len(timestamp_prefix) + len(timestamp_str) + 1
+        if self.get_size() + size > self.__max_size:
             return False
 
+        self.__buffer.write(separator)
+        self.__buffer.write(serialized_event[:-1])
+        self.__buffer.write(timestamp_prefix)
+        self.__buffer.write(timestamp_str)
+        self.__buffer.write('"}')
+
         self.__current_size += size
         self.__events_added += 1
+
+        # Do not let too many bytes accumulate before compressing them.
+        if self.__compressor is not None and self.__buffer.tell() >= self.__max_buffer_size:
+            self.__compress_buffer(True)
         return True
 
     def set_client_time(self, current_time):
@@ -527,43 +924,195 @@ class AddEventsRequest(object):
         @param current_time: The current time to include in the request.
         @type current_time: float
         """
-        if self.__body is not None:
-            # We have already cached the serialized JSON, so we need to update it to remain consistent.
-            old_post_fix = self.__get_post_fix(self.__client_time)
-            new_post_fix = self.__get_post_fix(current_time)
-
-            # Create a buffer for the copying.  We write in the entire JSON and then just back up the length of
-            # the old postfix to then add in the new one.
-            rebuild_buffer = StringIO()
-            rebuild_buffer.write(self.__body)
-            self.__body = None
-            rebuild_buffer.seek(-1 * len(old_post_fix), os.SEEK_END)
-            rebuild_buffer.truncate()
-            rebuild_buffer.write(new_post_fix)
-            self.__body = rebuild_buffer.getvalue()
-            rebuild_buffer.close()
-
+        # Only the end of the body depends on the client time, so that is all we have to recreate.
         self.__client_time = current_time
+        self.__tail = None
+        self.__body = None
 
     def get_payload(self):
         """Returns the serialized JSON to use as the body for the add_request.
 
+        If a compression type was specified, the returned body is compressed.
+
         After this is invoked, no new events can be added via the 'add_event' method.  However,
         you may call the 'set_client_time' method to update when this request is being sent, according to
         the client clock.
         """
         if self.__body is None:
-            self.__buffer.write(self.__get_post_fix(self.__client_time))
-            self.__body = self.__buffer.getvalue()
-            self.__buffer.close()
-            self.__buffer = None
+            self.__body = ''.join(self.get_payload_segments())
         return self.__body
 
+    def get_payload_segments(self):
+        """Returns the body for the add_request as a list of strings which must be sent in order.
+
+        This is the same as get_payload, except that the body is not copied into a single string.  The segment
+        holding the events is only created once, so a request that is resent does not have to copy its events
+        again.  The same restrictions as get_payload apply after this is invoked.
+
+        @rtype: list of str
+        """
+        if self.__events is None:
+            if self.__compressor is not None:
+                # Compress any remaining events.  Ending with a sync flush lets us append a separately compressed
+                # post fix for each client time.
+                self.__compress_buffer(False)
+                self.__compressed_chunks.append(self.__compressor.flush(zlib.Z_SYNC_FLUSH))
+                self.__compressor = None
+                self.__rollback_state = None
+                self.__events = ''.join(self.__compressed_chunks)
+                self.__compressed_chunks = None
+            else:
+                self.__events = self.__buffer.getvalue()
+            self.__release_buffer()
+
+        if self.__tail is None:
+            if self.__compression_type != 'none':
+                self.__tail = self.__get_compressed_post_fix(self.__client_time)
+            else:
+                self.__tail = self.__get_post_fix(self.__client_time)
+        return [self.__events, self.__tail]
+
+    def __str__(self):
+        """Returns the body of the request.  This is only used for debug logging, so the body is only copied into a
+        single string if it is actually logged."""
+        return self.get_payload()
+
+    def get_size(self):
+        """Returns the number of bytes the request counts against its maximum size.
+
+        This is the size of the serialized JSON, unless limit_compressed_size was specified, in which case it is
+        the size of the compressed body (or an estimate of it if get_payload has not been invoked yet).
+
+        @rtype: int
+        """
+        if not self.__limit_compressed_size or self.__compression_type == 'none':
+            return self.__current_size
+        if self.__events is not None:
+            return len(self.__events) + len(self.get_payload_segments()[1])
+        return (self.__compressed_size + self.__buffer.tell() +
+                len(self.__get_post_fix(self.__client_time)) + COMPRESSED_TRAILER_ALLOWANCE)
+
+    def get_uncompressed_size(self):
+        """Returns the number of bytes in the serialized JSON for the request, before any compression.
+
+        @rtype: int
+        """
+        size = len(self.__get_post_fix(self.__client_time))
+        if self.__compression_type == 'none' and self.__events is not None:
+            return size + len(self.__events)
+
+        if self.__buffer is not None:
+            size += self.__buffer.tell()
+        if self.__compression_type != 'none':
+            size += self.__compressed_input_size
+        return size
+
     def close(self):
         """Must be invoked after this request is no longer needed.  You may not add events or invoke get_payload
         after this call.
         """
         self.__body = None
+        self.__events = None
+        self.__tail = None
+        self.__compressed_chunks = None
+        self.__release_buffer()
+
+    @staticmethod
+    def create_prefix(base_body):
+        """Returns the start of the serialized JSON for an add events request with the specified body, up to and
+        including the opening of the events array.
+
+        We do a little bit of the JSON object assembly by hand.  Specifically, we serialize the body to JSON without
+        the 'events' field, but then delete the last '}' so that we can manually add in the 'events: [ ... ]'
+        ourselves.
+
+        @param base_body: A JsonObject or dict containing the information to send as the body of the add_events
+            request, with the exception of the events field.
+        @type base_body: dict
+
+        @rtype: str
+        """
+        assert len(base_body) > 0, "The base_body object must have some fields defined."
+        assert not 'events' in base_body, "The base_body object cannot already have 'events' set."
+        assert not 'client_time' in base_body, "The base_body object cannot already have 'client_time' set."
+
+        serialized = json_lib.serialize(base_body, use_fast_encoding=True).rstrip()
+        if not serialized.endswith('}'):
+            raise Exception('Could not locate trailing "}" and non-whitespace in base JSON for add events request')
+
+        # Remove the last '}' as well as any comma before it, since we want to write our own comma.
+        serialized = serialized[:-1].rstrip()
+        if serialized.endswith(','):
+            serialized = serialized[:-1]
+
+        return serialized + ', events: ['
+
+    def __release_buffer(self):
+        """Releases the serialization buffer, returning it to the pool if there is one."""
+        if self.__buffer is not None:
+            if self.__buffer_pool is not None:
+                self.__buffer_pool.put(self.__buffer)
+            else:
+                self.__buffer.close()
+            self.__buffer = None
+
+    def __compress_buffer(self, save_rollback_state):
+        """Feeds the serialized JSON that has not yet been compressed to the compressor.
+
+        @param save_rollback_state: If True and the compressor has not been fed since the last position was
+            returned, saves the compressor's state so that set_position can restore it.  If the state cannot be
+            saved, the JSON is left in the buffer.
+        @type save_rollback_state: bool
+        """
+        if save_rollback_state and self.__position_count > 0 and self.__rollback_state is None:
+            # Copying the compressor is only supported in Python 2.5 and greater.
+            if not hasattr(self.__compressor, 'copy'):
+                return
+            self.__rollback_state = (self.__compressor.copy(), len(self.__compressed_chunks), self.__compressed_size,
+                                     self.__compressed_input_size, self.__checksum)
+
+        data = self.__buffer.getvalue()
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+
+        if self.__compression_type == 'gzip':
+            self.__checksum = zlib.crc32(data, self.__checksum)
+        else:
+            self.__checksum = zlib.adler32(data, self.__checksum)
+        self.__compressed_input_size += len(data)
+
+        output = self.__compressor.compress(data)
+        if self.__limit_compressed_size:
+            # Flush the compressor so that we know exactly how large its output is.  The flush does not reset the
+            # compression dictionary, so this only costs a few bytes each time.
+            output += self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if len(output) > 0:
+            self.__compressed_chunks.append(output)
+            self.__compressed_size += len(output)
+
+    def __get_compressed_post_fix(self, client_time):
+        """Returns the end of the compressed body, including the compressed post fix and the stream trailer.
+
+        The post fix is compressed by its own raw deflate compressor.  Since the compressed events end with a sync
+        flush, the two streams can simply be concatenated.
+
+        @param client_time: The time in seconds past epoch to include in this request for the client time.
+
+        @return: The end of the compressed body.
+        @rtype: str
+        """
+        post_fix = self.__get_post_fix(client_time)
+        compressor = zlib.compressobj(self.__compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(post_fix) + compressor.flush()
+
+        if self.__compression_type == 'gzip':
+            checksum = zlib.crc32(post_fix, self.__checksum) & 0xffffffffL
+            total_size = self.__compressed_input_size + len(post_fix)
+            return compressed + struct.pack('<LL', checksum, total_size & 0xffffffffL)
+        else:
+            checksum = zlib.adler32(post_fix, self.__checksum) & 0xffffffffL
+            return compressed + struct.pack('>L', checksum)
 
     def __get_post_fix(self, client_time):
         """Returns the string that should be appended after the events JSON array to complete the
@@ -590,9 +1139,18 @@ class AddEventsRequest(object):
 
     def position(self):
         """Returns a position such that if it is passed to 'set_position', all events added since this method was
-        invoked are removed."""
+        invoked are removed.
 
-        return AddEventsRequest.Position(self.__current_size, self.__events_added, self.__buffer.tell())
+        If the request is being compressed, this position is only valid until the next time this method is invoked.
+        """
+        if self.__compressor is not None:
+            # Everything before this position can no longer be rolled back, so it can be compressed.
+            self.__compress_buffer(False)
+            self.__rollback_state = None
+
+        self.__position_count += 1
+        return AddEventsRequest.Position(self.__current_size, self.__events_added, self.__buffer.tell(),
+                                         self.__position_count)
 
     def set_position(self, position):
         """Reverts this object to only contain the events contained by the object when position was invoked to
@@ -600,6 +1158,15 @@ class AddEventsRequest(object):
 
         @param position: The position token representing the previous state.
         """
+        if self.__compressor is not None:
+            if position.position_count != self.__position_count:
+                raise Exception('Only the latest position may be restored when compressing an AddEventsRequest')
+            if self.__rollback_state is not None:
+                (self.__compressor, num_chunks, self.__compressed_size, self.__compressed_input_size,
+                 self.__checksum) = self.__rollback_state
+                del self.__compressed_chunks[num_chunks:]
+                self.__rollback_state = None
+
         self.__current_size = position.current_size
         self.__events_added = position.events_added
         self.__buffer.truncate(position.buffer_size)
@@ -607,10 +1174,490 @@ class AddEventsRequest(object):
     class Position(object):
         """Represents a position in the added events.
         """
-        def __init__(self, current_size, events_added, buffer_size):
+        def __init__(self, current_size, events_added, buffer_size, position_count):
             self.current_size = current_size
             self.events_added = events_added
             self.buffer_size = buffer_size
+            self.position_count = position_count
+
+
+class EventSerializer(object):
+    """Serializes the events for the lines copied from a single log so they can be passed to
+    AddEventsRequest.add_serialized_event.
+
+    Every event for a log has the same form:  an 'attrs' field holding the log's attributes along with the line in a
+    'message' field and, if the line was sampled, a 'sample_rate' field.  Rather than building a dict for each line
+    and having json_lib sort and dispatch on every key, the log's attributes are serialized once and each event is
+    written with its fields in a fixed order.  The 'ts' field is added by add_serialized_event.
+    """
+    def __init__(self, log_attributes):
+        """Initializes the serializer.
+
+        @param log_attributes: The attributes to include on all events for the log.  Any 'message' entry is ignored
+            and any 'sample_rate' entry is only used for events whose lines were not sampled.
+        @type log_attributes: dict
+        """
+        attributes = {}
+        for key, value in log_attributes.iteritems():
+            if key != 'message' and key != 'sample_rate':
+                attributes[key] = value
+
+        # What to write at the end of each event whose line was not sampled.
+        if 'sample_rate' in log_attributes:
+            self.__unsampled_suffix = ',"sample_rate":%s}}' % json_lib.serialize(log_attributes['sample_rate'],
+                                                                                 use_fast_encoding=True)
+        else:
+            self.__unsampled_suffix = '}}'
+
+        # Everything that comes before the serialized message in each event.
+        if len(attributes) > 0:
+            self.__prefix = '{"attrs":%s,"message":' % json_lib.serialize(attributes, use_fast_encoding=True)[:-1]
+        else:
+            self.__prefix = '{"attrs":{"message":'
+
+    def serialize(self, message, sample_rate=1.0):
+        """Returns the serialized JSON for the event for the specified line.
+
+        This is equivalent to serializing {'attrs': attributes} with json_lib.serialize, where attributes holds the
+        log's attributes, message, and sample_rate (if it is not 1.0), except for the order of the fields.
+
+        @param message: The line to send.
+        @param sample_rate: The sampling rate that was used to decide if the line should be sent.
+
+        @type message: str
+        @type sample_rate: float
+
+        @return: The serialized event.
+        @rtype: str
+        """
+        # We use unsorted serialization for the message since it allows json_lib to use the C encoder for strings.
+        serialized_message = json_lib.serialize(message, use_fast_encoding=True, sort_keys=False)
+        if sample_rate != 1.0:
+            return '%s%s,"sample_rate":%s}}' % (self.__prefix, serialized_message,
+                                                 json_lib.serialize(sample_rate, use_fast_encoding=True))
+        return self.__prefix + serialized_message + self.__unsampled_suffix
+
+
+class BufferPool(object):
+    """A pool of StringIO buffers that are reused to serialize requests.
+
+    A StringIO object keeps its allocated memory when it is truncated, so reusing one for each request means it
+    is already large enough to hold the next one, avoiding repeatedly growing and copying the buffer as a large
+    request is serialized.
+    """
+    def __init__(self, max_buffers=2):
+        """Creates an empty pool.
+
+        @param max_buffers: The maximum number of unused buffers to hold onto.
+        @type max_buffers: int
+        """
+        self.__max_buffers = max_buffers
+        # The unused buffers.
+        self.__buffers = []
+        self.__lock = threading.Lock()
+
+    def get(self):
+        """Returns an empty buffer, reusing a previously returned one if possible.
+
+        @rtype: StringIO
+        """
+        self.__lock.acquire()
+        try:
+            if len(self.__buffers) > 0:
+                return self.__buffers.pop()
+        finally:
+            self.__lock.release()
+        return StringIO()
+
+    def put(self, string_buffer):
+        """Returns a buffer to the pool once it is no longer needed.
+
+        @param string_buffer: The buffer, which must have been returned by get.
+        @type string_buffer: StringIO
+        """
+        string_buffer.seek(0)
+        string_buffer.truncate()
+        self.__lock.acquire()
+        try:
+            if len(self.__buffers) < self.__max_buffers:
+                self.__buffers.append(string_buffer)
+                string_buffer = None
+        finally:
+            self.__lock.release()
+        if string_buffer is not None:
+            string_buffer.close()
+
+
+# The delay before reconnecting after the first failed request, in seconds.  The delay doubles with each consecutive
+# failure, up to MAX_RECONNECT_DELAY.
+MIN_RECONNECT_DELAY = 0.05
+MAX_RECONNECT_DELAY = 30.0
+
+# The maximum number of seconds a connection may be idle before we stop reusing it.  Servers and load balancers
+# close idle keep-alive connections, so reusing one that has been idle for too long is likely to fail.
+MAX_CONNECTION_IDLE_TIME = 30.0
+
+# Matches a response that only holds a status of 'success', such as '{"status":"success"}'.  Anything else, including
+# a successful response with more fields, is handled by the full JSON parser so that malformed bodies are rejected.
+SUCCESS_RESPONSE_PATTERN = re.compile(r'\s*\{\s*"status"\s*:\s*"success"\s*\}\s*$')
+
+# The weight given to the latest request when updating a server's average latency.
+LATENCY_AVERAGE_WEIGHT = 0.2
+# The number of seconds after which a server's average latency is considered stale.  A server that has not been
+# sent a request for this long is preferred when load balancing, so that we find out if it has gotten faster.
+MAX_LATENCY_AGE = 60.0
+
+# The minimum body size for which ScalyrClientSession writes the segments of the body separately instead of
+# joining them into a single string.
+MIN_SEGMENTED_BODY_SIZE = 64 * 1024
+
+# The phases of a request that ScalyrClientSession times, in the order they occur:  serializing the body, opening
+# the TCP connection, performing the TLS handshake, writing the request, waiting for the first byte of the response,
+# and reading the rest of the response.
+REQUEST_PHASES = ['serialize', 'connect', 'tls', 'write', 'first_byte', 'read']
+
+
+class ConnectionPool(object):
+    """Holds the idle HTTP connections to the server so that they can be reused by later requests.
+
+    Reusing a keep-alive connection avoids the TCP and SSL handshakes for each request.  Since the server may close
+    an idle connection at any time, each connection is checked before it is handed out, and connections that have
+    been idle for too long are discarded.
+    """
+    def __init__(self, max_idle_connections=2, max_idle_time=MAX_CONNECTION_IDLE_TIME):
+        """Creates an empty pool.
+
+        @param max_idle_connections: The maximum number of idle connections to hold onto.
+        @param max_idle_time: The maximum number of seconds a connection may be idle and still be reused.
+
+        @type max_idle_connections: int
+        @type max_idle_time: float
+        """
+        self.__max_idle_connections = max_idle_connections
+        self.__max_idle_time = max_idle_time
+        # The idle connections, as tuples of the connection and the time it was returned to the pool.  The most
+        # recently returned connection is last.
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    def get(self, current_time=None):
+        """Returns a healthy idle connection, or None if there are none.
+
+        @param current_time: If not None, the time to use as the current time.
+        @type current_time: float
+
+        @rtype: httplib.HTTPConnection
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        while True:
+            self.__lock.acquire()
+            try:
+                if len(self.__connections) == 0:
+                    return None
+                connection, idle_since = self.__connections.pop()
+            finally:
+                self.__lock.release()
+
+            if 0 <= current_time - idle_since < self.__max_idle_time and ConnectionPool.is_healthy(connection):
+                return connection
+            connection.close()
+
+    def put(self, connection, current_time=None):
+        """Returns a connection to the pool once its response has been completely read.
+
+        @param connection: The connection.
+        @param current_time: If not None, the time to use as the current time.
+
+        @type connection: httplib.HTTPConnection
+        @type current_time: float
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        self.__lock.acquire()
+        try:
+            self.__connections.append((connection, current_time))
+            if len(self.__connections) > self.__max_idle_connections:
+                connection = self.__connections.pop(0)[0]
+            else:
+                connection = None
+        finally:
+            self.__lock.release()
+
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        """Closes all of the idle connections."""
+        self.__lock.acquire()
+        try:
+            connections = self.__connections
+            self.__connections = []
+        finally:
+            self.__lock.release()
+
+        for connection, _ in connections:
+            connection.close()
+
+    @staticmethod
+    def is_healthy(connection):
+        """Returns True if the idle connection still appears to be usable.
+
+        An idle connection should never have anything to read.  If its socket is readable, the server has either
+        closed it or sent something unexpected, and in both cases it cannot be used for another request.
+
+        @param connection: The connection.
+        @type connection: httplib.HTTPConnection
+
+        @rtype: bool
+        """
+        sock = getattr(connection, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return len(readable) == 0
+
+
+class PendingRequest(object):
+    """A request that is being sent on another thread by ScalyrClientSession.send_async.
+
+    The creator of the request polls it using wait until it completes.  If it has not completed by its deadline,
+    its connection is shut down, which causes the sending thread to give up on it promptly.
+    """
+    def __init__(self, deadline):
+        """Initializes the request.
+
+        @param deadline: The time by which the request must complete.
+        @type deadline: float
+        """
+        self.__deadline = deadline
+        # Set once the result is available.
+        self.__completed = threading.Event()
+        # The result returned by ScalyrClientSession.send, once the request has completed.
+        self.__result = None
+        # Protects __connection and __timed_out.
+        self.__lock = threading.Lock()
+        # The connection currently being used to send the request, if any.
+        self.__connection = None
+        # True if the deadline passed before the request completed.
+        self.__timed_out = False
+
+    def wait(self, timeout, current_time=None):
+        """Waits for the request to complete.  If the deadline passes first, the request is timed out.
+
+        @param timeout: The maximum number of seconds to wait.
+        @param current_time: If not None, the time to use as the current time.
+
+        @type timeout: float
+        @type current_time: float
+
+        @return: True if the request has completed.
+        @rtype: bool
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        self.__completed.wait(max(0.0, min(timeout, self.__deadline - current_time)))
+        if not self.__completed.isSet() and time.time() >= self.__deadline:
+            self.__time_out()
+        return self.__completed.isSet()
+
+    def get_result(self):
+        """Returns the result of the request, which must have completed.
+
+        @return: The same tuple returned by ScalyrClientSession.send.  If the request timed out, the status is
+            'requestTimedOut'.
+        @rtype: (str, int, str)
+        """
+        return self.__result
+
+    def is_timed_out(self):
+        """Returns True if the deadline passed before the request completed.
+
+        @rtype: bool
+        """
+        self.__lock.acquire()
+        try:
+            return self.__timed_out
+        finally:
+            self.__lock.release()
+
+    def cancel(self):
+        """Gives up on the request, shutting down its connection.  The request completes shortly afterwards."""
+        self.__time_out()
+
+    def set_connection(self, connection):
+        """Records the connection being used to send the request.  Invoked by the sending thread.
+
+        @param connection: The connection.
+        @type connection: httplib.HTTPConnection
+        """
+        self.__lock.acquire()
+        try:
+            self.__connection = connection
+            timed_out = self.__timed_out
+        finally:
+            self.__lock.release()
+
+        if timed_out:
+            PendingRequest.__shutdown(connection)
+
+    def set_result(self, result):
+        """Records the result of the request, completing it.  Invoked by the sending thread.
+
+        @param result: The tuple returned by ScalyrClientSession.send.
+        @type result: (str, int, str)
+        """
+        if result[0] != 'success' and self.is_timed_out():
+            result = ('requestTimedOut', result[1], result[2])
+        self.__result = result
+        self.__completed.set()
+
+    def __time_out(self):
+        """Marks the request as timed out and shuts down its connection."""
+        self.__lock.acquire()
+        try:
+            self.__timed_out = True
+            connection = self.__connection
+        finally:
+            self.__lock.release()
+
+        if connection is not None:
+            PendingRequest.__shutdown(connection)
+
+    @staticmethod
+    def __shutdown(connection):
+        """Shuts down the socket for the connection, causing any blocked operations on it to fail.
+
+        @param connection: The connection.
+        @type connection: httplib.HTTPConnection
+        """
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError, ValueError):
+                pass
+
+
+class ServerEndpoint(object):
+    """One of the servers a ScalyrClientSession may send requests to, along with its idle connections and health.
+
+    A server that fails a request is not sent another one until its reconnect delay has passed.  The delay starts
+    at MIN_RECONNECT_DELAY and doubles with each consecutive failure, up to MAX_RECONNECT_DELAY.
+    """
+    def __init__(self, server):
+        """Initializes the endpoint.
+
+        @param server: The URL for the server, such as https://agent.scalyr.com
+        @type server: str
+        """
+        # Verify the server address looks right.
+        parsed_server = re.match('^(http://|https://|)([^:]*)(:\d+|)$', server.lower())
+
+        if parsed_server is None:
+            raise Exception('Could not parse server address "%s"' % server)
+
+        # The full URL address
+        self.full_address = server
+        # The host for the server.
+        self.host = parsed_server.group(2)
+        # Whether or not the connection uses SSL.  For production use, this should always be true.  We only
+        # use non-SSL when testing against development versions of the Scalyr server.
+        self.use_ssl = parsed_server.group(1) == 'https://'
+
+        # Determine the port, defaulting to the right one based on protocol if not given.
+        if parsed_server.group(3) != '':
+            self.port = int(parsed_server.group(3)[1:])
+        elif self.use_ssl:
+            self.port = 443
+        else:
+            self.port = 80
+
+        # The idle HTTPConnection objects that have been opened to the server and may be reused.
+        self.connection_pool = ConnectionPool()
+        # The number of requests currently being sent to the server.
+        self.in_flight = 0
+
+        # The time the last request failed, if the most recent request was a failure.
+        self.__last_failure_time = None
+        # The number of seconds to wait after the last failure before sending another request.
+        self.__reconnect_delay = 0.0
+        # The exponentially weighted average latency of successful requests, in seconds, or None if there have been
+        # none.
+        self.__average_latency = None
+        # The time of the last successful request.
+        self.__last_success_time = None
+
+    def is_available(self, current_time):
+        """Returns True if the server may be sent a request.
+
+        @param current_time: The current time.
+        @type current_time: float
+
+        @rtype: bool
+        """
+        # Note, if the clock has moved backwards since the failure, we do not wait.
+        return (self.__last_failure_time is None or
+                not 0 <= current_time - self.__last_failure_time < self.__reconnect_delay)
+
+    def get_expected_latency(self, current_time):
+        """Returns the latency in seconds we expect for a request to the server.
+
+        @param current_time: The current time.
+        @type current_time: float
+
+        @return: The average latency of recent requests, or zero if there have been no recent requests.
+        @rtype: float
+        """
+        if (self.__average_latency is None or
+                not 0 <= current_time - self.__last_success_time < MAX_LATENCY_AGE):
+            return 0.0
+        return self.__average_latency
+
+    def record_success(self, current_time, latency):
+        """Records that a request to the server succeeded.
+
+        @param current_time: The current time.
+        @param latency: The number of seconds the request took.
+
+        @type current_time: float
+        @type latency: float
+        """
+        self.__last_failure_time = None
+        self.__reconnect_delay = 0.0
+        if self.get_expected_latency(current_time) == 0.0:
+            self.__average_latency = latency
+        else:
+            self.__average_latency += LATENCY_AVERAGE_WEIGHT * (latency - self.__average_latency)
+        self.__last_success_time = current_time
+
+    def record_failure(self, current_time):
+        """Records that a request to the server failed, closing its idle connections.
+
+        @param current_time: The current time.
+        @type current_time: float
+        """
+        self.connection_pool.close()
+        self.__last_failure_time = current_time
+        self.__reconnect_delay = min(max(2 * self.__reconnect_delay, MIN_RECONNECT_DELAY), MAX_RECONNECT_DELAY)
+
+
+# The header for a gzip stream with no file name or modification time, compressed using deflate.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# The range for the number of bytes of serialized JSON to buffer before feeding it to the compressor.
+MIN_UNCOMPRESSED_BUFFER_SIZE = 4 * 1024
+MAX_UNCOMPRESSED_BUFFER_SIZE = 64 * 1024
+
+# The number of bytes to allow for flushing the compressor and writing the stream trailer when estimating the
+# size of a compressed request.
+COMPRESSED_TRAILER_ALLOWANCE = 64
 
 # The last timestamp used for any event uploaded to the server.  We need to guarantee that this is monotonically
 # increasing so we track it in a global var.
@@ -648,7 +1695,7 @@ class HTTPSConnectionWithTimeoutAndVerification(httplib.HTTPSConnection):
     Python library, then it is possible to perform server certificate validation even on Python 2.4, 2.5.  This
     class implements the necessary support.
     """
-    def __init__(self, host, port, timeout, ca_file, has_ssl):
+    def __init__(self, host, port, timeout, ca_file, has_ssl, ssl_context=None):
         """
         Creates an instance.
 
@@ -662,12 +1709,17 @@ class HTTPSConnectionWithTimeoutAndVerification(httplib.HTTPSConnection):
                 you will be susceptible to man-in-the-middle attacks.  However, at least your traffic will be
                 encrypted.
             has_ssl:  True if the ssl Python library is available.
+            ssl_context:  If not None, the context returned by create_ssl_context for ca_file, used to wrap the
+                socket instead of loading the certificates again.
         """
         if not has_ssl and ca_file is not None:
             raise Exception('If has_ssl is false, you are not allowed to specify a ca_file because it has no affect.')
         self.__timeout = timeout
         self.__ca_file = ca_file
         self.__has_ssl = has_ssl
+        self.__ssl_context = ssl_context
+        # The number of seconds the TLS handshake took when connecting, or None if it was not measured separately.
+        self.tls_handshake_secs = None
         httplib.HTTPSConnection.__init__(self, host, port)
 
     def connect(self):
@@ -695,11 +1747,41 @@ class HTTPSConnectionWithTimeoutAndVerification(httplib.HTTPSConnection):
         if self._tunnel_host:
             self._tunnel()
 
-        # Now ask the ssl library to wrap the socket and verify the server certificate if we have a ca_file.
-        if self.__ca_file is not None:
+        # Now ask the ssl library to wrap the socket and verify the server certificate if we have a ca_file.  The
+        # handshake is performed as part of wrapping the socket.
+        handshake_start_time = time.time()
+        if self.__ssl_context is not None:
+            self.sock = self.__ssl_context.wrap_socket(self.sock)
+        elif self.__ca_file is not None:
             self.sock = ssl.wrap_socket(self.sock, ca_certs=self.__ca_file, cert_reqs=ssl.CERT_REQUIRED)
         else:
             self.sock = ssl.wrap_socket(self.sock, cert_reqs=ssl.CERT_NONE)
+        self.tls_handshake_secs = time.time() - handshake_start_time
+
+
+def create_ssl_context(ca_file):
+    """Creates an SSL context to use for all of the connections to the server, if the ssl library supports them.
+
+    Contexts are only available in Python 2.7.9 and later.  Sharing one means the certificates in ca_file are only
+    loaded once rather than for each connection.
+
+    @param ca_file: If not None, the file containing the certificate authority root certs used to verify the server
+        certificate.  If None, the server certificate is not verified.
+    @type ca_file: str
+
+    @return: The context, or None if contexts are not supported.
+    @rtype: ssl.SSLContext
+    """
+    if ssl is None or not hasattr(ssl, 'SSLContext'):
+        return None
+
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    if ca_file is not None:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(ca_file)
+    else:
+        context.verify_mode = ssl.CERT_NONE
+    return context
 
 
 def create_connection_helper(host, port, timeout=None, source_address=None):
@@ -34,6 +34,7 @@ import sys
 import time
 import threading
 
+from collections import deque
 from cStringIO import StringIO
 from scalyr_agent.util import RateLimiter
 
@@ -134,6 +135,35 @@ def set_log_level(level):
     __log_manager__.set_log_level(level)
 
 
+# The MetricQueueHandler that adds the metric lines for monitors to the MetricEventQueue set by set_metric_queue, or
+# None if the metric lines are only written to the metric logs.
+__metric_queue_handler__ = None
+# Whether the metric lines are still written to the metric logs when a MetricEventQueue has been set.
+__write_metric_logs__ = True
+
+
+def set_metric_queue(metric_queue, write_metric_logs=True):
+    """Sets the queue that the metric lines emitted by monitors are added to so that they can be sent to Scalyr
+    directly, rather than being written to the metric logs and then read back by the CopyingManager.
+
+    This only affects monitors whose metric logs are opened after this is invoked.  Like openMetricLogForMonitor, this
+    method is not thread safe and must be invoked on the same thread that opens the metric logs.
+
+    @param metric_queue: The queue, or None if the metric lines should only be written to the metric logs.
+    @param write_metric_logs: If False, the metric lines are only added to metric_queue and the metric logs are not
+        written.  Otherwise, the metric logs are kept as a copy of what was sent.
+
+    @type metric_queue: MetricEventQueue
+    @type write_metric_logs: bool
+    """
+    global __metric_queue_handler__, __write_metric_logs__
+    if metric_queue is not None:
+        __metric_queue_handler__ = MetricQueueHandler(metric_queue)
+    else:
+        __metric_queue_handler__ = None
+    __write_metric_logs__ = write_metric_logs
+
+
 #
 # _srcfile is used when walking the stack to check when we've got the first
 # caller stack frame.  This is copied from the logging/__init__.py
@@ -239,6 +269,9 @@ class AgentLogger(logging.Logger):
         # which monitor it is reporting for and the associated log handler.
         self.__monitor = None
         self.__metric_handler = None
+        # The MetricQueueHandler that the metrics for the monitor are added to, if the monitor was opened after a
+        # metric queue was set using set_metric_queue.
+        self.__metric_queue_handler = None
 
         # The regular expression that must match for metric and field names.  Esentially, it has to begin with
         # a letter, and only contain letters, digits, periods, and underscores.
@@ -430,13 +463,19 @@ class AgentLogger(logging.Logger):
         @param max_bytes: The maximum number of bytes to write to the log file before it is rotated.
         @param backup_count: The number of old log files to keep around.
         """
-        if self.__metric_handler is not None:
+        if self.__monitor is not None:
             self.closeMetricLog()
 
-        self.__metric_handler = MetricLogHandler.get_handler_for_path(path, max_bytes=max_bytes,
-                                                                      backup_count=backup_count)
+        # If a metric queue has been set, the metrics are added to it and the log file is only written if requested.
+        if __metric_queue_handler__ is None or __write_metric_logs__:
+            self.__metric_handler = MetricLogHandler.get_handler_for_path(path, max_bytes=max_bytes,
+                                                                          backup_count=backup_count)
+            self.__metric_handler.open_for_monitor(monitor)
+
+        if __metric_queue_handler__ is not None:
+            self.__metric_queue_handler = __metric_queue_handler__
+            self.__metric_queue_handler.open_for_monitor(path, monitor)
 
-        self.__metric_handler.open_for_monitor(monitor)
         self.__monitor = monitor
         AgentLogger.__opened_monitors__[monitor] = True
 
@@ -445,6 +484,10 @@ class AgentLogger(logging.Logger):
         if self.__metric_handler is not None:
             self.__metric_handler.close_for_monitor(self.__monitor)
             self.__metric_handler = None
+        if self.__metric_queue_handler is not None:
+            self.__metric_queue_handler.close_for_monitor(self.__monitor)
+            self.__metric_queue_handler = None
+        if self.__monitor is not None:
             del AgentLogger.__opened_monitors__[self.__monitor]
             self.__monitor = None
 
@@ -858,6 +901,225 @@ class MetricStdoutLogHandler(logging.StreamHandler, MetricLogHandler):
         self.propagate = False
 
 
+class MetricEventQueue(object):
+    """A bounded in-memory queue holding the metric lines emitted by monitors until the CopyingManager sends them.
+
+    Each entry is a tuple holding the time the line was emitted, the name of the monitor that emitted it, the line
+    without the time and monitor name prefix written to the metric log, and the ScalyrMonitor instance.  Use
+    format_metric_event to get the line as it would have been written to the metric log.  Lines put back after a
+    failed send also hold the result of sampling them as a fifth element, so they are not sampled again.
+
+    The queue also tracks which monitors are currently adding lines to it.
+
+    This abstraction is thread safe.
+    """
+    def __init__(self, max_size):
+        """Creates an empty queue.
+
+        @param max_size: The maximum number of lines to hold.  Once full, new lines are dropped until lines have
+            been taken from the queue.
+        @type max_size: int
+        """
+        self.__max_size = max_size
+        # The lines in the order they were emitted.
+        self.__events = deque()
+        # The total number of bytes in the lines held by the queue.
+        self.__pending_bytes = 0
+        # The total number of lines dropped because the queue was full.
+        self.__total_dropped = 0
+        # The monitor instances that are open, mapped to True.
+        self.__open_monitors = {}
+        self.__lock = threading.Lock()
+
+    def put(self, event):
+        """Adds a line to the end of the queue, unless the queue is full.
+
+        @param event: The line, in the form described in the class description.
+        @type event: tuple
+
+        @return: True if the line was added.
+        @rtype: bool
+        """
+        self.__lock.acquire()
+        try:
+            if len(self.__events) >= self.__max_size:
+                self.__total_dropped += 1
+                return False
+            self.__events.append(event)
+            self.__pending_bytes += len(event[2])
+            return True
+        finally:
+            self.__lock.release()
+
+    def take_all(self):
+        """Removes all of the lines from the queue.
+
+        @return: The lines, in the order they were emitted.
+        @rtype: list of tuple
+        """
+        self.__lock.acquire()
+        try:
+            result = list(self.__events)
+            self.__events.clear()
+            self.__pending_bytes = 0
+            return result
+        finally:
+            self.__lock.release()
+
+    def put_back(self, events):
+        """Returns lines that were taken from the queue but could not be sent to the front of the queue.
+
+        They are put back even if this makes the queue larger than its maximum size, since they were already
+        accepted.
+
+        @param events: The lines, in the order they were emitted.
+        @type events: list of tuple
+        """
+        self.__lock.acquire()
+        try:
+            for event in reversed(events):
+                self.__events.appendleft(event)
+                self.__pending_bytes += len(event[2])
+        finally:
+            self.__lock.release()
+
+    def open_monitor(self, monitor):
+        """Records that the specified monitor may add lines to the queue.
+
+        @param monitor: The monitor instance.
+        """
+        self.__lock.acquire()
+        try:
+            self.__open_monitors[monitor] = True
+        finally:
+            self.__lock.release()
+
+    def close_monitor(self, monitor):
+        """Records that the specified monitor will no longer add lines to the queue.
+
+        Lines it already added remain in the queue.
+
+        @param monitor: The monitor instance.
+        """
+        self.__lock.acquire()
+        try:
+            if monitor in self.__open_monitors:
+                del self.__open_monitors[monitor]
+        finally:
+            self.__lock.release()
+
+    def get_open_monitors(self):
+        """Returns the monitors that may add lines to the queue.
+
+        @return: The open monitor instances, mapped to True.
+        @rtype: dict
+        """
+        self.__lock.acquire()
+        try:
+            return self.__open_monitors.copy()
+        finally:
+            self.__lock.release()
+
+    def get_stats(self):
+        """Returns the statistics for the queue.
+
+        @return: A tuple holding the number of lines in the queue, the number of bytes in those lines, and the total
+            number of lines dropped because the queue was full.
+        @rtype: (int, int, int)
+        """
+        self.__lock.acquire()
+        try:
+            return len(self.__events), self.__pending_bytes, self.__total_dropped
+        finally:
+            self.__lock.release()
+
+
+def format_metric_event(event):
+    """Returns the line for an entry in a MetricEventQueue as it would have been written to the metric log.
+
+    This produces the same output as MetricLogFormatter.
+
+    @param event: The entry.
+    @type event: tuple
+
+    @rtype: str
+    """
+    (created, monitor_name, message) = event[0:3]
+    return '%s.%03dZ [%s] %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(created)),
+                                   (created - long(created)) * 1000, monitor_name, message)
+
+
+class MetricQueueHandler(logging.Handler):
+    """The handler that adds the metric lines for monitors to a MetricEventQueue.
+
+    Like the MetricLogHandler, a single instance is placed on the root logger and only handles the records for the
+    monitors it has been opened for.  The lines are subject to the same rate limit as the metric log they would have
+    been written to.
+    """
+    def __init__(self, metric_queue):
+        """Creates the handler.  This should not be used directly.  Use set_metric_queue instead.
+
+        @param metric_queue: The queue to add the lines to.
+        @type metric_queue: MetricEventQueue
+        """
+        logging.Handler.__init__(self)
+        self.__metric_queue = metric_queue
+        # The monitor instances whose metrics should be added to the queue, mapped to the RateLimiterLogFilter for
+        # their metric log path.
+        self.__monitors = {}
+        # The RateLimiterLogFilter for each metric log path.
+        self.__rate_limiters = {}
+        # Used by the rate limiters to determine how many bytes each line would have used in the metric log.
+        self.__formatter = MetricLogFormatter()
+
+    def emit(self, record):
+        """Adds the line for the record to the queue if it is a metric for one of the monitors.
+
+        @param record: The record.
+        @type record: logging.LogRecord
+        """
+        monitor = getattr(record, 'metric_log_for_monitor', None)
+        if monitor is None:
+            return
+        # The monitor may be closed concurrently by another thread, so only look it up once.
+        rate_limiter = self.__monitors.get(monitor)
+        if rate_limiter is None or not rate_limiter.filter(record):
+            return
+        # noinspection PyBroadException
+        try:
+            self.__metric_queue.put((record.created, record.monitor_name, record.getMessage(), monitor))
+        except Exception:
+            self.handleError(record)
+
+    def open_for_monitor(self, path, monitor):
+        """Configures this instance to add the metrics for the specified monitor to the queue.
+
+        This method is not thread-safe.
+
+        @param path: The path of the monitor's metric log.  The monitors sharing a metric log share its rate limit.
+        @param monitor: The monitor instance.
+        """
+        if len(self.__monitors) == 0:
+            logging.getLogger().addHandler(self)
+        if path not in self.__rate_limiters:
+            self.__rate_limiters[path] = RateLimiterLogFilter(self.__formatter)
+        self.__monitors[monitor] = self.__rate_limiters[path]
+        self.__metric_queue.open_monitor(monitor)
+
+    def close_for_monitor(self, monitor):
+        """Configures this instance to no longer add the metrics for the specified monitor to the queue.
+
+        This method is not thread-safe, but it may be invoked while other threads are emitting metrics.
+
+        @param monitor: The monitor instance.
+        """
+        if monitor in self.__monitors:
+            del self.__monitors[monitor]
+            self.__metric_queue.close_monitor(monitor)
+            if len(self.__monitors) == 0:
+                logging.getLogger().removeHandler(self)
+
+
 class AgentLogManager(object):
     """The central manager for all AgentLoggers.
 
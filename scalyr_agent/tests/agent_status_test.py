@@ -22,6 +22,7 @@ import cStringIO
 
 from scalyr_agent.agent_status import OverallStats, AgentStatus, ConfigStatus, LogProcessorStatus, MonitorStatus
 from scalyr_agent.agent_status import CopyingManagerStatus, MonitorManagerStatus, LogMatcherStatus, report_status
+from scalyr_agent.agent_status import RequestPhaseStatus
 
 
 class TestOverallStats(unittest.TestCase):
@@ -42,6 +43,8 @@ class TestOverallStats(unittest.TestCase):
         a.total_requests_sent = 1
         a.total_requests_failed = 2
         a.total_request_bytes_sent = 3
+        a.total_compressed_request_bytes_sent = 1
+        a.total_uncompressed_request_bytes_sent = 12
         a.total_response_bytes_received = 4
         a.total_request_latency_secs = 5
         a.total_connections_created = 6
@@ -58,6 +61,8 @@ class TestOverallStats(unittest.TestCase):
         b.total_requests_sent = 7
         b.total_requests_failed = 8
         b.total_request_bytes_sent = 9
+        b.total_compressed_request_bytes_sent = 3
+        b.total_uncompressed_request_bytes_sent = 36
         b.total_response_bytes_received = 10
         b.total_request_latency_secs = 11
         b.total_connections_created = 12
@@ -76,6 +81,8 @@ class TestOverallStats(unittest.TestCase):
         self.assertEquals(c.total_requests_sent, 8)
         self.assertEquals(c.total_requests_failed, 10)
         self.assertEquals(c.total_request_bytes_sent, 12)
+        self.assertEquals(c.total_compressed_request_bytes_sent, 4)
+        self.assertEquals(c.total_uncompressed_request_bytes_sent, 48)
         self.assertEquals(c.total_response_bytes_received, 14)
         self.assertEquals(c.total_request_latency_secs, 16)
         self.assertEquals(c.total_connections_created, 18)
@@ -386,4 +393,37 @@ Running monitors:
 Failed monitors:
   bad_monitor() 20 lines emitted, 40 errors
 """
-        self.assertEquals(expected_output, output.getvalue())
\ No newline at end of file
+        self.assertEquals(expected_output, output.getvalue())
+
+    def test_request_phases(self):
+        connect_status = RequestPhaseStatus()
+        connect_status.phase = 'connect'
+        connect_status.count = 3
+        connect_status.average = 0.0123
+        connect_status.p50 = 0.011
+        connect_status.p99 = 0.02
+        tls_status = RequestPhaseStatus()
+        tls_status.phase = 'tls'
+        self.status.request_phases = [connect_status, tls_status]
+
+        output = cStringIO.StringIO()
+        report_status(output, self.status, self.time)
+
+        expected_output = """Request timing:
+===============
+
+connect:    12.3 ms average, 11.0 ms p50, 20.0 ms p99 (3 requests)
+"""
+        self.assertTrue(expected_output in output.getvalue())
+
+    def test_config_parse_time(self):
+        self.status.config_status.last_parse_duration = 0.0125
+        self.status.config_status.unchanged_checks = 7
+
+        output = cStringIO.StringIO()
+        report_status(output, self.status, self.time)
+
+        expected_output = """Last changed observed: Fri Sep  5 11:14:13 2014 UTC
+Last parse time:       12.5 ms (7 unchanged checks skipped parsing)
+"""
+        self.assertTrue(expected_output in output.getvalue())
@@ -0,0 +1,177 @@
+# Copyright 2014 Scalyr Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+#
+# author: Steven Czerwinski <czerwin@scalyr.com>
+
+__author__ = 'czerwin@scalyr.com'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scalyr_agent.checkpoint_store as checkpoint_store
+
+from scalyr_agent.checkpoint_store import CheckpointStore
+from scalyr_agent import json_lib
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.__data_dir = tempfile.mkdtemp()
+        self.__journal_path = os.path.join(self.__data_dir, 'checkpoints.journal')
+        self.__snapshot_path = os.path.join(self.__data_dir, 'checkpoints.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.__data_dir)
+
+    def test_no_checkpoint_file(self):
+        self.assertTrue(CheckpointStore(self.__data_dir).read() is None)
+
+    def test_read_old_format(self):
+        fp = open(self.__snapshot_path, 'w')
+        fp.write(json_lib.serialize({'time': 5.0, 'checkpoints': {'/var/log/a.log': {'position': 10}}}))
+        fp.close()
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.assertEquals(state['time'], 5.0)
+        self.assertEquals(state['checkpoints']['/var/log/a.log']['position'], 10)
+
+    def test_journal_only_holds_changes(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 1})
+        store.update('/var/log/b.log', {'position': 2})
+        store.write_if_necessary(current_time=1.0)
+        self.assertEquals(os.path.getsize(self.__journal_path), 0)
+
+        store.update('/var/log/b.log', {'position': 3})
+        store.remove('/var/log/a.log')
+        store.write_if_necessary(current_time=2.0)
+
+        entries = self.__read_journal()
+        self.assertEquals(len(entries), 1)
+        self.__assert_json_equals(entries[0]['checkpoints'], {'/var/log/b.log': {'position': 3}})
+        self.__assert_json_equals(entries[0]['removed'], ['/var/log/a.log'])
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.assertEquals(state['time'], 2.0)
+        self.__assert_json_equals(state['checkpoints'], {'/var/log/b.log': {'position': 3}})
+
+    def test_nothing_written_if_not_dirty(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 1})
+        store.write_if_necessary(current_time=1.0)
+
+        store.write_if_necessary(current_time=2.0)
+        self.assertEquals(len(self.__read_journal()), 0)
+
+        # Once enough time has passed, the time must be refreshed even though nothing has changed.
+        store.write_if_necessary(current_time=2.0 + checkpoint_store.MAX_TIME_BETWEEN_WRITES)
+        self.assertEquals(len(self.__read_journal()), 1)
+
+    def test_write_interval(self):
+        store = CheckpointStore(self.__data_dir, write_interval=10.0)
+        store.update('/var/log/a.log', {'position': 1})
+        store.write_if_necessary(current_time=1.0)
+
+        store.update('/var/log/a.log', {'position': 2})
+        store.write_if_necessary(current_time=5.0)
+        self.assertEquals(len(self.__read_journal()), 0)
+
+        store.write_if_necessary(current_time=11.0)
+        self.assertEquals(len(self.__read_journal()), 1)
+
+        store.update('/var/log/a.log', {'position': 3})
+        store.write_if_necessary(current_time=12.0, force=True)
+        self.assertEquals(len(self.__read_journal()), 2)
+
+    def test_compaction(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 0})
+        store.write_if_necessary(current_time=1.0)
+
+        i = 1
+        while os.path.getsize(self.__journal_path) < checkpoint_store.MIN_COMPACTION_SIZE:
+            store.update('/var/log/a.log', {'position': i})
+            store.write_if_necessary(current_time=1.0 + i)
+            i += 1
+
+        store.update('/var/log/a.log', {'position': i})
+        store.write_if_necessary(current_time=1.0 + i)
+        self.assertEquals(os.path.getsize(self.__journal_path), 0)
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.__assert_json_equals(state['checkpoints'], {'/var/log/a.log': {'position': i}})
+
+    def test_ignores_journal_from_old_generation(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 1})
+        store.write_if_necessary(current_time=1.0)
+        store.update('/var/log/a.log', {'position': 2})
+        store.write_if_necessary(current_time=2.0)
+
+        # Simulate being interrupted after writing a new snapshot but before the journal was truncated.
+        old_journal = open(self.__journal_path).read()
+
+        new_store = CheckpointStore(self.__data_dir)
+        new_store.read()
+        new_store.update('/var/log/a.log', {'position': 4})
+        new_store.write_if_necessary(current_time=4.0)
+
+        fp = open(self.__journal_path, 'w')
+        fp.write(old_journal)
+        fp.close()
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.__assert_json_equals(state['checkpoints'], {'/var/log/a.log': {'position': 4}})
+
+    def test_truncated_journal_entry(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 1})
+        store.write_if_necessary(current_time=1.0)
+        store.update('/var/log/a.log', {'position': 2})
+        store.write_if_necessary(current_time=2.0)
+
+        fp = open(self.__journal_path, 'a')
+        fp.write('{"checkpoints":{"/var/log/a.log":{"posi')
+        fp.close()
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.assertEquals(state['time'], 2.0)
+        self.__assert_json_equals(state['checkpoints'], {'/var/log/a.log': {'position': 2}})
+
+    def test_retain_only(self):
+        store = CheckpointStore(self.__data_dir)
+        store.update('/var/log/a.log', {'position': 1})
+        store.update('/var/log/b.log', {'position': 2})
+        store.write_if_necessary(current_time=1.0)
+
+        store = CheckpointStore(self.__data_dir)
+        store.read()
+        store.retain_only({'/var/log/b.log': True})
+        store.write_if_necessary(current_time=2.0, force=True)
+
+        state = CheckpointStore(self.__data_dir).read()
+        self.__assert_json_equals(state['checkpoints'], {'/var/log/b.log': {'position': 2}})
+
+    def __assert_json_equals(self, actual, expected):
+        self.assertEquals(json_lib.serialize(actual), json_lib.serialize(expected))
+
+    def __read_journal(self):
+        result = []
+        for line in open(self.__journal_path).read().splitlines():
+            result.append(json_lib.parse(line))
+        return result
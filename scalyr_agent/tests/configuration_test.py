@@ -68,6 +68,16 @@ class TestConfiguration(unittest.TestCase):
         self.assertEquals(config.request_too_large_adjustment, 0.5)
         self.assertEquals(config.debug_level, 0)
         self.assertEquals(config.request_deadline, 60.0)
+        self.assertEquals(config.checkpoint_write_interval, 0.0)
+        self.assertEquals(config.idle_log_eviction_time, 0.0)
+        self.assertEquals(config.max_upload_latency, 0.0)
+        self.assertEquals(config.metric_queue_size, 0)
+        self.assertTrue(config.write_metric_logs)
+        self.assertEquals(config.compression_type, 'none')
+        self.assertEquals(config.compression_level, 6)
+        self.assertFalse(config.limit_compressed_request_size)
+        self.assertEquals(len(config.additional_scalyr_servers), 0)
+        self.assertFalse(config.load_balance_servers)
         self.assertTrue(config.ca_cert_path.endswith('ca_certs.crt'))
         self.assertTrue(config.verify_server_certificate)
 
@@ -128,6 +138,16 @@ class TestConfiguration(unittest.TestCase):
             request_too_large_adjustment: 0.75,
             debug_level: 1,
             request_deadline: 30.0,
+            checkpoint_write_interval: 5.0,
+            idle_log_eviction_time: 3600.0,
+            max_upload_latency: 0.5,
+            metric_queue_size: 5000,
+            write_metric_logs: false,
+            compression_type: "gzip",
+            compression_level: 9,
+            limit_compressed_request_size: true,
+            additional_scalyr_servers: [ "https://proxy1.example.com", "https://proxy2.example.com:8443" ],
+            load_balance_servers: true,
             server_attributes: { region: "us-east" },
             ca_cert_path: "/var/lib/foo.pem",
             verify_server_certificate: false,
@@ -163,9 +183,37 @@ class TestConfiguration(unittest.TestCase):
         self.assertEquals(config.request_too_large_adjustment, 0.75)
         self.assertEquals(config.debug_level, 1)
         self.assertEquals(config.request_deadline, 30.0)
+        self.assertEquals(config.checkpoint_write_interval, 5.0)
+        self.assertEquals(config.idle_log_eviction_time, 3600.0)
+        self.assertEquals(config.max_upload_latency, 0.5)
+        self.assertEquals(config.metric_queue_size, 5000)
+        self.assertFalse(config.write_metric_logs)
+        self.assertEquals(config.compression_type, 'gzip')
+        self.assertEquals(config.compression_level, 9)
+        self.assertTrue(config.limit_compressed_request_size)
+        self.assertEquals(list(config.additional_scalyr_servers),
+                          ['https://proxy1.example.com', 'https://proxy2.example.com:8443'])
+        self.assertTrue(config.load_balance_servers)
         self.assertEquals(config.ca_cert_path, '/var/lib/foo.pem')
         self.assertFalse(config.verify_server_certificate)
 
+    def test_values_are_converted_once(self):
+        self.__write_file(""" {
+            api_key: "hi there",
+            max_allowed_request_size: "2000000",
+            min_request_spacing_interval: 2,
+            logs: [ { path:"/var/log/tomcat6/access.log"} ]
+          }
+        """)
+        config = self.__create_test_configuration_instance()
+        config.parse()
+
+        self.assertEquals(config.max_allowed_request_size, 2000000)
+        self.assertTrue(type(config.max_allowed_request_size) is int)
+        self.assertEquals(config.min_request_spacing_interval, 2.0)
+        self.assertTrue(type(config.min_request_spacing_interval) is float)
+        self.assertTrue(config.max_allowed_request_size is config.max_allowed_request_size)
+
     def test_missing_api_key(self):
         self.__write_file(""" {
             logs: [ { path:"/var/log/tomcat6/access.log"} ]
@@ -184,6 +232,15 @@ class TestConfiguration(unittest.TestCase):
         config = self.__create_test_configuration_instance()
         self.assertRaises(BadConfiguration, config.parse)
 
+    def test_non_string_additional_server(self):
+        self.__write_file(""" {
+            api_key: "hi there",
+            additional_scalyr_servers: [ "https://proxy1.example.com", 5 ],
+          }
+        """)
+        config = self.__create_test_configuration_instance()
+        self.assertRaises(BadConfiguration, config.parse)
+
     def test_non_json_attributes(self):
         self.__write_file(""" {
             api_key: "hi there",
@@ -383,6 +440,75 @@ class TestConfiguration(unittest.TestCase):
         self.assertEquals(config.server_attributes['webServer'], 'true')
         self.assertEquals(config.server_attributes['serverHost'], 'foo.com')
 
+    def test_file_set_fingerprint(self):
+        self.__write_file(""" { api_key: "hi there" } """)
+        self.__write_config_fragment_file('nginx.json', """ { logs: [ { path: "/var/log/nginx/access.log" } ] } """)
+
+        config = self.__create_test_configuration_instance()
+        config.parse()
+        self.assertTrue(config.parse_duration is not None)
+        self.assertEquals(len(config.file_set_fingerprint), 2)
+        self.assertEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+
+        # Same size and possibly the same modification time, but different contents.
+        self.__write_config_fragment_file('nginx.json', """ { logs: [ { path: "/var/log/nginx/errors.log" } ] } """)
+        self.assertNotEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+
+        config = self.__create_test_configuration_instance()
+        config.parse()
+        self.__write_config_fragment_file('apache.json', """ { logs: [ { path: "/var/log/apache/access.log" } ] } """)
+        self.assertNotEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+
+        # A configuration that failed to parse can still be checked for changes.
+        self.__write_file(""" { api_key: "hi there", """)
+        config = self.__create_test_configuration_instance()
+        self.assertRaises(BadConfiguration, config.parse)
+        self.assertEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+        self.__write_file(""" { api_key: "hi there" } """)
+        self.assertNotEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+
+    def test_file_set_fingerprint_after_equivalent_parse(self):
+        self.__write_file(""" { api_key: "hi there" } """)
+        config = self.__create_test_configuration_instance()
+        config.parse()
+
+        # Adding a comment and touching the file forces it to be parsed again, even though it is equivalent.
+        self.__write_file(""" // A comment.
+            { api_key: "hi there" } """)
+        os.utime(self.__config_file, (1000000000, 1000000000))
+        self.assertNotEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+
+        new_config = self.__create_test_configuration_instance()
+        new_config.parse()
+        self.assertTrue(config.equivalent(new_config))
+
+        # The configuration in use still differs from the files, but the check against the one just parsed is
+        # skipped until the files change again.
+        self.assertNotEquals(config.compute_file_set_fingerprint(), config.file_set_fingerprint)
+        self.assertEquals(new_config.compute_file_set_fingerprint(), new_config.file_set_fingerprint)
+
+        os.utime(self.__config_file, (1000000001, 1000000001))
+        self.assertNotEquals(new_config.compute_file_set_fingerprint(), new_config.file_set_fingerprint)
+
+    def test_get_changed_options(self):
+        self.__write_file(""" { api_key: "hi there" } """)
+        self.__write_config_fragment_file('nginx.json', """ { logs: [ { path: "/var/log/nginx/access.log" } ] } """)
+        config = self.__create_test_configuration_instance()
+        config.parse()
+
+        other_config = self.__create_test_configuration_instance()
+        other_config.parse()
+        self.assertEquals(config.get_changed_options(other_config), [])
+
+        self.__write_file(""" { api_key: "hi there", debug_level: 2, server_attributes: { webServer: "true" } } """)
+        self.__write_config_fragment_file('nginx.json', """ { logs: [ { path: "/var/log/nginx/errors.log" } ] } """)
+        other_config = self.__create_test_configuration_instance()
+        other_config.parse()
+
+        changed_options = config.get_changed_options(other_config)
+        changed_options.sort()
+        self.assertEquals(changed_options, ['debug_level', 'logs', 'server_attributes'])
+
     def test_bad_fields_in_configuration_directory(self):
         self.__write_file(""" { api_key: "hi there"
             logs: [ { path:"/var/log/tomcat6/access.log" }]
@@ -447,6 +573,31 @@ class TestConfiguration(unittest.TestCase):
         self.assertEquals(config.logs[1].config.get_json_object('attributes').get_string('parser'), 'agent-metrics')
         self.assertEquals(config.logs[2].config.get_string('path'), '/var/log/scalyr-agent-2/linux_system_metrics.log')
 
+    def test_monitors_with_metric_queue(self):
+        self.__write_file(""" {
+            api_key: "hi there",
+            metric_queue_size: 1000,
+            monitors: [ { module: "httpPuller"} ]
+          }
+        """)
+        config = self.__create_test_configuration_instance()
+        config.parse()
+
+        self.assertEquals(len(config.monitors), 3)
+        self.assertEquals(len(config.logs), 1)
+        self.assertEquals(config.logs[0].config.get_string('path'), '/var/log/scalyr-agent-2/agent.log')
+        self.assertEquals(config.monitors[0].log_config['path'], '/var/log/scalyr-agent-2/httpPuller.log')
+        self.assertEquals(config.monitors[0].log_config['parser'], 'agent-metrics')
+
+    def test_bad_metric_queue_size(self):
+        self.__write_file(""" {
+            api_key: "hi there",
+            metric_queue_size: -1
+          }
+        """)
+        config = self.__create_test_configuration_instance()
+        self.assertRaises(BadConfiguration, config.parse)
+
     def test_multiple_modules(self):
         self.__write_file(""" {
             api_key: "hi there",
@@ -22,10 +22,12 @@ __author__ = 'czerwin@scalyr.com'
 import unittest
 
 import os
+import shutil
 import tempfile
 
 from scalyr_agent.configuration import Configuration
-from scalyr_agent.copying_manager import CopyingParameters
+from scalyr_agent.copying_manager import CopyingParameters, NewLogScanner
+from scalyr_agent.log_processing import LogMatcher
 
 ONE_MB = 1024 * 1024
 
@@ -124,3 +126,50 @@ class CopyingParamsTest(unittest.TestCase):
                     JsonObject(module='scalyr_agent.builtin_monitors.linux_process_metrics',
                                pid='$$', id='agent')]
         return Configuration(self.__config_file, default_paths, monitors, log_factory, monitor_factory)
+
+
+class NewLogScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.__tempdir = tempfile.mkdtemp()
+        self.__paths_being_processed = {}
+        log_config = {'path': os.path.join(self.__tempdir, '*.log'), 'attributes': {}, 'redaction_rules': [],
+                      'sampling_rules': []}
+        self.__matcher = LogMatcher(log_config)
+        self.__scanner = NewLogScanner([self.__matcher], lambda: self.__paths_being_processed, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.__tempdir)
+
+    def test_scan(self):
+        self.assertEquals(self.__scanner.get_scan_stats(), (0, 0.0, None))
+
+        first_path = self.__create_file('first.log')
+        self.__scanner.scan()
+        self.assertEquals(self.__scanner.get_new_paths(), [(self.__matcher, first_path)])
+        self.assertEquals(self.__scanner.get_new_paths(), [])
+
+        self.__paths_being_processed[first_path] = True
+        second_path = self.__create_file('second.log')
+        self.__scanner.scan()
+        self.assertEquals(self.__scanner.get_new_paths(), [(self.__matcher, second_path)])
+
+        (total_scans, total_scan_time, last_scan_duration) = self.__scanner.get_scan_stats()
+        self.assertEquals(total_scans, 2)
+        self.assertTrue(last_scan_duration is not None)
+
+    def test_set_log_matchers(self):
+        log_config = {'path': os.path.join(self.__tempdir, '*.txt'), 'attributes': {}, 'redaction_rules': [],
+                      'sampling_rules': []}
+        other_matcher = LogMatcher(log_config)
+        self.__scanner.set_log_matchers([other_matcher])
+
+        self.__create_file('first.log')
+        second_path = self.__create_file('second.txt')
+        self.__scanner.scan()
+        self.assertEquals(self.__scanner.get_new_paths(), [(other_matcher, second_path)])
+
+    def __create_file(self, name):
+        path = os.path.join(self.__tempdir, name)
+        fp = open(path, 'w')
+        fp.close()
+        return path
@@ -17,13 +17,16 @@
 
 __author__ = 'czerwin@scalyr.com'
 
+import glob
 import os
 import shutil
 import tempfile
 import unittest
 
+from scalyr_agent import json_lib
 from scalyr_agent.log_processing import LogFileIterator, LogLineSampler, LogLineRedacter, LogFileProcessor
-from scalyr_agent.log_processing import FileSystem
+from scalyr_agent.log_processing import FileSystem, LogMatcher, IncrementalGlob, MetricQueueProcessor
+from scalyr_agent.scalyr_logging import MetricEventQueue
 
 
 class TestLogFileIterator(unittest.TestCase):
@@ -568,6 +571,125 @@ class TestLogLineSampler(unittest.TestCase):
         self.assertEquals(sampler.process_line('INFO Here is a line\n'), 0.2)
 
 
+class TestLogMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.__tempdir = tempfile.mkdtemp()
+        self.__glob = os.path.join(self.__tempdir, '*.log')
+        self.__log_config = {'path': self.__glob, 'attributes': {'parser': 'test'}, 'redaction_rules': [],
+                             'sampling_rules': []}
+
+    def tearDown(self):
+        shutil.rmtree(self.__tempdir)
+
+    def test_find_new_paths(self):
+        self.__create_file('a.log')
+        self.__create_file('b.log')
+        self.__create_file('c.txt')
+
+        matcher = LogMatcher(self.__log_config)
+        existing = {os.path.join(self.__tempdir, 'a.log'): True}
+        self.assertEquals(matcher.find_new_paths(existing), [os.path.join(self.__tempdir, 'b.log')])
+
+    def test_create_processor(self):
+        self.__create_file('a.log')
+        path = os.path.join(self.__tempdir, 'a.log')
+
+        matcher = LogMatcher(self.__log_config)
+        previous_state = {path: LogFileProcessor.create_checkpoint(0)}
+        processor = matcher.create_processor(path, previous_state)
+
+        self.assertEquals(processor.log_path, path)
+        self.assertEquals(len(previous_state), 0)
+        self.assertEquals(len(matcher.generate_status().log_processors_status), 1)
+
+    def test_find_new_paths_only_returns_changes(self):
+        self.__create_file('a.log')
+
+        matcher = LogMatcher(self.__log_config)
+        self.assertEquals(matcher.find_new_paths({}), [os.path.join(self.__tempdir, 'a.log')])
+        # Not returned again since the directory has not changed, even though it is not being processed.
+        os.utime(self.__tempdir, (1000, 1000))
+        matcher.find_new_paths({})
+        self.assertEquals(matcher.find_new_paths({}), [])
+
+        self.__create_file('b.log')
+        os.utime(self.__tempdir, (2000, 2000))
+        self.assertEquals(sorted(matcher.find_new_paths({})),
+                          [os.path.join(self.__tempdir, 'a.log'), os.path.join(self.__tempdir, 'b.log')])
+
+    def __create_file(self, name):
+        fp = open(os.path.join(self.__tempdir, name), 'w')
+        fp.write('hi\n')
+        fp.close()
+
+
+class TestIncrementalGlob(unittest.TestCase):
+
+    def setUp(self):
+        self.__tempdir = tempfile.mkdtemp()
+        self.__current_time = 10000.0
+        for directory in ['app1', 'app2', 'app2/nested', 'app3', 'app3/nested']:
+            self.__create_directory(directory)
+        for name in ['app1/a.log', 'app1/b.log', 'app1/.hidden.log', 'app1/c.txt', 'app2/a.log', 'app2/nested/d.log',
+                     'app3/nested/d.log']:
+            self.__create_file(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.__tempdir)
+
+    def test_same_as_glob(self):
+        for pattern in ['*/*.log', '*/a.log', 'app1/*', '*/nested/*.log', 'app[12]/?.log', '*/', 'app1/.*']:
+            full_pattern = os.path.join(self.__tempdir, pattern)
+            self.assertEquals(sorted(IncrementalGlob(full_pattern).find_matches()), sorted(glob.glob(full_pattern)))
+
+    def test_changed_directories_only(self):
+        incremental_glob = IncrementalGlob(os.path.join(self.__tempdir, '*/*.log'), full_rescan_interval=300)
+        self.assertEquals(len(self.__find_changed(incremental_glob)), 3)
+        self.assertEquals(self.__find_changed(incremental_glob), [])
+
+        self.__create_file('app2/e.log')
+        self.__create_directory('app4')
+        self.__create_file('app4/f.log')
+        self.assertEquals(sorted(self.__find_changed(incremental_glob)),
+                          [self.__path('app2/a.log'), self.__path('app2/e.log'), self.__path('app4/f.log')])
+        self.assertEquals(self.__find_changed(incremental_glob), [])
+
+        # Make sure everything is returned once the full rescan interval has passed.
+        self.__current_time += 300
+        self.assertEquals(len(self.__find_changed(incremental_glob)), 5)
+
+    def test_recently_modified_directory_is_listed_again(self):
+        incremental_glob = IncrementalGlob(os.path.join(self.__tempdir, 'app1/*.log'))
+        os.utime(self.__path('app1'), (self.__current_time, self.__current_time))
+        self.assertEquals(len(self.__find_changed(incremental_glob)), 2)
+        self.assertEquals(len(self.__find_changed(incremental_glob)), 2)
+        self.__current_time += 10
+        self.assertEquals(len(self.__find_changed(incremental_glob)), 0)
+
+    def __find_changed(self, incremental_glob):
+        self.__current_time += 1
+        return incremental_glob.find_matches(changed_directories_only=True, current_time=self.__current_time)
+
+    def __path(self, name):
+        return os.path.join(self.__tempdir, name)
+
+    def __create_directory(self, name):
+        os.mkdir(self.__path(name))
+        self.__touch_parent(name)
+
+    def __create_file(self, name):
+        fp = open(self.__path(name), 'w')
+        fp.close()
+        self.__touch_parent(name)
+
+    def __touch_parent(self, name):
+        # Give the parent directory a distinct modification time that is old relative to the fake current time.
+        self.__current_time += 10
+        mtime = self.__current_time - 5
+        os.utime(os.path.dirname(self.__path(name)), (mtime, mtime))
+
+
 class TestLogFileProcessor(unittest.TestCase):
 
     def setUp(self):
@@ -736,6 +858,88 @@ class TestLogFileProcessor(unittest.TestCase):
         self.assertEquals('scalyr-1', events.events[0]['attrs']['host'])
         self.assertEquals('scalyr-1', events.events[1]['attrs']['host'])
 
+    def test_is_idle(self):
+        log_processor = self.log_processor
+        self.assertFalse(log_processor.is_idle(60, current_time=self.__fake_time + 30))
+        self.assertTrue(log_processor.is_idle(60, current_time=self.__fake_time + 60))
+
+        # New bytes reset the idle time, and the processor is not idle until they have been copied.
+        self.append_file(self.__path, 'First line\n')
+        log_processor.scan_for_new_bytes(current_time=self.__fake_time + 100)
+        self.assertFalse(log_processor.is_idle(60, current_time=self.__fake_time + 200))
+
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = log_processor.perform_processing(
+            events, current_time=self.__fake_time + 100)
+        self.assertFalse(log_processor.is_idle(60, current_time=self.__fake_time + 200))
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+        self.assertTrue(log_processor.is_idle(60, current_time=self.__fake_time + 200))
+
+    def test_close_and_resume_from_checkpoint(self):
+        log_processor = self.log_processor
+        self.append_file(self.__path, 'First line\n')
+
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+
+        checkpoint = log_processor.get_checkpoint()
+        log_processor.close()
+        self.assertTrue(log_processor.is_closed())
+
+        self.append_file(self.__path, 'Second line\n')
+        log_processor = LogFileProcessor(self.__path, file_system=self.__file_system, log_attributes={},
+                                         checkpoint=checkpoint)
+
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+        self.assertEquals(1, events.total_events())
+        self.assertEquals(events.get_message(0), 'Second line\n')
+
+    def test_rejected_event_carried_over(self):
+        log_processor = self.log_processor
+        self.append_file(self.__path, 'First line\nSecond line\n')
+
+        events = TestLogFileProcessor.TestAddEventsRequest(limit=1)
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertTrue(buffer_full)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+        self.assertEquals(1, events.total_events())
+        self.assertEquals(events.get_message(0), 'First line\n')
+
+        # The second line should be sent using the event that was created for the first request, so the new
+        # redaction rule is not applied to it.
+        log_processor.add_redacter('Second', 'Redacted')
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+        self.assertEquals(1, events.total_events())
+        self.assertEquals(events.get_message(0), 'Second line\n')
+
+        status = log_processor.generate_status()
+        self.assertEquals(23L, status.total_bytes_copied)
+        self.assertEquals(2L, status.total_lines_copied)
+
+    def test_rejected_line_not_reused_after_retry(self):
+        log_processor = self.log_processor
+        self.append_file(self.__path, 'Same line\nSame line\n')
+
+        events = TestLogFileProcessor.TestAddEventsRequest(limit=1)
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertTrue(buffer_full)
+        self.assertFalse(completion_callback(LogFileProcessor.FAIL_AND_RETRY))
+
+        # The first line has the same contents as the rejected one, but it was read from a different position, so
+        # it must be processed again with the new redaction rule.
+        log_processor.add_redacter('Same', 'Redacted')
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = log_processor.perform_processing(events, current_time=self.__fake_time)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+        self.assertEquals(2, events.total_events())
+        self.assertEquals(events.get_message(0), 'Redacted line\n')
+        self.assertEquals(events.get_message(1), 'Redacted line\n')
+
     def write_file(self, path, *lines):
         contents = ''.join(lines)
         file_handle = open(path, 'w')
@@ -760,6 +964,9 @@ class TestLogFileProcessor(unittest.TestCase):
             else:
                 return False
 
+        def add_serialized_event(self, serialized_event):
+            return self.add_event(json_lib.parse(serialized_event))
+
         def position(self):
             return len(self.events)
 
@@ -773,5 +980,114 @@ class TestLogFileProcessor(unittest.TestCase):
         def total_events(self):
             return len(self.events)
 
+
+class TestMetricQueueProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.__monitor = TestMetricQueueProcessor.FakeMonitor({
+            'path': '/var/log/scalyr-agent-2/foo.log', 'parser': 'agent-metrics', 'attributes': {'region': 'east'},
+            'sampling_rules': [], 'redaction_rules': [{'match_expression': 'secret', 'replacement': 'xxx'}]})
+        self.__metric_queue = MetricEventQueue(10)
+        self.__processor = MetricQueueProcessor(self.__metric_queue)
+
+    def test_basic_usage(self):
+        self.__metric_queue.put((0.0, 'foo(1)', 'test_name 5', self.__monitor))
+        self.__metric_queue.put((1.5, 'foo(1)', 'secret 6', self.__monitor))
+        self.assertEquals(self.__processor.scan_for_new_bytes(), 19)
+
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events)
+        self.assertFalse(buffer_full)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+
+        self.assertEquals(2, events.total_events())
+        self.assertEquals(events.get_message(0), '1970-01-01 00:00:00.000Z [foo(1)] test_name 5\n')
+        self.assertEquals(events.get_message(1), '1970-01-01 00:00:01.500Z [foo(1)] xxx 6\n')
+        # The lines have the same attributes they would have had if they were copied from the metric log.
+        attrs = events.events[0]['attrs']
+        self.assertEquals(attrs['parser'], 'agent-metrics')
+        self.assertEquals(attrs['region'], 'east')
+        self.assertEquals(attrs['logfile'], '/var/log/scalyr-agent-2/foo.log')
+
+        status = self.__processor.generate_status()
+        self.assertEquals(2L, status.total_lines_copied)
+        self.assertEquals(0L, status.total_lines_pending)
+        self.assertEquals(1L, status.total_redactions)
+
+    def test_fail_and_retry(self):
+        self.__metric_queue.put((0.0, 'foo(1)', 'first', self.__monitor))
+        self.__metric_queue.put((0.0, 'foo(1)', 'second', self.__monitor))
+
+        events = TestLogFileProcessor.TestAddEventsRequest(limit=1)
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events)
+        self.assertTrue(buffer_full)
+        self.assertEquals(1, events.total_events())
+        self.assertEquals(self.__metric_queue.get_stats()[0], 1)
+
+        # The line that was sent goes back in front of the one that did not fit.
+        self.assertFalse(completion_callback(LogFileProcessor.FAIL_AND_RETRY))
+        self.assertEquals([x[2] for x in self.__metric_queue.take_all()], ['first', 'second'])
+        self.assertEquals(0L, self.__processor.generate_status().total_lines_copied)
+
+    def test_max_bytes(self):
+        for i in range(0, 5):
+            self.__metric_queue.put((0.0, 'foo(1)', 'line %d' % i, self.__monitor))
+
+        # Each serialized line is more than 100 bytes, so only the first one is added.  The request is not full.
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events, max_bytes=100)
+        self.assertFalse(buffer_full)
+        self.assertEquals(1, events.total_events())
+        self.assertEquals(self.__metric_queue.get_stats()[0], 4)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events)
+        self.assertEquals(5, events.total_events())
+        self.assertEquals(self.__metric_queue.get_stats()[0], 0)
+
+    def test_retry_keeps_sampling_result(self):
+        self.__monitor.log_config['sampling_rules'] = [{'match_expression': 'sampled', 'sampling_rate': 0.5}]
+        for i in range(0, 10):
+            self.__metric_queue.put((0.0, 'foo(1)', 'sampled %d' % i, self.__monitor))
+
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events)
+        sent_lines = [events.get_message(i) for i in range(0, events.total_events())]
+        self.assertFalse(completion_callback(LogFileProcessor.FAIL_AND_RETRY))
+        self.assertEquals(self.__metric_queue.get_stats()[0], 10)
+
+        # The same lines are sent again, rather than sampling them again.
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        (completion_callback, buffer_full) = self.__processor.perform_processing(events)
+        self.assertEquals([events.get_message(i) for i in range(0, events.total_events())], sent_lines)
+        self.assertFalse(completion_callback(LogFileProcessor.SUCCESS))
+
+        status = self.__processor.generate_status()
+        self.assertEquals(len(sent_lines), status.total_lines_copied)
+        self.assertEquals(10 - len(sent_lines), status.total_lines_dropped_by_sampling)
+
+    def test_log_config_change(self):
+        self.__metric_queue.open_monitor(self.__monitor)
+        self.__metric_queue.put((0.0, 'foo(1)', 'secret 5', self.__monitor))
+        events = TestLogFileProcessor.TestAddEventsRequest()
+        self.__processor.perform_processing(events)
+        self.assertEquals(events.get_message(0), '1970-01-01 00:00:00.000Z [foo(1)] xxx 5\n')
+
+        # The monitor's new rules are used even though it is still open.
+        self.__monitor.log_config['redaction_rules'][0]['replacement'] = 'yyy'
+        self.__metric_queue.put((0.0, 'foo(1)', 'secret 6', self.__monitor))
+        self.__processor.perform_processing(events)
+        self.assertEquals(events.get_message(1), '1970-01-01 00:00:00.000Z [foo(1)] yyy 6\n')
+
+        # Lines still in the queue when the monitor is closed are sent.
+        self.__metric_queue.put((0.0, 'foo(1)', 'secret 7', self.__monitor))
+        self.__metric_queue.close_monitor(self.__monitor)
+        self.__processor.perform_processing(events)
+        self.assertEquals(events.get_message(2), '1970-01-01 00:00:00.000Z [foo(1)] yyy 7\n')
+
+    class FakeMonitor(object):
+        def __init__(self, log_config):
+            self.log_config = log_config
+
 if __name__ == '__main__':
     unittest.main()
@@ -17,9 +17,18 @@
 
 __author__ = 'czerwin@scalyr.com'
 
+import gzip
+import socket
 import unittest
+import zlib
 
-from scalyr_agent.scalyr_client import AddEventsRequest
+from cStringIO import StringIO
+
+import scalyr_agent.scalyr_client as scalyr_client
+
+from scalyr_agent import json_lib
+from scalyr_agent.scalyr_client import AddEventsRequest, BufferPool, ConnectionPool, PendingRequest, ServerEndpoint
+from scalyr_agent.scalyr_client import EventSerializer
 
 
 class AddEventsRequestTest(unittest.TestCase):
@@ -61,6 +70,32 @@ class AddEventsRequestTest(unittest.TestCase):
                           """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"}], client_time: 1 }""")
         request.close()
 
+    def test_add_serialized_event(self):
+        request = AddEventsRequest(self.__body)
+        request.set_client_time(1)
+        self.assertTrue(request.add_serialized_event(request.serialize_event({'name': 'eventOne'}), timestamp=1L))
+        self.assertTrue(request.add_serialized_event(request.serialize_event({}), timestamp=2L))
+        self.assertEquals(
+            request.get_payload(),
+            """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"},{"ts":"2"}], client_time: 1 }""")
+        size = request.get_size()
+        request.close()
+
+        # The size is computed before the event is written, so it must be exact.
+        request = AddEventsRequest(self.__body, max_size=size - 1)
+        self.assertTrue(request.add_serialized_event(request.serialize_event({'name': 'eventOne'}), timestamp=1L))
+        self.assertFalse(request.add_serialized_event(request.serialize_event({}), timestamp=2L))
+        request.set_client_time(1)
+        self.assertEquals(request.get_payload(),
+                          """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"}], client_time: 1 }""")
+        request.close()
+
+        request = AddEventsRequest(self.__body, max_size=size)
+        self.assertTrue(request.add_serialized_event(request.serialize_event({'name': 'eventOne'}), timestamp=1L))
+        self.assertTrue(request.add_serialized_event(request.serialize_event({}), timestamp=2L))
+        self.assertEquals(request.get_size(), size)
+        request.close()
+
     def test_set_position(self):
         request = AddEventsRequest(self.__body)
         request.set_client_time(1)
@@ -94,4 +129,316 @@ class AddEventsRequestTest(unittest.TestCase):
             request.get_payload(),
             """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"},{"name":"eventTwo","ts":"2"}]"""
             """, client_time: 2 }""")
-        request.close()
\ No newline at end of file
+        request.close()
+
+    def test_create_prefix(self):
+        self.assertEquals(AddEventsRequest.create_prefix(self.__body), '{"token":"fakeToken", events: [')
+
+        prefix = AddEventsRequest.create_prefix({'token': 'otherToken'})
+        request = AddEventsRequest(self.__body, prefix=prefix)
+        request.set_client_time(1)
+        self.assertTrue(request.add_event({'name': 'eventOne'}, timestamp=1L))
+        self.assertEquals(request.get_payload(),
+                          """{"token":"otherToken", events: [{"name":"eventOne","ts":"1"}], client_time: 1 }""")
+        request.close()
+
+    def test_buffer_pool(self):
+        pool = BufferPool()
+        request = AddEventsRequest(self.__body, buffer_pool=pool)
+        request.set_client_time(1)
+        self.assertTrue(request.add_event({'name': 'eventOne'}, timestamp=1L))
+        request.get_payload()
+        request.close()
+
+        # The second request should reuse the buffer, starting from an empty one.
+        request = AddEventsRequest(self.__body, buffer_pool=pool)
+        request.set_client_time(2)
+        self.assertTrue(request.add_event({'name': 'eventTwo'}, timestamp=2L))
+        self.assertEquals(request.get_payload(),
+                          """{"token":"fakeToken", events: [{"name":"eventTwo","ts":"2"}], client_time: 2 }""")
+        request.close()
+
+    def test_payload_segments(self):
+        request = AddEventsRequest(self.__body)
+        request.set_client_time(1)
+        self.assertTrue(request.add_event({'name': 'eventOne'}, timestamp=1L))
+
+        segments = request.get_payload_segments()
+        self.assertEquals(''.join(segments), request.get_payload())
+
+        # Only the segment holding the client time should be recreated when the client time changes.
+        request.set_client_time(2)
+        new_segments = request.get_payload_segments()
+        self.assertTrue(new_segments[0] is segments[0])
+        self.assertEquals(''.join(new_segments),
+                          """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"}], client_time: 2 }""")
+        request.close()
+
+
+class CompressedAddEventsRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__body = {'token': 'fakeToken'}
+
+    def test_deflate(self):
+        self.__assert_same_as_uncompressed('deflate', zlib.decompress)
+
+    def test_gzip(self):
+        self.__assert_same_as_uncompressed('gzip', self.__gunzip)
+
+    def test_set_client_time(self):
+        request = AddEventsRequest(self.__body, compression_type='deflate')
+        request.set_client_time(100)
+        self.assertTrue(request.add_event({'name': 'eventOne'}, timestamp=1L))
+        request.get_payload()
+
+        events_segment = request.get_payload_segments()[0]
+
+        request.set_client_time(2)
+        self.assertTrue(request.get_payload_segments()[0] is events_segment)
+        self.assertEquals(zlib.decompress(request.get_payload()),
+                          """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"}], client_time: 2 }""")
+        request.close()
+
+    def test_set_position(self):
+        request = AddEventsRequest(self.__body, max_size=10*1024*1024, compression_type='gzip')
+        request.set_client_time(1)
+        self.assertTrue(request.add_event({'name': 'eventOne'}, timestamp=1L))
+
+        # Add enough events that some of them have been fed to the compressor before rolling back.
+        position = request.position()
+        for i in range(0, 10000):
+            self.assertTrue(request.add_event({'name': 'event%d' % i}, timestamp=2L))
+        request.set_position(position)
+        self.assertTrue(request.add_event({'name': 'eventThree'}, timestamp=3L))
+
+        self.assertEquals(
+            self.__gunzip(request.get_payload()),
+            """{"token":"fakeToken", events: [{"name":"eventOne","ts":"1"},{"name":"eventThree","ts":"3"}]"""
+            """, client_time: 1 }""")
+        request.close()
+
+    def test_only_latest_position_can_be_restored(self):
+        request = AddEventsRequest(self.__body, compression_type='deflate')
+        position = request.position()
+        request.position()
+        self.assertRaises(Exception, request.set_position, position)
+
+    def test_limit_compressed_size(self):
+        raw_request = AddEventsRequest(self.__body, max_size=20*1024)
+        compressed_request = AddEventsRequest(self.__body, max_size=20*1024, compression_type='deflate',
+                                              limit_compressed_size=True)
+
+        raw_events = self.__add_events_until_full(raw_request)
+        compressed_events = self.__add_events_until_full(compressed_request)
+
+        self.assertTrue(compressed_events > 2 * raw_events)
+        self.assertTrue(len(compressed_request.get_payload()) <= 20*1024)
+        self.assertTrue(compressed_request.get_uncompressed_size() > 40*1024)
+
+    def __add_events_until_full(self, request):
+        count = 0
+        while request.add_event({'attrs': {'message': 'processed request id=%d\n' % count}}, timestamp=1L):
+            count += 1
+        return count
+
+    def __assert_same_as_uncompressed(self, compression_type, decompress):
+        raw_request = AddEventsRequest(self.__body)
+        compressed_request = AddEventsRequest(self.__body, compression_type=compression_type)
+        for request in [raw_request, compressed_request]:
+            request.set_client_time(1)
+            for i in range(0, 5000):
+                self.assertTrue(request.add_event({'attrs': {'message': 'line %d' % i}}, timestamp=1L))
+
+        compressed = compressed_request.get_payload()
+        self.assertTrue(len(compressed) < len(raw_request.get_payload()))
+        self.assertEquals(decompress(compressed), raw_request.get_payload())
+        self.assertEquals(compressed_request.get_uncompressed_size(), len(raw_request.get_payload()))
+
+    def __gunzip(self, compressed):
+        return gzip.GzipFile(fileobj=StringIO(compressed)).read()
+
+
+class EventSerializerTest(unittest.TestCase):
+
+    def test_fixed_order(self):
+        serializer = EventSerializer({'logfile': '/var/log/foo.log', 'parser': 'accessLog'})
+        self.assertEquals(serializer.serialize('Hi there\n'),
+                          '{"attrs":{"logfile":"/var/log/foo.log","parser":"accessLog","message":"Hi there\\n"}}')
+        self.assertEquals(serializer.serialize('Hi', 0.5),
+                          '{"attrs":{"logfile":"/var/log/foo.log","parser":"accessLog","message":"Hi",'
+                          '"sample_rate":0.5}}')
+        self.assertEquals(EventSerializer({}).serialize('Hi'), '{"attrs":{"message":"Hi"}}')
+
+    def test_same_as_json_lib(self):
+        for attributes in [{}, {'logfile': 'foo.log'}, {'message': 'ignored', 'sample_rate': 0.2},
+                           {'parser': 'json', 'count': 5, 'nested': {'b': True, 'a': None}}]:
+            serializer = EventSerializer(attributes)
+            for message in ['Hi there', 'Quote " and slash \\ \t\5\177\n', u'Unicode \u20ac']:
+                for sample_rate in [1.0, 0.5, 0.125]:
+                    attrs = dict(attributes)
+                    attrs['message'] = message
+                    if sample_rate != 1.0:
+                        attrs['sample_rate'] = sample_rate
+                    expected = json_lib.serialize({'attrs': attrs}, use_fast_encoding=True)
+
+                    actual = serializer.serialize(message, sample_rate)
+                    self.assertEquals(len(actual), len(expected))
+                    self.assertEquals(json_lib.parse(actual), json_lib.parse(expected))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__sockets = []
+
+    def tearDown(self):
+        for sock in self.__sockets:
+            sock.close()
+
+    def test_reuses_connection(self):
+        pool = ConnectionPool()
+        connection = self.__create_connection()[0]
+        pool.put(connection, current_time=1.0)
+
+        self.assertTrue(pool.get(current_time=2.0) is connection)
+        self.assertTrue(pool.get(current_time=2.0) is None)
+
+    def test_discards_closed_by_server(self):
+        pool = ConnectionPool()
+        connection, peer = self.__create_connection()
+        pool.put(connection, current_time=1.0)
+
+        peer.close()
+        self.assertTrue(pool.get(current_time=2.0) is None)
+        self.assertTrue(connection.closed)
+
+    def test_discards_idle_connection(self):
+        pool = ConnectionPool(max_idle_time=10.0)
+        connection = self.__create_connection()[0]
+        pool.put(connection, current_time=1.0)
+
+        self.assertTrue(pool.get(current_time=12.0) is None)
+        self.assertTrue(connection.closed)
+
+    def test_max_idle_connections(self):
+        pool = ConnectionPool(max_idle_connections=1)
+        first = self.__create_connection()[0]
+        second = self.__create_connection()[0]
+        pool.put(first, current_time=1.0)
+        pool.put(second, current_time=1.0)
+
+        self.assertTrue(first.closed)
+        self.assertTrue(pool.get(current_time=2.0) is second)
+
+    def __create_connection(self):
+        """Returns a fake connection and the socket for the server side of it."""
+        client, server = socket.socketpair()
+        self.__sockets.extend([client, server])
+        return FakeConnection(client), server
+
+
+class ServerEndpointTest(unittest.TestCase):
+
+    def test_parse_address(self):
+        endpoint = ServerEndpoint('https://proxy.example.com:8443')
+        self.assertEquals(endpoint.host, 'proxy.example.com')
+        self.assertEquals(endpoint.port, 8443)
+        self.assertTrue(endpoint.use_ssl)
+
+        endpoint = ServerEndpoint('http://proxy.example.com')
+        self.assertEquals(endpoint.port, 80)
+        self.assertFalse(endpoint.use_ssl)
+
+        self.assertRaises(Exception, ServerEndpoint, 'ftp://proxy.example.com')
+
+    def test_reconnect_backoff(self):
+        endpoint = ServerEndpoint('https://proxy.example.com')
+        self.assertTrue(endpoint.is_available(1.0))
+
+        min_delay = scalyr_client.MIN_RECONNECT_DELAY
+        endpoint.record_failure(1.0)
+        self.assertFalse(endpoint.is_available(1.0 + 0.5 * min_delay))
+        self.assertTrue(endpoint.is_available(1.0 + 1.5 * min_delay))
+
+        # The delay doubles with each consecutive failure until there is a success.
+        endpoint.record_failure(2.0)
+        self.assertFalse(endpoint.is_available(2.0 + 1.5 * min_delay))
+        self.assertTrue(endpoint.is_available(2.0 + 2.5 * min_delay))
+
+        for i in range(0, 20):
+            endpoint.record_failure(3.0)
+        self.assertFalse(endpoint.is_available(3.0 + 0.5 * scalyr_client.MAX_RECONNECT_DELAY))
+        self.assertTrue(endpoint.is_available(3.0 + 1.5 * scalyr_client.MAX_RECONNECT_DELAY))
+
+        endpoint.record_success(4.0, 0.1)
+        endpoint.record_failure(5.0)
+        self.assertTrue(endpoint.is_available(5.0 + 1.5 * min_delay))
+
+    def test_expected_latency(self):
+        endpoint = ServerEndpoint('https://proxy.example.com')
+        self.assertEquals(endpoint.get_expected_latency(1.0), 0.0)
+
+        endpoint.record_success(1.0, 1.0)
+        endpoint.record_success(2.0, 2.0)
+        self.assertAlmostEquals(endpoint.get_expected_latency(2.0), 1.0 + scalyr_client.LATENCY_AVERAGE_WEIGHT)
+
+        # Once the latency is stale, it should be ignored so that the server is tried again.
+        self.assertEquals(endpoint.get_expected_latency(2.0 + scalyr_client.MAX_LATENCY_AGE), 0.0)
+
+
+class PendingRequestTest(unittest.TestCase):
+
+    def test_completed(self):
+        pending_request = PendingRequest(deadline=10.0)
+        self.assertFalse(pending_request.wait(0.0, current_time=1.0))
+
+        pending_request.set_result(('success', 10, '{"status":"success"}'))
+        self.assertTrue(pending_request.wait(0.0, current_time=1.0))
+        self.assertEquals(pending_request.get_result()[0], 'success')
+
+    def test_deadline(self):
+        client, server = socket.socketpair()
+        try:
+            pending_request = PendingRequest(deadline=0.0)
+            pending_request.set_connection(FakeConnection(client))
+
+            # Passing the deadline shuts down the connection, which causes the sending thread to fail.
+            self.assertFalse(pending_request.wait(0.0))
+            self.assertTrue(pending_request.is_timed_out())
+            self.assertEquals(client.recv(1), '')
+
+            pending_request.set_result(('requestFailed', 10, ''))
+            self.assertTrue(pending_request.wait(0.0))
+            self.assertEquals(pending_request.get_result(), ('requestTimedOut', 10, ''))
+        finally:
+            client.close()
+            server.close()
+
+
+class SuccessResponsePatternTest(unittest.TestCase):
+
+    def test_matches_success(self):
+        self.assertTrue(self.__matches('{"status":"success"}'))
+        self.assertTrue(self.__matches(' {\n  "status" : "success" }\n'))
+
+    def test_falls_back_for_everything_else(self):
+        self.assertFalse(self.__matches('{"status": "success", "bytesCharged": 1234}'))
+        self.assertFalse(self.__matches('{"status":"success", <garbage>}'))
+        self.assertFalse(self.__matches('{"status":"error/client/badParam","message":"Bad key"}'))
+        self.assertFalse(self.__matches('{"status":"successful"}'))
+        self.assertFalse(self.__matches('{"message":"hi","status":"success"}'))
+        self.assertFalse(self.__matches('{"status":"success"'))
+        self.assertFalse(self.__matches(''))
+
+    def __matches(self, response):
+        return scalyr_client.SUCCESS_RESPONSE_PATTERN.match(response) is not None
+
+
+class FakeConnection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+
+    def close(self):
+        self.closed = True
@@ -152,6 +152,66 @@ class ScalyrLoggingTest(unittest.TestCase):
 
         monitor_logger.closeMetricLog()
 
+    def test_metric_queue(self):
+        monitor_instance = ScalyrLoggingTest.FakeMonitor('testing')
+        metric_file_path = tempfile.mktemp('.log')
+        metric_queue = scalyr_logging.MetricEventQueue(10)
+
+        scalyr_logging.set_metric_queue(metric_queue, write_metric_logs=False)
+        try:
+            monitor_logger = scalyr_logging.getLogger('scalyr_agent.builtin_monitors.foo(1)')
+            monitor_logger.openMetricLogForMonitor(metric_file_path, monitor_instance)
+            self.assertTrue(monitor_instance in metric_queue.get_open_monitors())
+            monitor_logger.emit_value('test_name', 5, {'foo': 5})
+            monitor_logger.closeMetricLog()
+            self.assertFalse(monitor_instance in metric_queue.get_open_monitors())
+        finally:
+            scalyr_logging.set_metric_queue(None)
+
+        self.assertEquals(monitor_instance.reported_lines, 1)
+        # The value should only be in the queue since the metric log was not requested.
+        self.assertFalse(os.path.exists(metric_file_path))
+        self.assertFalse(self.__log_contains('foo=5'))
+
+        events = metric_queue.take_all()
+        self.assertEquals(len(events), 1)
+        self.assertTrue(events[0][3] is monitor_instance)
+        self.assertTrue(re.match('\\d{4}-\\d{2}-\\d{2} \\d{2}:\\d{2}:\\d{2}.\\d{3}Z \[foo\(1\)\] test_name 5 foo=5\n$',
+                                 scalyr_logging.format_metric_event(events[0])))
+
+    def test_metric_queue_with_metric_log(self):
+        monitor_instance = ScalyrLoggingTest.FakeMonitor('testing')
+        metric_file_path = tempfile.mktemp('.log')
+        metric_queue = scalyr_logging.MetricEventQueue(10)
+
+        scalyr_logging.set_metric_queue(metric_queue)
+        try:
+            monitor_logger = scalyr_logging.getLogger('scalyr_agent.builtin_monitors.foo(1)')
+            monitor_logger.openMetricLogForMonitor(metric_file_path, monitor_instance)
+            monitor_logger.emit_value('test_name', 5)
+            monitor_logger.closeMetricLog()
+        finally:
+            scalyr_logging.set_metric_queue(None)
+
+        self.assertTrue(self.__log_contains('test_name 5', file_path=metric_file_path))
+        self.assertEquals(metric_queue.get_stats()[0], 1)
+
+    def test_metric_queue_limit(self):
+        metric_queue = scalyr_logging.MetricEventQueue(2)
+        self.assertTrue(metric_queue.put((0.0, 'foo', 'first', None)))
+        self.assertTrue(metric_queue.put((0.0, 'foo', 'second', None)))
+        self.assertFalse(metric_queue.put((0.0, 'foo', 'third', None)))
+        self.assertEquals(metric_queue.get_stats(), (2, 11, 1))
+
+        events = metric_queue.take_all()
+        self.assertEquals(metric_queue.get_stats(), (0, 0, 1))
+        self.assertTrue(metric_queue.put((0.0, 'foo', 'fourth', None)))
+
+        # Lines that could not be sent go back to the front of the queue, even if it is full.
+        metric_queue.put_back(events)
+        self.assertEquals(metric_queue.get_stats(), (3, 17, 1))
+        self.assertEquals([x[2] for x in metric_queue.take_all()], ['first', 'second', 'fourth'])
+
     def test_rate_limit(self):
         self.__log_path = tempfile.mktemp('.log')
         scalyr_logging.set_log_destination(use_disk=True, logs_directory=os.path.dirname(self.__log_path),
@@ -23,7 +23,7 @@ import unittest
 
 import scalyr_agent.util as scalyr_util
 
-from scalyr_agent.util import JsonReadFileException, RateLimiter, FakeRunState
+from scalyr_agent.util import JsonReadFileException, RateLimiter, FakeRunState, Histogram
 from scalyr_agent.json_lib import JsonObject
 
 
@@ -92,6 +92,41 @@ class TestRateLimiter(unittest.TestCase):
         self.assertTrue(self.charge_if_available(60))
 
 
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.__histogram = Histogram([1.0, 2.0, 4.0, 8.0])
+
+    def test_empty(self):
+        self.assertEquals(self.__histogram.count(), 0)
+        self.assertTrue(self.__histogram.average() is None)
+        self.assertTrue(self.__histogram.percentile(50) is None)
+
+    def test_percentile(self):
+        for value in [0.5, 1.5, 1.5, 3.0, 3.0, 3.0, 3.0, 3.0, 3.0, 7.0]:
+            self.__histogram.add(value)
+
+        self.assertEquals(self.__histogram.count(), 10)
+        self.assertAlmostEquals(self.__histogram.average(), 2.85)
+        self.assertEquals(self.__histogram.percentile(10), 1.0)
+        self.assertEquals(self.__histogram.percentile(50), 4.0)
+        # The estimate is never larger than the largest value.
+        self.assertEquals(self.__histogram.percentile(99), 7.0)
+
+    def test_overflow_bucket(self):
+        self.__histogram.add(3.0)
+        self.__histogram.add(20.0)
+        self.assertEquals(self.__histogram.percentile(99), 20.0)
+
+    def test_reset(self):
+        self.__histogram.add(3.0)
+        self.__histogram.reset()
+        self.assertEquals(self.__histogram.count(), 0)
+        self.assertTrue(self.__histogram.percentile(50) is None)
+
+    def test_exponential_bounds(self):
+        self.assertEquals(Histogram.exponential_bounds(1.0, 2.0, 4), [1.0, 2.0, 4.0, 8.0])
+
+
 class TestRunState(unittest.TestCase):
 
     def test_basic_use(self):
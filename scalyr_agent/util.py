@@ -18,6 +18,7 @@
 __author__ = 'czerwin@scalyr.com'
 
 import base64
+import bisect
 import os
 import random
 import threading
@@ -321,4 +322,114 @@ class RateLimiter(object):
             self.__bucket_contents -= num_bytes
             return True
 
-        return False
\ No newline at end of file
+        return False
+
+
+class Histogram(object):
+    """Tracks the distribution of a series of values, such as latencies, using a fixed set of buckets.
+
+    This allows percentiles to be estimated over an unbounded number of values while using a constant amount of
+    memory.  The estimate for a percentile is the upper bound of the bucket it falls in, so its precision depends on
+    the bucket boundaries.  Use exponential_bounds to create boundaries with a fixed relative error.
+
+    This abstraction is not thread safe.
+    """
+    def __init__(self, bucket_bounds):
+        """Creates an empty histogram.
+
+        @param bucket_bounds: The upper bounds of the buckets, in increasing order.  Values greater than the last
+            bound are placed in an additional overflow bucket.
+        @type bucket_bounds: list of float
+        """
+        self.__bucket_bounds = list(bucket_bounds)
+        # The number of values in each bucket.  The last entry is the overflow bucket.
+        self.__bucket_counts = [0] * (len(self.__bucket_bounds) + 1)
+
+        self.__count = 0
+        self.__sum = 0.0
+        self.__min = None
+        self.__max = None
+
+    @staticmethod
+    def exponential_bounds(first_bound, factor, num_buckets):
+        """Returns bucket boundaries that grow by factor from one bucket to the next.
+
+        @param first_bound: The upper bound of the first bucket.
+        @param factor: The ratio between the upper bounds of consecutive buckets.
+        @param num_buckets: The number of buckets.
+
+        @type first_bound: float
+        @type factor: float
+        @type num_buckets: int
+
+        @rtype: list of float
+        """
+        result = []
+        bound = first_bound
+        for i in range(0, num_buckets):
+            result.append(bound)
+            bound *= factor
+        return result
+
+    def add(self, value):
+        """Adds a value to the histogram.
+
+        @param value: The value.
+        @type value: float
+        """
+        self.__bucket_counts[bisect.bisect_left(self.__bucket_bounds, value)] += 1
+        self.__count += 1
+        self.__sum += value
+        if self.__min is None or value < self.__min:
+            self.__min = value
+        if self.__max is None or value > self.__max:
+            self.__max = value
+
+    def count(self):
+        """
+        @return: The number of values added to the histogram.
+        @rtype: int
+        """
+        return self.__count
+
+    def average(self):
+        """
+        @return: The average of all values added to the histogram, or None if there are none.
+        @rtype: float
+        """
+        if self.__count == 0:
+            return None
+        return self.__sum / self.__count
+
+    def percentile(self, percentage):
+        """Returns an estimate of the specified percentile of the values added to the histogram.
+
+        @param percentage: The percentile to return, between 0 and 100.
+        @type percentage: float
+
+        @return: The upper bound of the bucket holding the percentile, limited to the range of the values that were
+            actually added.  None if no values have been added.
+        @rtype: float
+        """
+        if self.__count == 0:
+            return None
+
+        # The number of values that must be less than or equal to the result.
+        rank = max(1, int(round(self.__count * percentage / 100.0)))
+        seen = 0
+        for i in range(0, len(self.__bucket_counts)):
+            seen += self.__bucket_counts[i]
+            if seen >= rank:
+                break
+
+        if i >= len(self.__bucket_bounds):
+            return self.__max
+        return max(self.__min, min(self.__max, self.__bucket_bounds[i]))
+
+    def reset(self):
+        """Removes all values from the histogram."""
+        self.__bucket_counts = [0] * (len(self.__bucket_bounds) + 1)
+        self.__count = 0
+        self.__sum = 0.0
+        self.__min = None
+        self.__max = None